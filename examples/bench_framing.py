@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Benchmark of the stream framers of txosc.
+
+Compares the throughput of the OSC 1.0 length-prefixed framing with the
+OSC 1.1 SLIP framing, when splitting a stream into packets. Twisted is not
+used.
+
+This example is in the public domain.
+"""
+import time
+from txosc import osc
+from txosc import framing
+
+NUM_PACKETS = 100000
+CHUNK_SIZE = 4096
+
+def bench(framer_class, packets):
+    """
+    Returns the number of packets per second that are split.
+    """
+    framer = framer_class()
+    data = "".join(["".join(framer.frame(p)) for p in packets])
+    start = time.time()
+    count = 0
+    for i in range(0, len(data), CHUNK_SIZE):
+        count += len(framer.feed(data[i:i + CHUNK_SIZE]))
+    duration = time.time() - start
+    assert count == len(packets)
+    return count / duration
+
+if __name__ == "__main__":
+    # Some of the float arguments contain the SLIP special bytes.
+    packets = [osc.Message("/synth/%d/freq" % (i % 16), float(i), i).toBinary() for i in range(NUM_PACKETS)]
+    for framer_class in [framing.LengthPrefixedFramer, framing.SLIPFramer]:
+        print("%s: %d packets/s" % (framer_class.__name__, bench(framer_class, packets)))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Benchmark of the round-trip latency of txosc between local endpoints.
+
+A client sends /ping, the server replies /pong, and the client sends the
+next /ping when it receives the reply. This is done over UDP via
+localhost, over a Unix datagram socket, and over TCP and a Unix stream
+socket. The percentiles of the round-trip times are printed.
+
+This example is in the public domain.
+"""
+import os
+import time
+import shutil
+import tempfile
+from twisted.internet import reactor, defer
+from txosc import osc
+from txosc import dispatch
+from txosc import async
+from txosc import stats
+
+NUM_ROUND_TRIPS = 5000
+PING = osc.Message("/ping")
+PONG = osc.Message("/pong")
+
+
+class PingPong(object):
+    """
+    Measures the round trips, given a function which sends a ping.
+    """
+    def __init__(self, clientReceiver):
+        self.histogram = stats.Histogram()
+        self.done = defer.Deferred()
+        self.send = None
+        clientReceiver.addCallback("/pong", self.pong)
+
+    def start(self, send):
+        self.send = send
+        self.count = 0
+        self.sentAt = time.time()
+        self.send()
+
+    def pong(self, message, address):
+        self.histogram.record(time.time() - self.sentAt)
+        self.count += 1
+        if self.count == NUM_ROUND_TRIPS:
+            self.done.callback(self.histogram)
+            return
+        self.sentAt = time.time()
+        self.send()
+
+
+def benchUDP():
+    server = dispatch.Receiver()
+    serverProtocol = async.DatagramServerProtocol(server)
+    serverPort = reactor.listenUDP(0, serverProtocol, "127.0.0.1")
+    server.addCallback("/ping", lambda m, address: serverProtocol.transport.write(PONG.toBinary(), address))
+    client = dispatch.Receiver()
+    clientProtocol = async.DatagramServerProtocol(client)
+    clientPort = reactor.listenUDP(0, clientProtocol, "127.0.0.1")
+    bench = PingPong(client)
+    destination = ("127.0.0.1", serverPort.getHost().port)
+    bench.start(lambda: clientProtocol.transport.write(PING.toBinary(), destination))
+    def stop(histogram):
+        d = defer.DeferredList([serverPort.stopListening(), clientPort.stopListening()])
+        return d.addCallback(lambda result: histogram)
+    return bench.done.addCallback(stop)
+
+
+def benchUNIXDatagram(directory):
+    server = dispatch.Receiver()
+    serverPort = async.listenUNIXDatagram(os.path.join(directory, "server"), server)
+    server.addCallback("/ping", lambda m, address: serverPort.write(PONG.toBinary(), address))
+    client = dispatch.Receiver()
+    clientPort = async.listenUNIXDatagram(os.path.join(directory, "client"), client)
+    bench = PingPong(client)
+    serverPath = os.path.join(directory, "server")
+    bench.start(lambda: clientPort.write(PING.toBinary(), serverPath))
+    def stop(histogram):
+        d = defer.DeferredList([serverPort.stopListening(), clientPort.stopListening()])
+        return d.addCallback(lambda result: histogram)
+    return bench.done.addCallback(stop)
+
+
+def benchStream(listen, connect, noDelay):
+    server = dispatch.Receiver()
+    server.addCallback("/ping", lambda m, client: client.send(PONG))
+    serverPort = listen(server)
+    client = dispatch.Receiver()
+    factory = connect(client)
+    if noDelay:
+        factory.setNoDelay(True)
+    bench = PingPong(client)
+    factory.deferred.addCallback(lambda result: bench.start(lambda: factory.send(PING)))
+    def stop(histogram):
+        factory.connectedProtocol.transport.loseConnection()
+        return defer.maybeDeferred(serverPort.stopListening).addCallback(lambda result: histogram)
+    return bench.done.addCallback(stop)
+
+
+def benchTCP():
+    ports = []
+    def listen(receiver):
+        ports.append(reactor.listenTCP(0, async.ServerFactory(receiver), interface="127.0.0.1"))
+        return ports[0]
+    def connect(receiver):
+        factory = async.ClientFactory(receiver)
+        reactor.connectTCP("127.0.0.1", ports[0].getHost().port, factory)
+        return factory
+    return benchStream(listen, connect, True)
+
+
+def benchUNIX(directory):
+    path = os.path.join(directory, "stream")
+    return benchStream(lambda receiver: async.listenUNIX(path, receiver), lambda receiver: async.connectUNIX(path, receiver), False)
+
+
+@defer.inlineCallbacks
+def main():
+    directory = tempfile.mkdtemp()
+    for name, bench in [
+            ("UDP loopback", benchUDP),
+            ("Unix datagram", lambda: benchUNIXDatagram(directory)),
+            ("TCP loopback", benchTCP),
+            ("Unix stream", lambda: benchUNIX(directory)),
+            ]:
+        histogram = yield bench()
+        print("%-14s p50=%.1fus p90=%.1fus p99=%.1fus max=%.1fus" % (name,
+            histogram.getPercentile(50) * 1e6, histogram.getPercentile(90) * 1e6,
+            histogram.getPercentile(99) * 1e6, histogram.getMax() * 1e6))
+    shutil.rmtree(directory, ignore_errors=True)
+    reactor.stop()
+
+if __name__ == "__main__":
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Benchmark of the batched UDP send of txosc.
+
+Sends the same message many times to a local UDP socket from a blocking
+txosc.sync.UdpSender: one send() call per packet, then batches of packets
+with the txosc.mmsg.SendBatch used by sendMany(), first with a loop of
+sendto calls, then with sendmmsg, where it is available. The receiving socket is not read: the datagrams that do not
+fit in its buffer are dropped by the kernel, which does not slow down the
+sender.
+
+This example is in the public domain.
+"""
+import socket
+import time
+from txosc import osc
+from txosc import sync
+from txosc import mmsg
+
+NUM_PACKETS = 200000
+BATCH_SIZE = 64
+
+def bench(port, method):
+    """
+    Returns the number of packets per second that are sent.
+    """
+    sender = sync.UdpSender("127.0.0.1", port)
+    message = osc.Message("/synth/1/freq", 440.0)
+    packets = mmsg.makePackets([message] * BATCH_SIZE, ("127.0.0.1", port))
+    batches = NUM_PACKETS // BATCH_SIZE
+    start = time.time()
+    if method == "send":
+        for i in xrange(batches * BATCH_SIZE):
+            sender.send(message)
+    else:
+        batch = mmsg.SendBatch(BATCH_SIZE, method == "sendmmsg")
+        for i in xrange(batches):
+            batch.send(sender._socket, packets)
+    duration = time.time() - start
+    sender.close()
+    return batches * BATCH_SIZE / duration
+
+if __name__ == "__main__":
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    print("send: %d packets/s" % (bench(port, "send")))
+    print("sendMany, sendto loop: %d packets/s" % (bench(port, "loop")))
+    if mmsg.HAVE_SENDMMSG:
+        print("sendMany, sendmmsg: %d packets/s" % (bench(port, "sendmmsg")))
+    server.close()
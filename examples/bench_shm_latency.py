@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Benchmark of the round-trip latency of the shared memory ring buffers of
+txosc between two processes.
+
+A child process echoes each /ping it reads from a ring as a /pong in
+another ring. The parent sends the next /ping when it reads the reply.
+The rings are read by spinning on them, and by sleeping until the writer
+wakes the reader up. A blocking Unix datagram socket pair is measured
+the same way for comparison. The percentiles of the round-trip times are
+printed.
+
+Spinning only makes sense with a free CPU core for each process: on a
+single core, each side spins until the scheduler preempts it.
+
+This example is in the public domain.
+"""
+import os
+import time
+import socket
+import shutil
+import tempfile
+from txosc import osc
+from txosc import shm
+from txosc import stats
+
+NUM_ROUND_TRIPS = 20000
+PING = osc.Message("/ping").toBinary()
+PONG = osc.Message("/pong").toBinary()
+
+
+def spin(reader):
+    while True:
+        packets = reader.read()
+        if packets:
+            return packets
+
+
+def wait(reader):
+    while True:
+        packets = reader.wait()
+        if packets:
+            return packets
+
+
+def benchRing(directory, receive):
+    pings = os.path.join(directory, "pings")
+    pongs = os.path.join(directory, "pongs")
+    shm.createRing(pings)
+    shm.createRing(pongs)
+    pid = os.fork()
+    if pid == 0:
+        reader = shm.RingReader(pings)
+        writer = shm.RingWriter(pongs)
+        for i in range(NUM_ROUND_TRIPS):
+            for data in receive(reader):
+                writer.sendBinary(PONG)
+        os._exit(0)
+    reader = shm.RingReader(pongs)
+    writer = shm.RingWriter(pings)
+    histogram = stats.Histogram()
+    for i in range(NUM_ROUND_TRIPS):
+        sentAt = time.time()
+        writer.sendBinary(PING)
+        receive(reader)
+        histogram.record(time.time() - sentAt)
+    os.waitpid(pid, 0)
+    reader.close()
+    writer.close()
+    shm.removeRing(pings)
+    shm.removeRing(pongs)
+    return histogram
+
+
+def benchUNIXDatagram():
+    parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    pid = os.fork()
+    if pid == 0:
+        for i in range(NUM_ROUND_TRIPS):
+            child.recv(1024)
+            child.send(PONG)
+        os._exit(0)
+    histogram = stats.Histogram()
+    for i in range(NUM_ROUND_TRIPS):
+        sentAt = time.time()
+        parent.send(PING)
+        parent.recv(1024)
+        histogram.record(time.time() - sentAt)
+    os.waitpid(pid, 0)
+    parent.close()
+    child.close()
+    return histogram
+
+
+def main():
+    directory = tempfile.mkdtemp(dir=os.path.isdir("/dev/shm") and "/dev/shm" or None)
+    for name, bench in [
+            ("Ring, spinning", lambda: benchRing(directory, spin)),
+            ("Ring, wakeup", lambda: benchRing(directory, wait)),
+            ("Unix datagram", benchUNIXDatagram),
+            ]:
+        histogram = bench()
+        print("%-15s p50=%.1fus p90=%.1fus p99=%.1fus max=%.1fus" % (name,
+            histogram.getPercentile(50) * 1e6, histogram.getPercentile(90) * 1e6,
+            histogram.getPercentile(99) * 1e6, histogram.getMax() * 1e6))
+    shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Benchmark of the connected and unconnected UDP senders of txosc.
+
+Sends the same message many times to a local UDP socket with a blocking
+txosc.sync.UdpSender, first unconnected, then connected to the
+destination. The receiving socket is not read: the datagrams that do not
+fit in its buffer are dropped by the kernel, which does not slow down the
+sender.
+
+This example is in the public domain.
+"""
+import socket
+import time
+from txosc import osc
+from txosc import sync
+
+NUM_PACKETS = 200000
+
+def bench(port, connected):
+    """
+    Returns the number of packets per second that are sent.
+    """
+    sender = sync.UdpSender("127.0.0.1", port, connected=connected)
+    message = osc.Message("/synth/1/freq", 440.0)
+    start = time.time()
+    for i in xrange(NUM_PACKETS):
+        sender.send(message)
+    duration = time.time() - start
+    sender.close()
+    return NUM_PACKETS / duration
+
+if __name__ == "__main__":
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    print("unconnected: %d packets/s" % (bench(port, False)))
+    print("connected: %d packets/s" % (bench(port, True)))
+    server.close()
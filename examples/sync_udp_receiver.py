@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""
+Example of a UDP txosc receiver without Twisted.
+
+Send it messages with sync_udp_sender.py. Send /quit to stop it.
+
+This example is in the public domain.
+"""
+from txosc import dispatch
+from txosc import sync
+
+def hello(message, address):
+    print("Got %s from %s" % (message, address))
+
+if __name__ == "__main__":
+    receiver = dispatch.Receiver()
+    udp_receiver = sync.UdpReceiver(31337, receiver)
+    receiver.addCallback("/hello", hello)
+    receiver.addCallback("/quit", lambda message, address: udp_receiver.shutdown())
+    print("Listening on osc.udp://localhost:31337")
+    udp_receiver.serve_forever()
+    udp_receiver.close()
@@ -2,5 +2,5 @@
 """
 txosc: Open Sound Control for Twisted
 """
-__all__ = ["async", "dispatch", "osc"]
+__all__ = ["async", "dispatch", "framing", "mmsg", "osc", "rpc", "shm", "stats", "workers"]
 __version__ = "0.2.0"
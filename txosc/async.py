@@ -6,13 +6,56 @@
 """
 Asynchronous OSC sender and receiver using Twisted
 """
+import sys
+import time
+import collections
+import errno
 import struct
 import socket
 
-from twisted.internet import defer, protocol
+from twisted.internet import abstract, defer, protocol, task, udp
+from twisted.python import log
 from twisted.application.internet import MulticastServer
 from txosc.osc import *
 from txosc.osc import _elementFromBinary
+from txosc import framing
+from txosc import mmsg
+from txosc import shm
+from txosc import stats
+
+if hasattr(socket, "SO_REUSEPORT"):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+else:
+    SO_REUSEPORT = 0x200 # BSD and Mac OS X
+
+
+def _abortConnection(transport):
+    """
+    Closes a connection without waiting for the data to be written.
+    """
+    abort = getattr(transport, "abortConnection", None)
+    if abort is not None:
+        abort()
+    else:
+        transport.loseConnection()
+
+
+def _decodeElement(data, receiver):
+    """
+    Decodes an element, recording the time it takes in the profiler of the
+    receiver, if any.
+
+    @param receiver: L{txosc.dispatch.Receiver} instance or C{None}.
+    """
+    profiler = getattr(receiver, "profiler", None)
+    if profiler is None or not profiler.shouldSample():
+        return _elementFromBinary(data)
+    start = profiler.clock()
+    element = _elementFromBinary(data)
+    profiler.decodeTime.record(profiler.clock() - start)
+    return element
 
 #
 # Stream based client/server protocols
@@ -21,14 +64,50 @@ from txosc.osc import _elementFromBinary
 class StreamBasedProtocol(protocol.Protocol):
     """
     OSC over TCP sending and receiving protocol.
+
+    When the coalescing is enabled in its factory, the frames sent are
+    buffered and written all at once when the reactor gets back control,
+    or when C{coalesceMaxBytes} is reached.
+
+    The protocol is registered as a streaming producer of its transport.
+    While the transport asks it to pause, because the peer does not read
+    fast enough, the frames sent are kept in the protocol, up to the
+    C{maxOutboundBuffer} size of the factory. The elements sent beyond it
+    are dropped, and counted in the C{messagesDropped} of the factory.
+
+    Senders can wait for the L{Deferred} returned by L{send}, or for
+    L{whenWritable}, to slow down when the peer is slow. The protocol is
+    also a consumer, to which a producer of encoded OSC packets can be
+    registered: it is paused and resumed according to the
+    C{highWatermark} and C{lowWatermark} of the factory.
+
+    @ivar lastReceived: The time data was last received, in seconds, when
+        the factory watches the idle connections, or C{None}.
+    @ivar lastSent: The time an element was last sent, in seconds, when
+        the factory watches the idle connections, or C{None}.
     """
+    _flushCall = None
+    _paused = False
+    _producer = None
+    _idleCall = None
+    _lastKeepalive = None
+    lastReceived = None
+    lastSent = None
 
     def connectionMade(self):
-        self.factory.connectedProtocol = self
+        self._framer = self.factory.framer(self.factory.maxFrameSize)
+        self._pending = []
+        self._pendingSize = 0
+        self._pendingDeferreds = []
+        self._writableDeferreds = []
+        self._lostDeferreds = []
+        if self.factory.noDelay is not None and hasattr(self.transport, "setTcpNoDelay"):
+            self.transport.setTcpNoDelay(self.factory.noDelay)
+        if hasattr(self.transport, "registerProducer"):
+            self.transport.registerProducer(self, True)
+        self.factory.registerProtocol(self)
         if hasattr(self.factory, 'deferred'):
             self.factory.deferred.callback(True)
-        self._buffer = ""
-        self._pkgLen = None
 
 
     def dataReceived(self, data):
@@ -40,36 +119,254 @@ class StreamBasedProtocol(protocol.Protocol):
         followed by the contents of the first packet, followed by the
         size of the second packet, etc.
 
+        The connection is closed if a packet is larger than the
+        C{maxFrameSize} of the factory, or if the part of a packet kept is
+        larger than its C{maxPendingSize}.
+
         @type data: L{str}
         """
-        self._buffer += data
-        if len(self._buffer) < 4:
-            return
-        if self._pkgLen is None:
-            self._pkgLen = struct.unpack(">i", self._buffer[:4])[0]
-        if len(self._buffer) < self._pkgLen + 4:
-            print "waiting for %d more bytes" % (self._pkgLen + 4 - len(self._buffer))
+        factory = self.factory
+        if self.lastReceived is not None:
+            self.lastReceived = factory.getClock().seconds()
+        try:
+            payloads = self._framer.feed(data)
+        except OscError, e:
+            log.msg("Closing the connection: %s" % (e))
+            self.transport.loseConnection()
             return
-        payload = self._buffer[4:4 + self._pkgLen]
-        self._buffer = self._buffer[4 + self._pkgLen:]
-        self._pkgLen = None
-
-        if payload:
-            element = _elementFromBinary(payload)
-            self.factory.gotElement(element)
-
-        if len(self._buffer):
-            self.dataReceived("")
+        for payload in payloads:
+            if payload:
+                element = _decodeElement(payload, self.factory.receiver)
+                self.factory.gotElement(element, self)
+        # the complete packets are dispatched before the overflow aborts
+        if factory.maxPendingSize is not None and self._framer.getPendingSize() > factory.maxPendingSize:
+            factory.pendingOverflow(self)
 
 
     def send(self, element):
         """
         Send an OSC element over the TCP wire.
         @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        @return: A L{Deferred} which fires with C{True} once the element
+            is written to the transport, or C{False} if it is dropped.
         """
-        binary = element.toBinary()
-        self.transport.write(struct.pack(">i", len(binary)) + binary)
-        #TODO: return a Deferred
+        return self.sendBinary(element.toBinary())
+
+
+    def sendBinary(self, binary):
+        """
+        Send an already encoded OSC packet over the TCP wire.
+        @type binary: C{str}
+        @return: A L{Deferred}. See L{send}.
+        """
+        frames = self._framer.frame(binary)
+        factory = self.factory
+        if self.lastSent is not None:
+            self.lastSent = factory.getClock().seconds()
+        size = sum([len(f) for f in frames])
+        if not factory.coalesce and not self._paused:
+            factory.messagesSent += 1
+            self.transport.writeSequence(frames)
+            factory.writesFlushed += 1
+            factory.bytesSent += size
+            return defer.succeed(True)
+        if self._pendingSize + size > factory.maxOutboundBuffer:
+            factory.messagesDropped += 1
+            return defer.succeed(False)
+        factory.messagesSent += 1
+        d = defer.Deferred()
+        self._pending.extend(frames)
+        self._pendingSize += size
+        self._pendingDeferreds.append(d)
+        if factory.maxPendingSize is not None and self._pendingSize > factory.maxPendingSize:
+            factory.pendingOverflow(self)
+            return d
+        if self._pendingSize >= factory.highWatermark:
+            self._pauseProducer()
+        if self._paused:
+            return d
+        if self._pendingSize >= factory.coalesceMaxBytes:
+            self.flush()
+        elif self._flushCall is None:
+            self._flushCall = factory.getClock().callLater(factory.coalesceDelay, self.flush)
+        return d
+
+
+    def flush(self):
+        """
+        Writes the frames buffered by the coalescing to the transport, in
+        a single call.
+
+        Nothing is written while the transport has paused the protocol.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        if not self._pending or self._paused:
+            return
+        self.transport.writeSequence(self._pending)
+        self.factory.writesFlushed += 1
+        self.factory.bytesSent += self._pendingSize
+        deferreds = self._pendingDeferreds
+        self._pending = []
+        self._pendingSize = 0
+        self._pendingDeferreds = []
+        for d in deferreds:
+            d.callback(True)
+        self._checkWritable()
+
+
+    def getPendingSize(self):
+        """
+        Returns the number of bytes sent that have not been written to
+        the transport yet.
+        @rtype: C{int}
+        """
+        return self._pendingSize
+
+
+    def isWritable(self):
+        """
+        Returns whether the transport accepts data and the pending data is
+        under the C{highWatermark} of the factory.
+        @rtype: C{bool}
+        """
+        return not self._paused and self._pendingSize < self.factory.highWatermark
+
+
+    def whenWritable(self):
+        """
+        Returns a L{Deferred} which fires when the transport accepts data
+        and the pending data is down to the C{lowWatermark} of the factory.
+        It fails if the connection is lost first.
+        """
+        if not self._paused and self._pendingSize <= self.factory.lowWatermark:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._writableDeferreds.append(d)
+        return d
+
+
+    def notifyConnectionLost(self):
+        """
+        Returns a L{Deferred} which fails with the reason of the loss of
+        the connection.
+        """
+        d = defer.Deferred()
+        self._lostDeferreds.append(d)
+        return d
+
+
+    def _checkWritable(self):
+        if self._paused or self._pendingSize > self.factory.lowWatermark:
+            return
+        if self._producer is not None:
+            if self._streamingProducer:
+                if self._producerPaused:
+                    self._producerPaused = False
+                    self._producer.resumeProducing()
+            else:
+                self._producer.resumeProducing()
+        deferreds = self._writableDeferreds
+        self._writableDeferreds = []
+        for d in deferreds:
+            d.callback(None)
+
+
+    def _pauseProducer(self):
+        if self._producer is not None and self._streamingProducer and not self._producerPaused:
+            self._producerPaused = True
+            self._producer.pauseProducing()
+
+
+    # IPushProducer, for the transport
+
+    def pauseProducing(self):
+        """
+        Called by the transport when its buffer is full.
+        """
+        self._paused = True
+        self._pauseProducer()
+
+
+    def resumeProducing(self):
+        """
+        Called by the transport when its buffer has been written to the
+        socket. The frames kept meanwhile are written.
+        """
+        self._paused = False
+        self.flush()
+        self._checkWritable()
+
+
+    def stopProducing(self):
+        """
+        Called by the transport when the connection is lost.
+        """
+        deferreds = self._pendingDeferreds
+        self._pending = []
+        self._pendingSize = 0
+        self._pendingDeferreds = []
+        for d in deferreds:
+            d.callback(False)
+
+
+    # IConsumer, for the producers of OSC packets
+
+    def registerProducer(self, producer, streaming):
+        """
+        Registers a producer which writes encoded OSC packets to this
+        protocol with L{write}.
+
+        A streaming producer is paused when the pending data reaches the
+        C{highWatermark} of the factory, and resumed when it is down to
+        its C{lowWatermark}. A non-streaming producer is asked for more
+        data each time the pending data is down to the C{lowWatermark}.
+        """
+        if self._producer is not None:
+            raise RuntimeError("Cannot register two producers")
+        self._producer = producer
+        self._streamingProducer = streaming
+        self._producerPaused = False
+        if not streaming:
+            producer.resumeProducing()
+
+
+    def unregisterProducer(self):
+        """
+        Unregisters the producer.
+        """
+        self._producer = None
+
+
+    def write(self, data):
+        """
+        Sends an encoded OSC packet. See L{sendBinary}.
+        """
+        self.sendBinary(data)
+
+
+    def connectionLost(self, reason):
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        self.stopProducing()
+        deferreds = self._writableDeferreds
+        self._writableDeferreds = []
+        for d in deferreds:
+            d.errback(reason)
+        self.factory.unregisterProtocol(self)
+        deferreds = self._lostDeferreds
+        self._lostDeferreds = []
+        for d in deferreds:
+            d.errback(reason)
+
+
+    def __str__(self):
+        if self.transport is None:
+            return protocol.Protocol.__str__(self)
+        return str(self.transport.getPeer())
 
 
 
@@ -78,24 +375,184 @@ class StreamBasedFactory(object):
     Factory object for the sending and receiving of elements in a
     stream-based protocol (e.g. TCP, serial).
 
+    The OSC 1.0 length-prefixed framing is used by default. Pass
+    L{txosc.framing.SLIPFramer} as the framer to use the OSC 1.1 SLIP
+    framing instead. Here is an example on how to use it with a serial
+    port::
+
+      factory = ServerFactory(receiver, framer=framing.SLIPFramer)
+      SerialPort(factory.buildProtocol(None), "/dev/ttyUSB0", reactor)
+
     @ivar receiver:  A L{Receiver} object which is used to dispatch
         incoming messages to.
     @ivar connectedProtocol: An instance of L{StreamBasedProtocol}
         representing the current connection.
+    @ivar framer: The class of the L{txosc.framing} framer used to split
+        the stream into packets.
+    @ivar maxFrameSize: The largest packet size accepted, in bytes.
+    @ivar coalesce: Whether the frames sent are buffered and written
+        together. See L{setCoalescing}.
+    @ivar noDelay: Value of the C{TCP_NODELAY} option of the connections,
+        or C{None} to leave the default of the system.
+    @ivar maxOutboundBuffer: The most bytes kept by a protocol while its
+        transport is paused or while coalescing.
+    @ivar maxPendingSize: The most bytes kept by a protocol, to send or
+        received, before its connection is aborted, or C{None}. See
+        L{ServerFactory.setLimits}.
+    @ivar highWatermark: Number of bytes kept by a protocol above which
+        it pauses its producer.
+    @ivar lowWatermark: Number of bytes kept by a protocol under which it
+        resumes its producer.
+    @ivar messagesSent: Number of elements sent.
+    @ivar messagesDropped: Number of elements dropped because the
+        C{maxOutboundBuffer} was reached.
+    @ivar writesFlushed: Number of writes to the transport.
+    @ivar bytesSent: Number of bytes written to the transport.
     """
     receiver = None
     connectedProtocol = None
+    framer = framing.LengthPrefixedFramer
+    maxFrameSize = framing.DEFAULT_MAX_FRAME_SIZE
+    coalesce = False
+    coalesceMaxBytes = 64 * 1024
+    coalesceDelay = 0.0
+    noDelay = None
+    clock = None
+    maxOutboundBuffer = 1 << 20 # 1 MiB
+    maxPendingSize = None
+    highWatermark = 64 * 1024
+    lowWatermark = 16 * 1024
+    messagesSent = 0
+    messagesDropped = 0
+    writesFlushed = 0
+    bytesSent = 0
 
-    def __init__(self, receiver=None):
+    def __init__(self, receiver=None, framer=None):
+        """
+        @param receiver: L{txosc.dispatch.Receiver} instance.
+        @param framer: The class of the framer, from L{txosc.framing}.
+        """
         if receiver:
             self.receiver = receiver
+        if framer:
+            self.framer = framer
 
 
     def send(self, element):
-        self.connectedProtocol.send(element)
+        """
+        Send an OSC element with the connected protocol.
+        @return: A L{Deferred}. See L{StreamBasedProtocol.send}.
+        """
+        return self.connectedProtocol.send(element)
+
+
+    def sendBinary(self, binary):
+        """
+        Send an already encoded OSC packet.
+        @type binary: C{str}
+        @return: A L{Deferred}. See L{StreamBasedProtocol.send}.
+        """
+        return self.connectedProtocol.sendBinary(binary)
+
+
+    def flush(self):
+        """
+        Writes the frames buffered by the coalescing right away.
+        """
+        self.connectedProtocol.flush()
+
+
+    def setCoalescing(self, enabled=True, maxBytes=64 * 1024, delay=0.0):
+        """
+        Enables or disables the coalescing of the frames sent.
+
+        When enabled, frames are buffered and written to the transport
+        with a single C{writeSequence} call, which reduces the number of
+        system calls for bursts of small messages.
+
+        @param maxBytes: The buffered frames are written as soon as they
+            reach this size, in bytes.
+        @param delay: The buffered frames are written at most this time
+            after the first of them was sent, in seconds. With 0, they are
+            written when the reactor gets back control.
+        """
+        self.coalesce = enabled
+        self.coalesceMaxBytes = maxBytes
+        self.coalesceDelay = delay
+        if not enabled and self.connectedProtocol is not None:
+            self.connectedProtocol.flush()
+
+
+    def setNoDelay(self, enabled):
+        """
+        Sets the C{TCP_NODELAY} option of the connection, which disables
+        the Nagle algorithm.
+        @type enabled: C{bool}
+        """
+        self.noDelay = enabled
+        protocol = self.connectedProtocol
+        if protocol is not None and hasattr(protocol.transport, "setTcpNoDelay"):
+            protocol.transport.setTcpNoDelay(enabled)
+
+
+    def getWriteStats(self):
+        """
+        Returns the counters of the data sent.
+
+        When the coalescing is enabled, C{"messages"} is larger than
+        C{"writes"}.
+        @rtype: C{dict}
+        """
+        return {
+            "messages": self.messagesSent,
+            "dropped": self.messagesDropped,
+            "writes": self.writesFlushed,
+            "bytes": self.bytesSent,
+            }
+
+
+    def getClock(self):
+        """
+        Returns the C{IReactorTime} provider used for the coalescing.
+        """
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+
+    def registerProtocol(self, protocol):
+        """
+        Called by a protocol when its connection is made.
+        @type protocol: L{StreamBasedProtocol}
+        """
+        self.connectedProtocol = protocol
+
+
+    def unregisterProtocol(self, protocol):
+        """
+        Called by a protocol when its connection is lost.
+        @type protocol: L{StreamBasedProtocol}
+        """
+        if self.connectedProtocol is protocol:
+            self.connectedProtocol = None
+
+
+    def pendingOverflow(self, protocol):
+        """
+        Called by a protocol when it keeps more than C{maxPendingSize}
+        bytes. Its connection is aborted.
+        @type protocol: L{StreamBasedProtocol}
+        """
+        log.msg("Aborting the connection to %s: more than %d bytes are pending." % (protocol, self.maxPendingSize))
+        _abortConnection(protocol.transport)
 
 
-    def gotElement(self, element):
+    def gotElement(self, element, protocol=None):
+        """
+        Dispatches an element received by a protocol to the receiver.
+        @param protocol: The L{StreamBasedProtocol} that received it.
+        """
         if self.receiver:
             self.receiver.dispatch(element, self)
         else:
@@ -111,77 +568,1528 @@ class ClientFactory(protocol.ClientFactory, StreamBasedFactory):
     """
     protocol = StreamBasedProtocol
 
-    def __init__(self, receiver=None):
-        StreamBasedFactory.__init__(self, receiver)
+    def __init__(self, receiver=None, framer=None):
+        StreamBasedFactory.__init__(self, receiver, framer)
         self.deferred = defer.Deferred()
 
 
 class ServerFactory(protocol.ServerFactory, StreamBasedFactory):
     """
     TCP server factory
+
+    It keeps track of all its connected protocols. The received elements
+    are dispatched with the protocol that received them as the client, so
+    that callbacks reply to the right peer. C{connectedProtocol} is the
+    last connected protocol still alive.
+
+    The number of connections, the data kept for each of them, and the
+    time they stay idle can be limited, so that the memory used stays
+    bounded when many clients connect or stop responding. See
+    L{setLimits}.
+
+    @ivar connectedProtocols: C{set} of the connected L{StreamBasedProtocol}s.
+    @ivar maxConnections: The most connections at once, or C{None}.
+    @ivar idleTimeout: The time after which a connection on which nothing
+        is received is aborted, in seconds, or C{None}.
+    @ivar keepaliveInterval: The time after which C{keepaliveMessage} is
+        sent on a connection on which nothing is received, and then again
+        each time it elapses, in seconds, or C{None}.
+    @ivar keepaliveMessage: The L{Message} sent as a keepalive.
+    @ivar connectionsAccepted: Number of connections accepted.
+    @ivar connectionsRejected: Number of connections closed right away
+        because of C{maxConnections}.
+    @ivar connectionsReaped: Number of connections aborted because they
+        were idle.
+    @ivar connectionsOverflowed: Number of connections aborted because of
+        C{maxPendingSize}.
     """
     protocol = StreamBasedProtocol
+    maxConnections = None
+    idleTimeout = None
+    keepaliveInterval = None
+    keepaliveMessage = Message("/ping")
+    connectionsAccepted = 0
+    connectionsRejected = 0
+    connectionsReaped = 0
+    connectionsOverflowed = 0
 
+    def __init__(self, receiver=None, framer=None):
+        StreamBasedFactory.__init__(self, receiver, framer)
+        self.connectedProtocols = set()
 
-#
-# Datagram client/server protocols
-#
 
-class DatagramServerProtocol(protocol.DatagramProtocol):
+    def setLimits(self, maxConnections=None, maxPendingSize=None, idleTimeout=None, keepaliveInterval=None):
+        """
+        Sets the limits of the connections. C{None} disables a limit.
+
+        The limits on the idle time apply to the connections made
+        afterwards.
+
+        @param maxConnections: The most connections at once. The
+            connections beyond are closed as soon as they are accepted.
+        @param maxPendingSize: The most bytes kept for a connection: the
+            frames sent that the peer does not read, or the part of a
+            frame received. The connection is aborted beyond.
+        @param idleTimeout: The connections on which nothing is received
+            for this time, in seconds, are aborted.
+        @param keepaliveInterval: The C{keepaliveMessage} is sent on the
+            connections on which nothing is received for this time, in
+            seconds, so that dead peers are detected and the peers can
+            answer to stay connected.
+        """
+        self.maxConnections = maxConnections
+        self.maxPendingSize = maxPendingSize
+        self.idleTimeout = idleTimeout
+        self.keepaliveInterval = keepaliveInterval
+
+
+    def getConnectionStats(self):
+        """
+        Returns the counters of the connections.
+
+        @return: C{dict} with the number of C{"connections"}, and the
+            number of connections C{"accepted"}, C{"rejected"}, C{"reaped"}
+            because they were idle, and C{"overflowed"}.
+        """
+        return {
+            "connections": len(self.connectedProtocols),
+            "accepted": self.connectionsAccepted,
+            "rejected": self.connectionsRejected,
+            "reaped": self.connectionsReaped,
+            "overflowed": self.connectionsOverflowed,
+            }
+
+
+    def buildProtocol(self, addr):
+        if self.maxConnections is not None and len(self.connectedProtocols) >= self.maxConnections:
+            self.connectionsRejected += 1
+            return None
+        self.connectionsAccepted += 1
+        return protocol.ServerFactory.buildProtocol(self, addr)
+
+
+    def registerProtocol(self, protocol):
+        self.connectedProtocols.add(protocol)
+        self.connectedProtocol = protocol
+        if self.idleTimeout is not None or self.keepaliveInterval is not None:
+            now = self.getClock().seconds()
+            protocol.lastReceived = now
+            protocol._lastKeepalive = now
+            self._scheduleIdleCheck(protocol, now)
+
+
+    def unregisterProtocol(self, protocol):
+        self.connectedProtocols.discard(protocol)
+        if protocol._idleCall is not None:
+            if protocol._idleCall.active():
+                protocol._idleCall.cancel()
+            protocol._idleCall = None
+        if self.connectedProtocol is protocol:
+            self.connectedProtocol = None
+            for other in self.connectedProtocols:
+                self.connectedProtocol = other
+                break
+
+
+    def pendingOverflow(self, protocol):
+        self.connectionsOverflowed += 1
+        StreamBasedFactory.pendingOverflow(self, protocol)
+
+
+    def _scheduleIdleCheck(self, protocol, now):
+        """
+        Schedules the next check of an idle connection, when it has to be
+        aborted or sent a keepalive if nothing is received meanwhile.
+        """
+        times = []
+        if self.idleTimeout is not None:
+            times.append(protocol.lastReceived + self.idleTimeout)
+        if self.keepaliveInterval is not None:
+            times.append(max(protocol.lastReceived, protocol._lastKeepalive) + self.keepaliveInterval)
+        protocol._idleCall = self.getClock().callLater(max(0, min(times) - now), self._checkIdle, protocol)
+
+
+    def _checkIdle(self, protocol):
+        protocol._idleCall = None
+        now = self.getClock().seconds()
+        if self.idleTimeout is not None and now - protocol.lastReceived >= self.idleTimeout:
+            self.connectionsReaped += 1
+            _abortConnection(protocol.transport)
+            return
+        if self.keepaliveInterval is not None and now - max(protocol.lastReceived, protocol._lastKeepalive) >= self.keepaliveInterval:
+            protocol._lastKeepalive = now
+            protocol.send(self.keepaliveMessage)
+        if protocol in self.connectedProtocols:
+            self._scheduleIdleCheck(protocol, now)
+
+
+    def gotElement(self, element, protocol=None):
+        if not self.receiver:
+            raise OscError("Element received, but no Receiver in place: " + str(element))
+        if protocol is None:
+            protocol = self
+        self.receiver.dispatch(element, protocol)
+
+
+    def broadcast(self, element):
+        """
+        Sends an element to all the connected clients.
+
+        The element is encoded once. A slow client does not slow down the
+        others: what it cannot receive is kept up to C{maxOutboundBuffer}
+        bytes, and dropped beyond.
+
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        @return: The number of clients it was sent to.
+        @rtype: C{int}
+        """
+        binary = element.toBinary()
+        for protocol in self.connectedProtocols:
+            protocol.sendBinary(binary)
+        return len(self.connectedProtocols)
+
+
+class _PooledClientFactory(protocol.ReconnectingClientFactory, StreamBasedFactory):
     """
-    The UDP OSC server protocol.
+    The factory of the connection of a L{ConnectionPool} to a destination.
 
-    @ivar receiver: The L{Receiver} instance to dispatch received
-        elements to.
+    @ivar queue: C{deque} of the C{(binary, deferred)} sent while not
+        connected.
+    @ivar lastUsed: The time of the last send through the pool, in
+        seconds. The traffic of the connected protocol is also taken into
+        account to find out whether the connection is idle.
     """
+    protocol = StreamBasedProtocol
+    noisy = False
+
+    def __init__(self, pool, destination, receiver=None, framer=None):
+        StreamBasedFactory.__init__(self, receiver, framer)
+        self.pool = pool
+        self.destination = destination
+        self.queue = collections.deque()
+        self.waiting = []
+        self.lastUsed = None
+        self.reapCall = None
+        self.connects = 0
+        self.failures = 0
+        self.dropped = 0
+        self._closed = None
+
+
+    def registerProtocol(self, protocol):
+        StreamBasedFactory.registerProtocol(self, protocol)
+        protocol.lastReceived = protocol.lastSent = self.getClock().seconds()
+        self.resetDelay()
+        self.pool._connected(self)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.continueTrying:
+            self.failures += 1
+            self.pool.failures += 1
+        protocol.ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+        self._checkGaveUp(reason)
+
 
-    def __init__(self, receiver):
+    def clientConnectionLost(self, connector, reason):
+        protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+        self._checkGaveUp(reason)
+
+
+    def _checkGaveUp(self, reason):
+        if not self.continueTrying:
+            if self._closed is not None:
+                d, self._closed = self._closed, None
+                d.callback(None)
+        elif self._callID is None:
+            # ReconnectingClientFactory.retry gave up after maxRetries
+            self.pool._gaveUp(self, reason)
+
+
+    def stop(self):
         """
-        @param receiver: L{Receiver} instance.
+        Stops reconnecting, and closes the connection. A connection
+        attempt in progress is stopped by C{stopTrying}, through the
+        C{connector} of the factory.
+        @return: A L{Deferred} which fires once the connection is closed.
         """
-        self.receiver = receiver
+        self.stopTrying()
+        if self.connectedProtocol is None:
+            return defer.succeed(None)
+        self._closed = defer.Deferred()
+        self.connectedProtocol.transport.loseConnection()
+        return self._closed
 
-    def datagramReceived(self, data, (host, port)):
-        element = _elementFromBinary(data)
-        self.receiver.dispatch(element, (host, port))
 
-class MulticastDatagramServerProtocol(DatagramServerProtocol):
+
+class ConnectionPool(object):
     """
-    UDP OSC server protocol that can listen to multicast.
-    
-    Here is an example on how to use it:
-    
-      reactor.listenMulticast(8005, MulticastServerUDP(receiver, "224.0.0.1"), listenMultiple=True)
-    
-    This way, many listeners can listen on the same port, same host, to the same multicast group. (in this case, the 224.0.0.1 multicast group)
+    Keeps a TCP connection to each destination OSC is sent to.
+
+    The connection to a destination is made the first time something is
+    sent to it. The elements sent while it is not connected are queued, up
+    to C{maxQueueSize} elements, and sent once it is. The elements beyond
+    are dropped. When a connection is lost or cannot be made, it is made
+    again after an exponentially growing delay, from C{initialDelay} to
+    C{maxDelay} seconds. After C{maxRetries} consecutive failures, if set,
+    the queued elements are dropped and the destination is forgotten.
+
+    A connection on which nothing was sent or received for C{idleTimeout}
+    seconds is closed, including when the protocol returned by
+    L{getProtocol} is used directly.
+
+    Here is an example on how to use it::
+
+      pool = ConnectionPool(receiver)
+      pool.send(osc.Message("/ping"), ("localhost", 17779))
+
+    @ivar receiver: The L{Receiver} the replies are dispatched to, with
+        the factory of their connection as the client.
+    @ivar framer: The framer class. See L{StreamBasedFactory}.
+    @ivar maxQueueSize: The most elements queued for a destination.
+    @ivar idleTimeout: Delay after which an unused connection is closed,
+        in seconds, or C{None} to keep them open.
+    @ivar reactor: The reactor to use. Defaults to the global reactor.
     """
-    def __init__(self, receiver, multicast_addr="224.0.0.1"):
+    reactor = None
+    initialDelay = 0.5
+    maxDelay = 30.0
+    maxRetries = None
+
+    def __init__(self, receiver=None, framer=None, maxQueueSize=1024, idleTimeout=300.0):
+        self.receiver = receiver
+        self.framer = framer
+        self.maxQueueSize = maxQueueSize
+        self.idleTimeout = idleTimeout
+        self.connects = 0
+        self.failures = 0
+        self.dropped = 0
+        self.reaped = 0
+        self._factories = {}
+
+
+    def send(self, element, destination):
         """
-        @param multicast_addr: IP address of the multicast group.
-        @param receiver: L{txosc.dispatch.Receiver} instance.
-        @type multicast_addr: str
-        @type receiver: L{txosc.dispatch.Receiver}
+        Sends an OSC element to a destination.
+
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        @param destination: C{(host, port)} tuple.
+        @return: A L{Deferred} which fires with C{True} once the element is
+            written to the transport, or C{False} if it is dropped. See
+            L{StreamBasedProtocol.send}.
         """
-        self.multicast_addr = multicast_addr
-        DatagramServerProtocol.__init__(self, receiver)
-        
-    def startProtocol(self):
+        return self.sendBinary(element.toBinary(), destination)
+
+
+    def sendBinary(self, binary, destination):
         """
-        Join a specific multicast group, which is the IP we will respond to
+        Sends an already encoded OSC packet to a destination.
+        @type binary: C{str}
+        @return: A L{Deferred}. See L{send}.
         """
-        self.transport.joinGroup(self.multicast_addr)
+        factory = self._getFactory(destination)
+        factory.lastUsed = self._getReactor().seconds()
+        if factory.connectedProtocol is not None:
+            return factory.connectedProtocol.sendBinary(binary)
+        if len(factory.queue) >= self.maxQueueSize:
+            factory.dropped += 1
+            self.dropped += 1
+            return defer.succeed(False)
+        d = defer.Deferred()
+        factory.queue.append((binary, d))
+        return d
 
-class DatagramClientProtocol(protocol.DatagramProtocol):
-    """
-    The UDP OSC client protocol.
-    """
 
-    def send(self, element, (host, port)):
+    def getProtocol(self, destination):
         """
-        Send a L{txosc.osc.Message} or L{txosc.osc.Bundle} to the address specified.
-        @type element: L{txosc.osc.Message}
+        Returns the connected protocol of a destination, connecting to it
+        if needed.
+
+        @param destination: C{(host, port)} tuple.
+        @return: A L{Deferred} which fires with the L{StreamBasedProtocol}
+            once connected. It fails if the pool gives up connecting.
+        """
+        factory = self._getFactory(destination)
+        factory.lastUsed = self._getReactor().seconds()
+        if factory.connectedProtocol is not None:
+            return defer.succeed(factory.connectedProtocol)
+        d = defer.Deferred()
+        factory.waiting.append(d)
+        return d
+
+
+    def close(self, destination):
+        """
+        Closes the connection to a destination, and drops what is queued
+        for it.
+        @return: A L{Deferred} which fires once the connection is closed.
+        """
+        factory = self._factories.get(destination)
+        if factory is None:
+            return defer.succeed(None)
+        return self._remove(factory, OscError("The connection to %s:%s is closed." % destination))
+
+
+    def closeAll(self):
+        """
+        Closes all the connections.
+        @return: A L{Deferred} which fires once they are closed.
+        """
+        return defer.gatherResults([self.close(destination) for destination in self._factories.keys()])
+
+
+    def getStats(self):
+        """
+        Returns the statistics of the pool.
+
+        @return: C{dict} with the number of C{"connections"} which are
+            connected and C{"connecting"}, the number of elements
+            C{"queued"}, the counters of the successful C{"connects"}, of
+            the connection C{"failures"}, of the elements C{"dropped"} by
+            the queues, and of the idle connections C{"reaped"}, and a
+            C{"destinations"} C{dict} of the statistics of each
+            destination.
+        """
+        destinations = {}
+        for destination, factory in self._factories.iteritems():
+            destinations[destination] = {
+                "connected": factory.connectedProtocol is not None,
+                "queued": len(factory.queue),
+                "connects": factory.connects,
+                "failures": factory.failures,
+                "dropped": factory.dropped,
+                "sent": factory.messagesSent,
+                }
+        connected = len([stats for stats in destinations.itervalues() if stats["connected"]])
+        return {
+            "connections": connected,
+            "connecting": len(destinations) - connected,
+            "queued": sum([stats["queued"] for stats in destinations.itervalues()]),
+            "connects": self.connects,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "reaped": self.reaped,
+            "destinations": destinations,
+            }
+
+
+    def _getFactory(self, destination):
+        factory = self._factories.get(destination)
+        if factory is None:
+            reactor = self._getReactor()
+            factory = _PooledClientFactory(self, destination, self.receiver, self.framer)
+            factory.initialDelay = factory.delay = self.initialDelay
+            factory.maxDelay = self.maxDelay
+            factory.maxRetries = self.maxRetries
+            factory.clock = reactor
+            self._factories[destination] = factory
+            host, port = destination
+            factory.connector = reactor.connectTCP(host, port, factory)
+            if self.idleTimeout is not None:
+                factory.reapCall = reactor.callLater(self.idleTimeout, self._reap, factory)
+        return factory
+
+
+    def _connected(self, factory):
+        self.connects += 1
+        factory.connects += 1
+        protocol = factory.connectedProtocol
+        queue = factory.queue
+        while queue and factory.connectedProtocol is protocol:
+            binary, d = queue.popleft()
+            protocol.sendBinary(binary).chainDeferred(d)
+        waiting = factory.waiting
+        factory.waiting = []
+        for d in waiting:
+            d.callback(protocol)
+
+
+    def _gaveUp(self, factory, reason):
+        log.msg("Giving up connecting to %s:%s: %s" % (factory.destination + (reason.getErrorMessage(),)))
+        self._remove(factory, reason)
+
+
+    def _remove(self, factory, reason):
+        """
+        Forgets a destination, and stops its connection.
         """
-        data = element.toBinary()
-        self.transport.write(data, (socket.gethostbyname(host), port))
+        if self._factories.get(factory.destination) is factory:
+            del self._factories[factory.destination]
+        if factory.reapCall is not None and factory.reapCall.active():
+            factory.reapCall.cancel()
+        factory.reapCall = None
+        queue = factory.queue
+        factory.queue = collections.deque()
+        self.dropped += len(queue)
+        factory.dropped += len(queue)
+        for binary, d in queue:
+            d.callback(False)
+        waiting = factory.waiting
+        factory.waiting = []
+        for d in waiting:
+            d.errback(reason)
+        return factory.stop()
 
 
+    def _reap(self, factory):
+        factory.reapCall = None
+        reactor = self._getReactor()
+        lastUsed = factory.lastUsed
+        protocol = factory.connectedProtocol
+        if protocol is not None:
+            lastUsed = max(lastUsed, protocol.lastReceived, protocol.lastSent)
+        idle = reactor.seconds() - lastUsed
+        if idle < self.idleTimeout:
+            factory.reapCall = reactor.callLater(self.idleTimeout - idle, self._reap, factory)
+            return
+        self.reaped += 1
+        self._remove(factory, OscError("The connection to %s:%s was idle." % factory.destination))
+
+
+    def _getReactor(self):
+        if self.reactor is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.reactor
+
+
+#
+# Datagram client/server protocols
+#
+
+class DatagramServerProtocol(protocol.DatagramProtocol):
+    """
+    The UDP OSC server protocol.
+
+    The size of the receive buffer of the socket can be set, so that
+    bursts of datagrams are not dropped by the kernel. On Linux, the
+    C{SO_RXQ_OVFL} option is set, so that the number of datagrams dropped
+    is known. See L{getStats}.
+
+    @ivar receiver: The L{Receiver} instance to dispatch received
+        elements to.
+    @ivar receiveBufferSize: The requested C{SO_RCVBUF} size, in bytes,
+        or C{None} to keep the default one.
+    @ivar datagramCount: Number of datagrams received.
+    @ivar byteCount: Number of bytes received.
+    """
+    clock = time.time
+
+    def __init__(self, receiver, receiveBufferSize=None):
+        """
+        @param receiver: L{Receiver} instance.
+        @param receiveBufferSize: The C{SO_RCVBUF} size, in bytes.
+        @type receiveBufferSize: C{int}
+        """
+        self.receiver = receiver
+        self.receiveBufferSize = receiveBufferSize
+        self.datagramCount = 0
+        self.byteCount = 0
+        self._lastStats = None
+
+    def startProtocol(self):
+        """
+        Sets the options of the socket.
+        """
+        sock = getattr(self.transport, "socket", None)
+        if sock is not None:
+            if self.receiveBufferSize is not None:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receiveBufferSize)
+                size = self.getReceiveBufferSize()
+                expected = self.receiveBufferSize
+                # Linux reports twice the size which is set, for its overhead.
+                if sys.platform.startswith("linux"):
+                    expected *= 2
+                if size < expected:
+                    log.msg("The UDP receive buffer is limited to %d bytes instead of %d. See the net.core.rmem_max sysctl." % (size, self.receiveBufferSize))
+            if sys.platform.startswith("linux"):
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, mmsg.SO_RXQ_OVFL, 1)
+                except socket.error:
+                    pass
+        self._lastStats = (self.clock(), self.datagramCount, self.getKernelDrops())
+
+    def getReceiveBufferSize(self):
+        """
+        Returns the actual size of the receive buffer of the socket, in bytes.
+        @rtype: C{int}
+        """
+        return self.transport.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def getKernelDrops(self):
+        """
+        Returns the number of datagrams dropped by the kernel because the
+        receive buffer was full.
+
+        It is read from the ancillary data received by a
+        L{BatchDatagramPort}, or else from C{/proc/net/udp}.
+
+        @return: The number of drops, or C{None} if it is not known.
+        """
+        getDrops = getattr(self.transport, "getKernelDrops", None)
+        if getDrops is not None:
+            drops = getDrops()
+            if drops is not None:
+                return drops
+        sock = getattr(self.transport, "socket", None)
+        if sock is None:
+            return None
+        return stats.readUdpDrops(sock)
+
+    def getStats(self):
+        """
+        Returns the reception statistics.
+
+        The rates are computed over the time since the previous call, or
+        since the protocol was started.
+
+        @return: C{dict} with the C{"datagrams"}, C{"bytes"} and kernel
+            C{"drops"} counts, the C{"datagramsPerSecond"} and
+            C{"dropsPerSecond"} rates, and the C{"receiveBufferSize"}.
+            The drops are C{None} if they are not known.
+        """
+        now = self.clock()
+        drops = self.getKernelDrops()
+        result = {
+            "datagrams": self.datagramCount,
+            "bytes": self.byteCount,
+            "drops": drops,
+            "datagramsPerSecond": 0.0,
+            "dropsPerSecond": None,
+            "receiveBufferSize": self.getReceiveBufferSize(),
+            }
+        if self._lastStats is not None:
+            then, datagrams, lastDrops = self._lastStats
+            elapsed = now - then
+            if elapsed > 0:
+                result["datagramsPerSecond"] = (self.datagramCount - datagrams) / elapsed
+                if drops is not None and lastDrops is not None:
+                    result["dropsPerSecond"] = (drops - lastDrops) / elapsed
+        self._lastStats = (now, self.datagramCount, drops)
+        return result
+
+    def datagramReceived(self, data, (host, port)):
+        self.datagramCount += 1
+        self.byteCount += len(data)
+        element = _decodeElement(data, self.receiver)
+        self.receiver.dispatch(element, (host, port))
+
+    def datagramsReceived(self, datagrams):
+        """
+        Called by a L{BatchDatagramPort} with all the datagrams received
+        at once. They are dispatched with L{Receiver.dispatchMany}.
+
+        A datagram which cannot be decoded is logged and skipped. An
+        exception raised by a callback is logged, and the next datagrams
+        are still dispatched.
+
+        @param datagrams: C{list} of C{(data, (host, port))} tuples.
+        """
+        receiver = self.receiver
+        self.datagramCount += len(datagrams)
+        self.byteCount += sum([len(data) for data, address in datagrams])
+        elements = []
+        for data, address in datagrams:
+            try:
+                elements.append((_decodeElement(data, receiver), address))
+            except Exception:
+                log.err()
+        receiver.dispatchMany(elements, log.err)
+
+class MulticastDatagramServerProtocol(DatagramServerProtocol):
+    """
+    UDP OSC server protocol that can listen to multicast.
+    
+    Here is an example on how to use it:
+    
+      reactor.listenMulticast(8005, MulticastServerUDP(receiver, "224.0.0.1"), listenMultiple=True)
+    
+    This way, many listeners can listen on the same port, same host, to the same multicast group. (in this case, the 224.0.0.1 multicast group)
+    """
+    def __init__(self, receiver, multicast_addr="224.0.0.1", receiveBufferSize=None):
+        """
+        @param multicast_addr: IP address of the multicast group.
+        @param receiver: L{txosc.dispatch.Receiver} instance.
+        @param receiveBufferSize: The C{SO_RCVBUF} size, in bytes.
+        @type multicast_addr: str
+        @type receiver: L{txosc.dispatch.Receiver}
+        """
+        self.multicast_addr = multicast_addr
+        DatagramServerProtocol.__init__(self, receiver, receiveBufferSize)
+        
+    def startProtocol(self):
+        """
+        Join a specific multicast group, which is the IP we will respond to
+        """
+        DatagramServerProtocol.startProtocol(self)
+        self.transport.joinGroup(self.multicast_addr)
+
+class BatchDatagramPort(udp.Port):
+    """
+    A UDP port which receives up to C{batchSize} datagrams each time its
+    socket is readable, with a single recvmmsg system call.
+
+    The datagrams are passed to the C{datagramsReceived} method of the
+    protocol if it has one, such as L{DatagramServerProtocol}, or else to
+    its C{datagramReceived} method, one by one. Use L{listenUDPBatched}
+    to create it.
+
+    @ivar batchSize: The most datagrams received per system call.
+    @type batchSize: C{int}
+    @ivar reusePort: Whether the C{SO_REUSEPORT} option is set on the
+        socket, so that many processes can bind the same port. The kernel
+        then spreads the datagrams between them, by hashing their source
+        and destination addresses.
+    @type reusePort: C{bool}
+    """
+
+    def __init__(self, port, proto, interface='', maxPacketSize=8192, reactor=None, batchSize=mmsg.DEFAULT_BATCH_SIZE, reusePort=False):
+        udp.Port.__init__(self, port, proto, interface, maxPacketSize, reactor)
+        self.batchSize = batchSize
+        self.reusePort = reusePort
+        self._batch = mmsg.RecvBatch(batchSize, maxPacketSize)
+
+
+    def getKernelDrops(self):
+        """
+        Returns the number of datagrams dropped by the kernel, as reported
+        in the ancillary data, or C{None}.
+        """
+        return self._batch.drops
+
+
+    def createInternetSocket(self):
+        s = udp.Port.createInternetSocket(self)
+        if self.reusePort:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return s
+
+
+    def doRead(self):
+        """
+        Called when the socket is readable.
+        """
+        try:
+            datagrams = self._batch.recv(self.socket)
+        except socket.error, e:
+            if e.args[0] == errno.ECONNREFUSED and self._connectedAddr:
+                self.protocol.connectionRefused()
+                return
+            raise
+        if not datagrams:
+            return
+        try:
+            batchReceived = getattr(self.protocol, "datagramsReceived", None)
+            if batchReceived is not None:
+                batchReceived(datagrams)
+            else:
+                for data, address in datagrams:
+                    self.protocol.datagramReceived(data, address)
+        except:
+            log.err()
+
+
+
+def listenUDPBatched(port, protocol, interface='', maxPacketSize=8192, batchSize=mmsg.DEFAULT_BATCH_SIZE, reactor=None, reusePort=False):
+    """
+    Listens to UDP with a L{BatchDatagramPort} where recvmmsg is available,
+    which is on Linux. Elsewhere, C{reactor.listenUDP} is used, unless
+    C{reusePort} is set.
+
+    Here is an example on how to use it::
+
+      listenUDPBatched(17779, DatagramServerProtocol(receiver))
+
+    @param protocol: A C{DatagramProtocol}.
+    @param reactor: The reactor to use. Defaults to the global reactor.
+    @param reusePort: Whether to set the C{SO_REUSEPORT} option. See
+        L{BatchDatagramPort}.
+    @return: The listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if not mmsg.HAVE_RECVMMSG and not reusePort:
+        return reactor.listenUDP(port, protocol, interface, maxPacketSize)
+    p = BatchDatagramPort(port, protocol, interface, maxPacketSize, reactor, batchSize, reusePort)
+    p.startListening()
+    return p
+
+
+
+class HostResolver(object):
+    """
+    Resolves host names into IP addresses without blocking, and caches them.
+
+    Literal IP addresses are returned as they are. Names are resolved
+    with C{reactor.resolve} and kept for C{ttl} seconds. Once expired, the
+    old address is still returned while it is resolved again. If that
+    fails, the old address is kept, and resolved again after a delay which
+    doubles with each consecutive failure.
+
+    @ivar ttl: How long a resolved address is kept, in seconds.
+    @type ttl: C{float}
+    @ivar retryDelay: The delay before resolving again an expired address
+        after a first failure, in seconds.
+    @ivar maxRetryDelay: The longest delay between failed attempts.
+    """
+    reactor = None
+    retryDelay = 1.0
+    maxRetryDelay = 60.0
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._cache = {}
+        self._waiting = {}
+        self._failures = {}
+
+
+    def getCachedAddress(self, host):
+        """
+        Returns the IP address of a host if it is known, without blocking.
+
+        If the cached address has expired, it is resolved again in the
+        background, unless it is already being resolved.
+
+        @type host: C{str}
+        @return: C{str} IP address, or C{None} if the host has not been
+            resolved yet.
+        """
+        if abstract.isIPAddress(host) or abstract.isIPv6Address(host):
+            return host
+        cached = self._cache.get(host)
+        if cached is None:
+            return None
+        address, expiry = cached
+        if expiry <= self._getReactor().seconds() and host not in self._waiting:
+            self.resolve(host).addErrback(lambda failure: None)
+        return address
+
+
+    def resolve(self, host):
+        """
+        Resolves a host name. Concurrent requests for the same host share a
+        single lookup, and fire in the order they were made.
+
+        @type host: C{str}
+        @return: A L{Deferred} which fires with the C{str} IP address.
+        """
+        d = defer.Deferred()
+        if host in self._waiting:
+            self._waiting[host].append(d)
+            return d
+        self._waiting[host] = [d]
+        lookup = self._getReactor().resolve(host)
+        lookup.addCallbacks(self._resolved, self._failed, callbackArgs=(host,), errbackArgs=(host,))
+        return d
+
+
+    def _resolved(self, address, host):
+        self._cache[host] = (address, self._getReactor().seconds() + self.ttl)
+        self._failures.pop(host, None)
+        for d in self._waiting.pop(host):
+            d.callback(address)
+
+
+    def _failed(self, failure, host):
+        if host in self._cache:
+            failures = self._failures.get(host, 0)
+            self._failures[host] = failures + 1
+            delay = min(self.retryDelay * 2 ** failures, self.maxRetryDelay)
+            address = self._cache[host][0]
+            self._cache[host] = (address, self._getReactor().seconds() + delay)
+        for d in self._waiting.pop(host):
+            d.errback(failure)
+
+
+    def _getReactor(self):
+        if self.reactor is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.reactor
+
+
+
+class DatagramClientProtocol(protocol.DatagramProtocol):
+    """
+    The UDP OSC client protocol.
+
+    Host names are resolved with a L{HostResolver}, so that sending never
+    blocks the reactor. The packets sent to a host that is being resolved
+    for the first time are queued until its address is known.
+
+    @ivar resolver: The L{HostResolver} instance.
+    """
+    resolver = None
+    _sendBatch = None
+
+    def send(self, element, (host, port)):
+        """
+        Send a L{txosc.osc.Message} or L{txosc.osc.Bundle} to the address specified.
+        @type element: L{txosc.osc.Message}
+        """
+        self.sendBinary(element.toBinary(), (host, port))
+
+
+    def sendBinary(self, data, (host, port)):
+        """
+        Send an already encoded OSC packet to the address specified.
+        @type data: C{str}
+        """
+        if self.resolver is None:
+            self.resolver = HostResolver()
+        address = self.resolver.getCachedAddress(host)
+        if address is not None:
+            self.transport.write(data, (address, port))
+            return
+        d = self.resolver.resolve(host)
+        d.addCallback(self._sendResolved, data, port)
+        d.addErrback(log.err, "Could not send an OSC packet to %s:%s" % (host, port))
+
+
+    def sendMany(self, elements, destinations):
+        """
+        Sends each element to each destination, with as few system calls
+        as possible. On Linux, the datagrams are sent with sendmmsg.
+
+        The packets for the destinations which are not resolved yet are
+        queued, like with L{sendBinary}, and counted as sent.
+
+        @param elements: C{list} of L{txosc.osc.Message},
+            L{txosc.osc.Bundle} or already encoded C{str}.
+        @param destinations: C{list} of (host, port) tuples, or a single one.
+        @return: The number of datagrams sent. It is lower than the number
+            of packets if the socket buffer is full: the datagrams which
+            follow the first one that could not be sent are dropped.
+        @rtype: C{int}
+        """
+        if self.resolver is None:
+            self.resolver = HostResolver()
+        if isinstance(destinations, tuple):
+            destinations = [destinations]
+        resolved = []
+        unresolved = []
+        for host, port in destinations:
+            address = self.resolver.getCachedAddress(host)
+            if address is None:
+                unresolved.append((host, port))
+            else:
+                resolved.append((address, port))
+        packets = mmsg.makePackets(elements, resolved)
+        sent = self._getSendBatch().send(self.transport.socket, packets)
+        if unresolved:
+            for data, destination in mmsg.makePackets(elements, unresolved):
+                self.sendBinary(data, destination)
+                sent += 1
+        return sent
+
+
+    def _sendResolved(self, address, data, port):
+        if self.transport is not None:
+            self.transport.write(data, (address, port))
+
+
+    def _getSendBatch(self):
+        if self._sendBatch is None:
+            self._sendBatch = mmsg.SendBatch()
+        return self._sendBatch
+
+
+
+class ConnectedDatagramClientProtocol(DatagramClientProtocol):
+    """
+    A UDP OSC client protocol which sends to a single destination.
+
+    The UDP socket is connected to the destination, so that the kernel
+    does not look up the route of each packet, and so that the ICMP
+    "port unreachable" errors are reported to L{connectionRefused}.
+    The packets sent before the destination is resolved are queued, up
+    to C{maxQueueSize} of them: the next ones are dropped. If the
+    destination cannot be resolved, the queue is discarded, and sending
+    raises an L{OscError}.
+
+    This protocol does not read from its socket. Otherwise, the epoll and
+    poll reactors would close it when an ICMP error is received. The
+    error is instead reported when the next packet is sent, and that
+    packet is dropped.
+
+    Here is an example on how to use it::
+
+      client = ConnectedDatagramClientProtocol(("localhost", 17779))
+      reactor.listenUDP(0, client)
+      client.send(osc.Message("/ping"))
+
+    @ivar host: The destination host name or IP address.
+    @ivar port: The destination port.
+    @ivar refusedCount: Number of ICMP errors received.
+    @ivar droppedCount: Number of packets dropped because the queue was full.
+    @ivar deferred: A L{Deferred} which fires once the socket is connected.
+    @ivar reactor: The reactor, or C{None} for the one of the port.
+    """
+    reactor = None
+
+    def __init__(self, (host, port), maxQueueSize=1024):
+        """
+        @param maxQueueSize: The most packets queued until the destination
+            is resolved.
+        """
+        self.host = host
+        self.port = port
+        self.maxQueueSize = maxQueueSize
+        self.refusedCount = 0
+        self.droppedCount = 0
+        self.deferred = defer.Deferred()
+        self._connected = False
+        self._failure = None
+        self._queue = []
+        self._refusedHandler = None
+
+
+    def startProtocol(self):
+        # The port only starts reading once this method has returned.
+        self._getReactor().callLater(0, self._resolve)
+
+
+    def _getReactor(self):
+        if self.reactor is not None:
+            return self.reactor
+        reactor = getattr(self.transport, "reactor", None)
+        if reactor is None:
+            from twisted.internet import reactor
+        return reactor
+
+
+    def _resolve(self):
+        if self.transport is None:
+            return
+        if self.resolver is None:
+            self.resolver = HostResolver()
+            self.resolver.reactor = self._getReactor()
+        d = self.resolver.resolve(self.host)
+        d.addCallbacks(self._connect, self._resolutionFailed)
+
+
+    def _resolutionFailed(self, failure):
+        self._failure = failure
+        self._queue = []
+        self.deferred.errback(failure)
+
+
+    def _checkResolved(self):
+        if self._failure is not None:
+            raise OscError("Could not resolve %s: %s" % (self.host, self._failure.getErrorMessage()))
+
+
+    def _connect(self, address):
+        if self.transport is None:
+            return
+        self.transport.connect(address, self.port)
+        self.transport.stopReading()
+        self._connected = True
+        queue = self._queue
+        self._queue = []
+        for data in queue:
+            self.transport.write(data)
+        self.deferred.callback(True)
+
+
+    def send(self, element, address=None):
+        """
+        Send a L{txosc.osc.Message} or L{txosc.osc.Bundle} to the destination.
+        @param address: If given, it must be the destination.
+        """
+        self.sendBinary(element.toBinary(), address)
+
+
+    def sendBinary(self, data, address=None):
+        """
+        Send an already encoded OSC packet to the destination.
+        @type data: C{str}
+        @param address: If given, it must be the destination.
+        """
+        if address is not None and tuple(address) != (self.host, self.port):
+            raise OscError("This protocol only sends to %s:%s." % (self.host, self.port))
+        if self._connected:
+            self.transport.write(data)
+            return
+        self._checkResolved()
+        if len(self._queue) >= self.maxQueueSize:
+            self.droppedCount += 1
+        else:
+            self._queue.append(data)
+
+
+    def sendMany(self, elements, destinations=None):
+        """
+        Sends many elements to the destination, with as few system calls
+        as possible. See L{DatagramClientProtocol.sendMany}.
+
+        @param destinations: If given, it must only contain the destination.
+        @return: The number of datagrams sent or queued. The packets
+            dropped because the queue is full are not counted.
+        @rtype: C{int}
+        """
+        if destinations is not None:
+            if isinstance(destinations, tuple):
+                destinations = [destinations]
+            for address in destinations:
+                if tuple(address) != (self.host, self.port):
+                    raise OscError("This protocol only sends to %s:%s." % (self.host, self.port))
+        packets = mmsg.makePackets(elements, None)
+        if not self._connected:
+            self._checkResolved()
+            room = max(self.maxQueueSize - len(self._queue), 0)
+            self._queue.extend([data for data, address in packets[:room]])
+            self.droppedCount += len(packets) - len(packets[:room])
+            return len(packets[:room])
+        try:
+            return self._getSendBatch().send(self.transport.socket, packets)
+        except socket.error, e:
+            if e.args[0] != errno.ECONNREFUSED:
+                raise
+            self.connectionRefused()
+            return 0
+
+
+    def setRefusedHandler(self, handler):
+        """
+        Sets a callable to call when the destination port is unreachable.
+        @param handler: Callable with no argument.
+        """
+        self._refusedHandler = handler
+
+
+    def connectionRefused(self):
+        """
+        Called when an ICMP "port unreachable" error is received for a
+        packet sent.
+        """
+        self.refusedCount += 1
+        if self._refusedHandler is not None:
+            self._refusedHandler()
+
+
+
+class DatagramBundler(object):
+    """
+    Packs the elements sent with a L{DatagramClientProtocol} into bundles.
+
+    The elements sent to the same destination within a small delay are
+    packed into L{txosc.osc.Bundle}s no larger than an MTU, so that fewer
+    datagrams are sent. The pending elements are sent when the MTU is
+    reached, after the delay, or when L{flush} is called.
+
+    Here is an example on how to use it::
+
+      client = DatagramClientProtocol()
+      reactor.listenUDP(0, client)
+      bundler = DatagramBundler(client)
+      bundler.send(osc.Message("/x", 1.0), ("127.0.0.1", 17779))
+      bundler.send(osc.Message("/y", 2.0), ("127.0.0.1", 17779))
+
+    @ivar client: The L{DatagramClientProtocol} which sends the datagrams.
+    @ivar delay: The longest time an element is kept before being sent, in seconds.
+    @ivar mtu: The largest datagram size, in bytes.
+    """
+    clock = None
+
+    def __init__(self, client, mtu=Bundler.DEFAULT_MTU, delay=0.001):
+        self.client = client
+        self.mtu = mtu
+        self.delay = delay
+        self._bundlers = {}
+        self._flushCall = None
+
+
+    def send(self, element, (host, port)):
+        """
+        Queues an element to send to the address specified.
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        """
+        self.sendAtomic([element], (host, port))
+
+
+    def sendAtomic(self, elements, (host, port)):
+        """
+        Queues elements to send to the address specified, in the same datagram.
+        @param elements: C{list} of L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        """
+        address = (host, port)
+        bundler = self._bundlers.get(address)
+        if bundler is None:
+            bundler = self._bundlers[address] = Bundler(self.mtu)
+        for packet in bundler.add(*elements):
+            self.client.sendBinary(packet, address)
+        if bundler.getPendingCount() and self._flushCall is None:
+            self._flushCall = self._getClock().callLater(self.delay, self.flush)
+
+
+    def flush(self):
+        """
+        Sends all the pending elements right away.
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        bundlers = self._bundlers
+        self._bundlers = {}
+        for address, bundler in bundlers.iteritems():
+            for packet in bundler.flush():
+                self.client.sendBinary(packet, address)
+
+
+    def _getClock(self):
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+
+
+class FanoutSender(object):
+    """
+    Sends the same OSC elements to many destinations.
+
+    Each element is encoded once, and the same binary data is written to
+    every destination. A destination is either a C{(host, port)} tuple,
+    to which the data is sent over UDP with the L{DatagramClientProtocol},
+    or a L{StreamBasedFactory}, such as a connected L{ClientFactory}.
+
+    Here is an example on how to use it::
+
+      client = DatagramClientProtocol()
+      reactor.listenUDP(0, client)
+      fanout = FanoutSender(client)
+      for i in range(40):
+          fanout.addDestination(("10.0.0.%d" % (i + 1), 17779))
+      fanout.send(osc.Message("/frame", 1))
+
+    @ivar client: The L{DatagramClientProtocol} for the UDP destinations.
+    """
+
+    def __init__(self, client=None):
+        self.client = client
+        self._destinations = {}
+
+
+    def addDestination(self, destination):
+        """
+        Adds a destination. Nothing happens if it is already there.
+        @param destination: A C{(host, port)} tuple or a L{StreamBasedFactory}.
+        """
+        if isinstance(destination, list):
+            destination = tuple(destination)
+        if isinstance(destination, tuple) and self.client is None:
+            raise OscError("A DatagramClientProtocol is needed to send over UDP.")
+        if destination not in self._destinations:
+            self._destinations[destination] = {"sent": 0, "errors": 0, "drops": 0}
+
+
+    def removeDestination(self, destination):
+        """
+        Removes a destination.
+        @raise KeyError: If there is no such destination.
+        """
+        if isinstance(destination, list):
+            destination = tuple(destination)
+        del self._destinations[destination]
+
+
+    def getDestinations(self):
+        """
+        Returns the current destinations.
+        @rtype: C{list}
+        """
+        return self._destinations.keys()
+
+
+    def send(self, element):
+        """
+        Sends an element to all the destinations.
+
+        Errors raised while sending to a destination are counted and
+        logged, and do not prevent sending to the others. A stream
+        destination that is not connected drops the element.
+
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        @return: The number of destinations it was sent to.
+        @rtype: C{int}
+        """
+        binary = element.toBinary()
+        sent = 0
+        for destination, stats in self._destinations.items():
+            try:
+                if isinstance(destination, tuple):
+                    self.client.sendBinary(binary, destination)
+                else:
+                    protocol = destination.connectedProtocol
+                    if protocol is None or protocol.transport is None or protocol.transport.disconnecting:
+                        stats["drops"] += 1
+                        continue
+                    protocol.sendBinary(binary)
+            except Exception:
+                stats["errors"] += 1
+                log.err(None, "Could not send an OSC packet to %s" % (destination,))
+            else:
+                stats["sent"] += 1
+                sent += 1
+        return sent
+
+
+    def getStats(self):
+        """
+        Returns the counters of each destination.
+
+        @return: C{dict} whose keys are the destinations, and values are
+            C{dict}s with the C{"sent"}, C{"errors"} and C{"drops"} counts.
+        """
+        return dict([(destination, dict(stats)) for destination, stats in self._destinations.iteritems()])
+
+
+
+#
+# Unix domain socket protocols
+#
+
+class UNIXDatagramServerProtocol(DatagramServerProtocol):
+    """
+    The OSC server protocol for Unix datagram sockets.
+
+    The client given to the callbacks is the path of the socket of the
+    sender, or C{None} if its socket is not bound. Use L{listenUNIXDatagram}
+    to create it.
+    """
+
+    def datagramReceived(self, data, address):
+        self.datagramCount += 1
+        self.byteCount += len(data)
+        element = _decodeElement(data, self.receiver)
+        self.receiver.dispatch(element, address)
+
+    def getKernelDrops(self):
+        """
+        Unix sockets do not drop datagrams: the senders block, or get an
+        C{EAGAIN} error, when the receive buffer is full.
+        @return: C{0}
+        """
+        return 0
+
+
+
+class UNIXDatagramClientProtocol(protocol.ConnectedDatagramProtocol):
+    """
+    The OSC client protocol for Unix datagram sockets, connected to a
+    single server. Use L{connectUNIXDatagram} to create it.
+    """
+
+    def send(self, element):
+        """
+        Send a L{txosc.osc.Message} or L{txosc.osc.Bundle} to the server.
+        """
+        self.transport.write(element.toBinary())
+
+
+    def sendBinary(self, data):
+        """
+        Send an already encoded OSC packet to the server.
+        @type data: C{str}
+        """
+        self.transport.write(data)
+
+
+
+def listenUNIXDatagram(path, receiver, maxPacketSize=8192, receiveBufferSize=None, reactor=None):
+    """
+    Listens to OSC over a Unix datagram socket.
+
+    Here is an example on how to use it::
+
+      listenUNIXDatagram("/tmp/synth.osc", receiver)
+      client = connectUNIXDatagram("/tmp/synth.osc")
+      client.send(osc.Message("/ping"))
+
+    @param path: The path of the socket.
+    @param receiver: L{txosc.dispatch.Receiver} instance.
+    @param reactor: The reactor to use. Defaults to the global reactor.
+    @return: The listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor.listenUNIXDatagram(path, UNIXDatagramServerProtocol(receiver, receiveBufferSize), maxPacketSize)
+
+
+def connectUNIXDatagram(path, bindAddress=None, reactor=None):
+    """
+    Connects a L{UNIXDatagramClientProtocol} to a Unix datagram socket.
+
+    @param path: The path of the socket of the server.
+    @param bindAddress: The path to bind the socket of the client to, so
+        that the server can reply, or C{None}.
+    @param reactor: The reactor to use. Defaults to the global reactor.
+    @rtype: L{UNIXDatagramClientProtocol}
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    client = UNIXDatagramClientProtocol()
+    reactor.connectUNIXDatagram(path, client, bindAddress=bindAddress)
+    return client
+
+
+def listenUNIX(path, receiver, framer=None, reactor=None):
+    """
+    Listens to OSC over a Unix stream socket, with a L{ServerFactory}.
+
+    @param path: The path of the socket.
+    @param receiver: L{txosc.dispatch.Receiver} instance.
+    @param framer: The framer class. See L{StreamBasedFactory}.
+    @param reactor: The reactor to use. Defaults to the global reactor.
+    @return: The listening port.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor.listenUNIX(path, ServerFactory(receiver, framer))
+
+
+def connectUNIX(path, receiver=None, framer=None, reactor=None):
+    """
+    Connects a L{ClientFactory} to a Unix stream socket.
+
+    Here is an example on how to use it::
+
+      client = connectUNIX("/tmp/synth.osc")
+      client.deferred.addCallback(lambda result: client.send(osc.Message("/ping")))
+
+    @param path: The path of the socket of the server.
+    @param receiver: L{txosc.dispatch.Receiver} instance for the replies.
+    @param framer: The framer class. See L{StreamBasedFactory}.
+    @param reactor: The reactor to use. Defaults to the global reactor.
+    @return: The L{ClientFactory}, whose C{deferred} fires once connected.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    factory = ClientFactory(receiver, framer)
+    reactor.connectUNIX(path, factory)
+    return factory
+
+
+#
+# Shared memory ring buffer receiver
+#
+
+class RingReceiver(abstract.FileDescriptor):
+    """
+    Dispatches the OSC packets written to a L{txosc.shm} ring buffer.
+
+    The ring is read when the writer wakes the reader up with its FIFO,
+    and every C{pollInterval} seconds in case a wakeup was missed. Without
+    wakeups, it is only polled. The client given to the callbacks is
+    C{None}.
+
+    Here is an example on how to use it::
+
+      shm.createRing("/dev/shm/synth.osc")
+      ring = RingReceiver("/dev/shm/synth.osc", receiver)
+      ring.startReading()
+
+    @ivar reader: The L{txosc.shm.RingReader}.
+    @ivar receiver: The L{Receiver} instance to dispatch received
+        elements to.
+    @ivar packetCount: Number of packets received.
+    @ivar byteCount: Number of bytes received.
+    """
+
+    def __init__(self, path, receiver, pollInterval=0.01, wakeup=True, reactor=None):
+        """
+        @param path: The path of the file of the ring buffer.
+        @param receiver: L{Receiver} instance.
+        @param pollInterval: The interval between the polls, in seconds.
+        @param wakeup: Whether the writer should wake the reader up.
+        @param reactor: The reactor to use. Defaults to the global reactor.
+        """
+        abstract.FileDescriptor.__init__(self, reactor)
+        self.reader = shm.RingReader(path)
+        self.receiver = receiver
+        self.pollInterval = pollInterval
+        self.wakeup = wakeup
+        self.packetCount = 0
+        self.byteCount = 0
+        self._poll = task.LoopingCall(self.readRing)
+        self._poll.clock = self.reactor
+
+    def fileno(self):
+        return self.reader.wakeupFileno
+
+    def startReading(self):
+        """
+        Starts reading the ring buffer.
+        """
+        if self.wakeup:
+            self.reader.setWaiting(True)
+            abstract.FileDescriptor.startReading(self)
+        if not self._poll.running:
+            self._poll.start(self.pollInterval)
+
+    def stopReading(self):
+        """
+        Stops reading the ring buffer.
+        """
+        self.reader.setWaiting(False)
+        abstract.FileDescriptor.stopReading(self)
+        if self._poll.running:
+            self._poll.stop()
+
+    def doRead(self):
+        self.reader.clearWakeup()
+        self.readRing()
+
+    def connectionLost(self, reason):
+        """
+        Stops waiting for wakeups if the FIFO fails, but keeps polling the
+        ring buffer.
+        """
+        log.msg("Stopped waiting for wakeups of %s: %s" % (self.reader.path, reason.getErrorMessage()))
+        self.reader.setWaiting(False)
+        abstract.FileDescriptor.stopReading(self)
+
+    def readRing(self):
+        """
+        Dispatches the packets written to the ring buffer.
+
+        A packet which cannot be decoded is logged and skipped. An
+        exception raised by a callback is logged, and the next packets are
+        still dispatched, since they are already freed from the ring.
+        """
+        receiver = self.receiver
+        for data in self.reader.read():
+            self.packetCount += 1
+            self.byteCount += len(data)
+            try:
+                element = _decodeElement(data, receiver)
+            except Exception:
+                log.err()
+                continue
+            try:
+                receiver.dispatch(element, None)
+            except Exception:
+                log.err()
+
+    def getStats(self):
+        """
+        Returns the reception statistics.
+
+        @return: C{dict} with the C{"packets"} and C{"bytes"} counts, the
+            C{"drops"} count of the writer, and the C{"pending"} bytes.
+        """
+        return {
+            "packets": self.packetCount,
+            "bytes": self.byteCount,
+            "drops": self.reader.getDropped(),
+            "pending": self.reader.getPendingSize(),
+            }
+
+    def close(self):
+        """
+        Stops reading and unmaps the ring buffer.
+        """
+        self.stopReading()
+        self.reader.close()
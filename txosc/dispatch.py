@@ -10,8 +10,28 @@ import string
 import math
 import struct
 import re
+import threading
 from txosc.osc import *
 
+
+def _locked(method):
+    """
+    Makes a method of an L{AddressNode} hold the lock of its tree, if it
+    has one. See L{AddressNode.setThreadSafe}.
+    """
+    def lockedMethod(self, *args, **kwargs):
+        lock = self._getLock()
+        if lock is None:
+            return method(self, *args, **kwargs)
+        lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release()
+    lockedMethod.__name__ = method.__name__
+    lockedMethod.__doc__ = method.__doc__
+    return lockedMethod
+
 class AddressNode(object):
     """
     A node in the tree of OSC addresses.
@@ -22,7 +42,15 @@ class AddressNode(object):
 
     @ivar _name: the name of this node. 
     @ivar _parent: the parent node.
+    @ivar _callbacks: C{dict} of the callbacks of this node, indexed by
+        their type tags signature. Callbacks accepting any type tags
+        are stored under the C{None} key.
+    @ivar _lock: The lock of the tree, on its root node, or C{None}.
+    @ivar _snapshot: The current L{_Snapshot} of the tree, on its root
+        node, or C{None}.
     """
+    _lock = None
+    _snapshot = None
 
     def __init__(self, name=None, parent=None):
         """
@@ -32,17 +60,19 @@ class AddressNode(object):
         self._name = name
         self._parent = parent
         self._childNodes = {}
-        self._callbacks = set()
+        self._callbacks = {}
         self._parent = None
         self._wildcardNodes = set()
 
 
+    @_locked
     def removeCallbacks(self):
         """
         Remove all callbacks from this node.
         """
-        self._callbacks = set()
+        self._callbacks = {}
         self._checkRemove()
+        self._publish()
 
 
     def setName(self, newname):
@@ -90,6 +120,7 @@ class AddressNode(object):
         self._parent._checkRemove()
 
 
+    @_locked
     def addNode(self, name, instance):
         """
         Add a child node.
@@ -99,6 +130,11 @@ class AddressNode(object):
         #FIXME: We should document the name. 
         # Is it /foo or foo?
         # Does it redirect all messages prefixed with "/foo" to the child?
+        self._addNode(name, instance)
+        self._publish([name])
+
+
+    def _addNode(self, name, instance):
         instance.setName(name)
         instance.setParent(self)
 
@@ -110,6 +146,101 @@ class AddressNode(object):
         return self._name
 
 
+    def setThreadSafe(self, enabled=True):
+        """
+        Makes the tree of this node safe to use from many threads.
+
+        The callbacks can then be added and removed while other threads
+        dispatch messages. The tree is protected by a lock, which is held
+        while the callbacks are looked up, but not while they are called.
+        The nodes added below this one use the same lock.
+
+        @type enabled: C{bool}
+        """
+        root = self._getRoot()
+        if enabled:
+            if root._lock is None:
+                root._lock = threading.Lock()
+        else:
+            root._snapshot = None
+            root._lock = None
+
+
+    def setCopyOnWrite(self, enabled=True):
+        """
+        Makes the callbacks of the tree of this node be looked up without
+        locking.
+
+        The tree is then made thread-safe, and an immutable copy of it is
+        kept. The callbacks are looked up in the current copy, without
+        holding the lock, while the changes are made with the lock held. A
+        change publishes a new copy, in which only the nodes on the path
+        to the changed node are copied: the other ones are shared with the
+        previous copy. Callbacks can therefore be added and removed from
+        other threads, or from callbacks, without slowing down dispatching.
+
+        The nodes must be renamed and reparented with L{addNode} only.
+
+        @type enabled: C{bool}
+        """
+        root = self._getRoot()
+        if enabled:
+            root.setThreadSafe()
+            lock = root._lock
+            lock.acquire()
+            try:
+                root._snapshot = _Snapshot.fromNode(root)
+            finally:
+                lock.release()
+        else:
+            root._snapshot = None
+
+
+    def _getRoot(self):
+        node = self
+        while node._parent is not None:
+            node = node._parent
+        return node
+
+
+    def _getLock(self):
+        return self._getRoot()._lock
+
+
+    def _getSnapshot(self):
+        """
+        Returns the snapshot of this node in the current copy of its tree,
+        or C{None} if there is none.
+        """
+        node = self
+        names = []
+        while node._parent is not None:
+            names.append(node._name)
+            node = node._parent
+        snapshot = node._snapshot
+        while names and snapshot is not None:
+            snapshot = snapshot.children.get(names.pop())
+        return snapshot
+
+
+    def _publish(self, path=()):
+        """
+        Publishes a new copy of the tree, if it is copy-on-write, after
+        the nodes on a path from this node have changed.
+
+        @param path: C{list} of the names of the changed nodes, below
+            this one.
+        """
+        node = self
+        names = list(reversed(path))
+        while node._parent is not None:
+            names.append(node._name)
+            node = node._parent
+        if node._snapshot is not None:
+            names.reverse()
+            node._snapshot = node._snapshot.update(node, names)
+
+
     def match(self, pattern):
         """
         Match a pattern to return a set of nodes.
@@ -117,7 +248,13 @@ class AddressNode(object):
         @param pattern: A C{str} with an address pattern.
         @return a C{set()} of matched AddressNode instances.
         """
+        snapshot = self._getSnapshot()
+        if snapshot is not None:
+            return set([s.node for s in snapshot.match(self._patternPath(pattern))])
+        return self._lockedMatch(pattern)
+
 
+    def _match(self, pattern):
         path = self._patternPath(pattern)
         if not len(path):
             return set([self])
@@ -141,36 +278,51 @@ class AddressNode(object):
 
         if not matchedNodes:
             return matchedNodes
-        return reduce(lambda a, b: a.union(b), [n.match(path[1:]) for n in matchedNodes])
+        return reduce(lambda a, b: a.union(b), [n._match(path[1:]) for n in matchedNodes])
 
+    _lockedMatch = _locked(_match)
 
-    def addCallback(self, pattern, cb):
+
+    @_locked
+    def addCallback(self, pattern, cb, typetags=None):
         """
         Adds a callback for L{txosc.osc.Message} instances received for a given OSC path, relative to this node's address as its root. 
 
         In the OSC protocol, only leaf nodes can have callbacks, though this implementation allows also branch nodes to have callbacks.
 
+        When a type tags signature is given, the callback is only called
+        for messages whose type tags are exactly the same. Otherwise, it is
+        called for any message matching the address.
+
         @param path: OSC address in the form C{/egg/spam/ham}, or list C{['egg', 'spam', 'ham']}.
         @type pattern: C{str} or C{list}.
         @param cb: Callback that will receive L{Message} as an argument when received.
         @type cb: Function or method.
+        @param typetags: Type tags signature, e.g. C{"fff"}, or C{None} to accept any type tags.
+        @type typetags: C{str}
         @return: None
         """
+        self._addCallback(pattern, cb, typetags)
+        self._publish(self._patternPath(pattern))
+
+
+    def _addCallback(self, pattern, cb, typetags):
         path = self._patternPath(pattern)
         if not len(path):
-            self._callbacks.add(cb)
+            self._callbacks.setdefault(typetags, set()).add(cb)
         else:
             part = path[0]
             if part not in self._childNodes:
                 if not AddressNode.isValidAddressPart(part):
                     raise ValueError("Invalid address part: '%s'" % part)
-                self.addNode(part, AddressNode())
+                self._addNode(part, AddressNode())
                 if AddressNode.isWildcard(part):
                     self._wildcardNodes.add(part)
-            self._childNodes[part].addCallback(path[1:], cb)
+            self._childNodes[part]._addCallback(path[1:], cb, typetags)
 
 
-    def removeCallback(self, pattern, cb):
+    @_locked
+    def removeCallback(self, pattern, cb, typetags=None):
         """
         Removes a callback for L{Message} instances received for a given OSC path.
 
@@ -178,15 +330,26 @@ class AddressNode(object):
         @type pattern: C{str} or C{list}.
         @param cb: Callback that will receive L{txosc.osc.Message} as an argument when received.
         @type cb: A callable object.
+        @param typetags: The type tags signature the callback was added with.
+        @type typetags: C{str}
         """
+        self._removeCallback(pattern, cb, typetags)
+        self._publish(self._patternPath(pattern))
+
+
+    def _removeCallback(self, pattern, cb, typetags):
         path = self._patternPath(pattern)
         if not len(path):
-            self._callbacks.remove(cb)
+            if typetags not in self._callbacks:
+                raise KeyError("No callback for type tags: " + repr(typetags))
+            self._callbacks[typetags].remove(cb)
+            if not self._callbacks[typetags]:
+                del self._callbacks[typetags]
         else:
             part = path[0]
             if part not in self._childNodes:
                 raise KeyError("No such address part: " + part)
-            self._childNodes[part].removeCallback(path[1:], cb)
+            self._childNodes[part]._removeCallback(path[1:], cb, typetags)
             if not self._childNodes[part]._callbacks and not self._childNodes[part]._childNodes:
                 # remove child
                 if part in self._wildcardNodes:
@@ -264,35 +427,186 @@ class AddressNode(object):
         """
         raise NotImplementedError("Implement removeCallbacks")
 
+    @_locked
     def removeAllCallbacks(self):
         """
         Remove all callbacks from this node.
         """
         self._childNodes = {}
         self._wildcardNodes = set()
-        self._callbacks = set()
+        self._callbacks = {}
         self._checkRemove()
+        self._publish()
 
 
     def matchCallbacks(self, message):
         """
-        Get all callbacks for a given message
+        Get all callbacks for a given message, whose signature matches
+        its type tags.
         """
         pattern = message.address
-        return self.getCallbacks(pattern)
+        return self.getCallbacks(pattern, message.getTypeTags())
 
 
-    def getCallbacks(self, pattern):
+    def getCallbacks(self, pattern, typetags=None):
         """
         Retrieve all callbacks which are bound to given
         pattern. Returns a set() of callables.
+
+        @param typetags: If given, only the callbacks whose signature
+            is these type tags, or which accept any type tags, are returned.
+        @type typetags: C{str}
         @return: L{set} of callbables.
         """
+        snapshot = self._getSnapshot()
+        if snapshot is not None:
+            return snapshot.getCallbacks(self._patternPath(pattern), typetags)
+        return self._getCallbacks(pattern, typetags)
+
+
+    @_locked
+    def _getCallbacks(self, pattern, typetags):
         path = self._patternPath(pattern)
-        nodes = self.match(path)
-        if not nodes:
-            return nodes
-        return reduce(lambda a, b: a.union(b), [n._callbacks for n in nodes])
+        nodes = self._match(path)
+        callbacks = set()
+        for n in nodes:
+            callbacks.update(n._getCallbacksForTypeTags(typetags))
+        return callbacks
+
+
+    def _getCallbacksForTypeTags(self, typetags):
+        """
+        Returns the callbacks of this node only, for a type tags signature.
+
+        @param typetags: Type tags string, or C{None} for all the callbacks.
+        @rtype: C{set}
+        """
+        if typetags is None:
+            callbacks = set()
+            for cbs in self._callbacks.itervalues():
+                callbacks.update(cbs)
+            return callbacks
+        callbacks = self._callbacks.get(None, set())
+        if typetags in self._callbacks:
+            callbacks = callbacks.union(self._callbacks[typetags])
+        return callbacks
+
+
+
+class _Snapshot(object):
+    """
+    An immutable copy of an L{AddressNode} and of its children, in which
+    the callbacks are looked up without locking. It is never changed once
+    published: a new one is made instead. See
+    L{AddressNode.setCopyOnWrite}.
+
+    @ivar node: The L{AddressNode} this is a copy of.
+    @ivar callbacks: C{dict} of C{frozenset}s of callbacks, by type tags.
+    @ivar children: C{dict} of the snapshots of the child nodes, by name.
+    @ivar wildcards: C{frozenset} of the names of the children which are
+        wildcards.
+    """
+    __slots__ = ["node", "callbacks", "children", "wildcards"]
+
+    def __init__(self, node, callbacks, children, wildcards):
+        self.node = node
+        self.callbacks = callbacks
+        self.children = children
+        self.wildcards = wildcards
+
+
+    @staticmethod
+    def fromNode(node):
+        """
+        Copies a node and all its children.
+        @type node: L{AddressNode}
+        @rtype: L{_Snapshot}
+        """
+        children = {}
+        for name, child in node._childNodes.iteritems():
+            children[name] = _Snapshot.fromNode(child)
+        return _Snapshot._copy(node, children)
+
+
+    @staticmethod
+    def _copy(node, children):
+        callbacks = {}
+        for typetags, cbs in node._callbacks.iteritems():
+            callbacks[typetags] = frozenset(cbs)
+        return _Snapshot(node, callbacks, children, frozenset(node._wildcardNodes))
+
+
+    def update(self, node, path):
+        """
+        Returns a copy in which the nodes on a path are copied again from
+        the tree. The snapshots of the other children are reused, as long
+        as their nodes have not been replaced.
+
+        @param node: The L{AddressNode} this is a copy of.
+        @param path: C{list} of the names of the changed nodes.
+        @rtype: L{_Snapshot}
+        """
+        children = {}
+        name = None
+        if path:
+            name = path[0]
+        for childName, child in node._childNodes.iteritems():
+            previous = self.children.get(childName)
+            if previous is None or previous.node is not child:
+                children[childName] = _Snapshot.fromNode(child)
+            elif childName == name:
+                children[childName] = previous.update(child, path[1:])
+            else:
+                children[childName] = previous
+        return _Snapshot._copy(node, children)
+
+
+    def match(self, path):
+        """
+        Returns the snapshots matching a pattern, like L{AddressNode.match}.
+
+        @param path: C{list} of the parts of the pattern.
+        @rtype: C{set}
+        """
+        if not path:
+            return set([self])
+        part = path[0]
+        children = self.children
+        matched = set()
+        if AddressNode.isWildcard(part):
+            for name in children:
+                if AddressNode.matchesWildcard(name, part):
+                    matched.add(children[name])
+        elif self.wildcards:
+            for name in self.wildcards:
+                if AddressNode.matchesWildcard(part, name):
+                    matched.add(children[name])
+                    break
+        if part in children:
+            matched.add(children[part])
+        result = set()
+        for child in matched:
+            result.update(child.match(path[1:]))
+        return result
+
+
+    def getCallbacks(self, path, typetags):
+        """
+        Returns the callbacks matching a pattern, like
+        L{AddressNode.getCallbacks}.
+
+        @param path: C{list} of the parts of the pattern.
+        @rtype: C{set}
+        """
+        callbacks = set()
+        for snapshot in self.match(path):
+            if typetags is None:
+                for cbs in snapshot.callbacks.itervalues():
+                    callbacks.update(cbs)
+            else:
+                callbacks.update(snapshot.callbacks.get(None, ()))
+                callbacks.update(snapshot.callbacks.get(typetags, ()))
+        return callbacks
 
 
 
@@ -303,35 +617,136 @@ class Receiver(AddressNode):
     registered callbacks.
 
     Callbacks are stored in a tree-like structure, using L{AddressNode} objects.
+
+    @ivar profiler: A L{txosc.stats.Profiler} which records the time spent
+        dispatching the messages, or C{None}.
     """
+    profiler = None
 
     def dispatch(self, element, client):
         """
         Dispatch an element to all matching callbacks.
 
-        Executes every callback matching the message address with
-        element as argument. The order in which the callbacks are
-        called is undefined.
+        Executes every callback matching the message address and type tags
+        with element as argument. The order in which the callbacks are
+        called is undefined. The fallback is called when no callback matches.
 
         @param element: A L{Message} or L{Bundle}.  
-        @param client: Either a (host, port) tuple with the originator's address, or an instance of L{StreamBasedFactory} whose C{send()} method can be used to send a message back.
+        @param client: Either a (host, port) tuple with the originator's address, or an instance of L{StreamBasedFactory} or L{StreamBasedProtocol} whose C{send()} method can be used to send a message back.
         """
         if isinstance(element, Bundle):
             messages = element.getMessages()
         else:
             messages = [element]
+        if self.profiler is not None:
+            for m in messages:
+                self._profiledDispatch(m, client)
+            return
         for m in messages:
             matched = False
-            for c in self.getCallbacks(m.address):
+            for c in self.getCallbacks(m.address, m.getTypeTags()):
                 c(m, client)
                 matched = True
             if not matched:
                 self.fallback(m, client)
 
+    def dispatchMany(self, elements, onError=None):
+        """
+        Dispatch a batch of elements, such as the datagrams received by a
+        L{txosc.async.BatchDatagramPort}.
+
+        The callbacks matching an address and type tags are only looked
+        up once per batch. Therefore, callbacks added or removed while the
+        batch is dispatched are only taken into account for the next one.
+
+        @param elements: C{list} of C{(element, client)} tuples. See L{dispatch}.
+        @param onError: A callable called without argument, from the
+            C{except} block, when a callback raises while an element is
+            dispatched. The next elements are then still dispatched. If
+            C{None}, the exception is raised, and the next elements are
+            not dispatched.
+        """
+        if self.profiler is not None:
+            for element, client in elements:
+                if onError is None:
+                    self.dispatch(element, client)
+                    continue
+                try:
+                    self.dispatch(element, client)
+                except Exception:
+                    onError()
+            return
+        matches = {}
+        for element, client in elements:
+            if onError is None:
+                self._dispatchMatched(element, client, matches)
+                continue
+            try:
+                self._dispatchMatched(element, client, matches)
+            except Exception:
+                onError()
+
+    def _dispatchMatched(self, element, client, matches):
+        """
+        Dispatches an element of a batch.
+
+        @param matches: C{dict} of the callbacks already looked up in the
+            batch, by address and type tags.
+        """
+        if isinstance(element, Bundle):
+            messages = element.getMessages()
+        else:
+            messages = [element]
+        for m in messages:
+            key = (m.address, m.getTypeTags())
+            callbacks = matches.get(key)
+            if callbacks is None:
+                callbacks = matches[key] = self.getCallbacks(*key)
+            for c in callbacks:
+                c(m, client)
+            if not callbacks:
+                self.fallback(m, client)
+
+    def _profiledDispatch(self, message, client):
+        """
+        Dispatches a single message, recording its statistics in the profiler.
+        """
+        profiler = self.profiler
+        profiler.countMessage(message.address)
+        if not profiler.shouldSample():
+            callbacks = self.getCallbacks(message.address, message.getTypeTags())
+            for c in callbacks:
+                c(message, client)
+            if not callbacks:
+                self.fallback(message, client)
+            return
+        clock = profiler.clock
+        start = clock()
+        callbacks = self.getCallbacks(message.address, message.getTypeTags())
+        profiler.matchTime.record(clock() - start)
+        for c in callbacks:
+            before = clock()
+            c(message, client)
+            profiler.recordCallback(c, clock() - before)
+        if not callbacks:
+            self.fallback(message, client)
+        profiler.dispatchTime.record(clock() - start)
+
+
+    def setProfiler(self, profiler):
+        """
+        Sets the profiler which records the dispatching statistics.
+        @param profiler: L{txosc.stats.Profiler} instance, or C{None} to disable profiling.
+        """
+        self.profiler = profiler
+
     #TODO: add a addFallback or setFallback method
     def fallback(self, message, client):
         """
         The default fallback handler.
+
+        It logs every unhandled message. Use a L{txosc.stats.FallbackCounter}
+        instead when many unhandled messages are expected.
         """
         from twisted.python import log
         log.msg("Unhandled message from %s): %s" % (repr(client), str(message)))
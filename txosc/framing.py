@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_framing -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Framing of OSC packets over stream-based transports
+
+A stream transport such as TCP does not preserve the boundaries of the
+packets that are written to it. The framers of this module encode
+packets into a stream, and split a stream back into packets.
+
+Twisted is not used in this file.
+"""
+import struct
+from txosc.osc import OscError
+
+DEFAULT_MAX_FRAME_SIZE = 1 << 20 # 1 MiB
+
+_lengthPrefix = struct.Struct(">i")
+
+
+class LengthPrefixedFramer(object):
+    """
+    The OSC 1.0 stream framing.
+
+    Each packet is preceded by an int32 giving its size.
+
+    Received data is appended to a C{bytearray} and parsed from an offset,
+    so that each byte is copied a constant number of times, however many
+    packets a single chunk of data contains. The consumed bytes are only
+    removed from the buffer once they make up most of it.
+
+    @ivar maxFrameSize: The largest packet size accepted, in bytes.
+    @type maxFrameSize: C{int}
+    """
+    compactThreshold = 1 << 16
+
+    def __init__(self, maxFrameSize=DEFAULT_MAX_FRAME_SIZE):
+        self.maxFrameSize = maxFrameSize
+        self._buffer = bytearray()
+        self._offset = 0
+
+
+    def frame(self, binary):
+        """
+        Frames a packet.
+
+        @param binary: The binary representation of an OSC element.
+        @type binary: C{str}
+        @return: C{list} of C{str} to write to the stream, in this order.
+        """
+        return [_lengthPrefix.pack(len(binary)), binary]
+
+
+    def feed(self, data):
+        """
+        Appends some data from the stream and returns all the complete
+        packets it contains.
+
+        @param data: Data received from the stream.
+        @type data: C{str}
+        @return: C{list} of C{str} packets. It might be empty.
+        @raise OscError: If a packet is larger than C{maxFrameSize}, or
+            its size is negative.
+        """
+        buf = self._buffer
+        buf.extend(data)
+        offset = self._offset
+        end = len(buf)
+        frames = []
+        while end - offset >= 4:
+            size = _lengthPrefix.unpack_from(buf, offset)[0]
+            if size < 0 or size > self.maxFrameSize:
+                raise OscError("Invalid frame size: %d bytes" % (size))
+            if end - offset - 4 < size:
+                break
+            offset += 4
+            frames.append(str(buf[offset:offset + size]))
+            offset += size
+        if offset == end:
+            del buf[:]
+            offset = 0
+        elif offset > self.compactThreshold and offset * 2 > end:
+            del buf[:offset]
+            offset = 0
+        self._offset = offset
+        return frames
+
+
+    def getPendingSize(self):
+        """
+        Returns the number of bytes received that are not part of a
+        complete packet yet.
+        @rtype: C{int}
+        """
+        return len(self._buffer) - self._offset
+
+
+
+class SLIPFramer(object):
+    """
+    The OSC 1.1 stream framing, using double-ended SLIP (RFC 1055).
+
+    Each packet is escaped and enclosed between two END bytes. Inside a
+    packet, END is replaced by ESC ESC_END, and ESC by ESC ESC_ESC.
+
+    The END bytes and the escape sequences are found using the C{find}
+    and C{replace} methods of strings, and not with a loop over each byte.
+
+    @ivar maxFrameSize: The largest packet size accepted, in bytes, once
+        decoded.
+    @type maxFrameSize: C{int}
+    """
+    END = "\xc0"
+    ESC = "\xdb"
+    ESC_END = "\xdc"
+    ESC_ESC = "\xdd"
+
+    def __init__(self, maxFrameSize=DEFAULT_MAX_FRAME_SIZE):
+        self.maxFrameSize = maxFrameSize
+        self._buffer = bytearray()
+
+
+    def frame(self, binary):
+        """
+        Frames a packet.
+
+        @param binary: The binary representation of an OSC element.
+        @type binary: C{str}
+        @return: C{list} of C{str} to write to the stream, in this order.
+        """
+        if self.ESC in binary:
+            binary = binary.replace(self.ESC, self.ESC + self.ESC_ESC)
+        if self.END in binary:
+            binary = binary.replace(self.END, self.ESC + self.ESC_END)
+        return [self.END, binary, self.END]
+
+
+    def feed(self, data):
+        """
+        Appends some data from the stream and returns all the complete
+        packets it contains.
+
+        Empty packets, which result from two consecutive END bytes, are
+        ignored.
+
+        @param data: Data received from the stream.
+        @type data: C{str}
+        @return: C{list} of C{str} packets. It might be empty.
+        @raise OscError: If a packet is larger than C{maxFrameSize}.
+        """
+        buf = self._buffer
+        start = len(buf)
+        buf.extend(data)
+        frames = []
+        if buf.find(self.END, start) == -1:
+            self._checkPendingSize()
+            return frames
+        chunks = buf.split(self.END)
+        del buf[:]
+        buf.extend(chunks.pop())
+        for chunk in chunks:
+            if not chunk:
+                continue
+            packet = str(chunk)
+            if self.ESC in packet:
+                packet = packet.replace(self.ESC + self.ESC_END, self.END).replace(self.ESC + self.ESC_ESC, self.ESC)
+            if len(packet) > self.maxFrameSize:
+                raise OscError("Invalid frame size: %d bytes" % (len(packet)))
+            frames.append(packet)
+        self._checkPendingSize()
+        return frames
+
+
+    def _checkPendingSize(self):
+        # Each byte of a packet is at most escaped into two bytes.
+        if len(self._buffer) > 2 * self.maxFrameSize:
+            raise OscError("Invalid frame size: more than %d bytes" % (self.maxFrameSize))
+
+
+    def getPendingSize(self):
+        """
+        Returns the number of bytes received that are not part of a
+        complete packet yet.
+        @rtype: C{int}
+        """
+        return len(self._buffer)
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_mmsg -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Batched UDP I/O with the recvmmsg and sendmmsg system calls of Linux
+
+recvmmsg receives many datagrams with a single system call, and sendmmsg
+sends many. They are called through ctypes. Where they are not available,
+the datagrams are received with a loop of C{recvfrom} calls, and sent
+with a loop of C{sendto} calls.
+
+Stream data made of many strings is written with the writev system call,
+without joining them, by L{sendv}.
+
+Twisted is not used in this file.
+"""
+import errno
+import os
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_PACKET_SIZE = 8192
+
+_SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+_CONTROL_SIZE = 64
+_cmsghdr = struct.Struct("Lii")
+
+# Linux socket option which adds the number of datagrams dropped by the
+# kernel, for lack of room in the receive buffer, to the ancillary data.
+SO_RXQ_OVFL = 40
+# Its value depends on the system. Where it is missing, the sockets
+# must be non-blocking.
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+_wouldBlock = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+        ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+        ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr),
+        ("msg_len", ctypes.c_uint),
+        ]
+
+
+def _structFormat(structure, fieldFormats):
+    """
+    Returns the format of the struct module for a ctypes structure, with
+    the padding added by the C compiler.
+
+    @param fieldFormats: C{list} of the formats of the fields, in order.
+    @return: The format, or C{None} if the sizes of the fields do not
+        match the formats.
+    """
+    format = ""
+    offset = 0
+    for (name, fieldType), fieldFormat in zip(structure._fields_, fieldFormats):
+        field = getattr(structure, name)
+        if struct.calcsize(fieldFormat) != field.size:
+            return None
+        if field.offset > offset:
+            format += "%dx" % (field.offset - offset)
+        format += fieldFormat
+        offset = field.offset + field.size
+    size = ctypes.sizeof(structure)
+    if size > offset:
+        format += "%dx" % (size - offset)
+    if struct.calcsize(format) != size:
+        return None
+    return format
+
+# struct iovec and struct mmsghdr, packed with the struct module, which
+# is faster than filling ctypes structures field by field.
+_iovecFormat = _structFormat(_iovec, ["P", "L"])
+_msghdrFormat = _structFormat(_msghdr, ["P", "I", "P", "L", "P", "L", "i"])
+_mmsghdrFormat = None
+if _msghdrFormat is not None:
+    _mmsghdrFormat = _structFormat(_mmsghdr, [_msghdrFormat, "I"])
+
+
+def _loadLibc():
+    """
+    Returns the C library if it provides recvmmsg and sendmmsg, or C{None}.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return libc
+
+_libc = _loadLibc()
+HAVE_RECVMMSG = _libc is not None
+HAVE_SENDMMSG = _libc is not None and _iovecFormat is not None and _mmsghdrFormat is not None
+
+
+def _loadWritev():
+    """
+    Returns the writev function of the C library, or C{None}.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        writev = libc.writev
+    except (OSError, AttributeError):
+        return None
+    writev.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    writev.restype = ctypes.c_ssize_t
+    return writev
+
+_writev = _loadWritev()
+HAVE_WRITEV = _writev is not None and _iovecFormat is not None
+
+# The most strings written by a single writev call (IOV_MAX).
+MAX_IOV = 1024
+
+# The kernel does not send more messages per sendmmsg call (UIO_MAXIOV).
+_MAX_SEND_BATCH = 1024
+
+
+
+def _decodeAddress(name, size):
+    """
+    Converts a C{struct sockaddr} to a (host, port) tuple.
+
+    @param name: Pointer to the structure.
+    @param size: Size of the structure, in bytes.
+    """
+    raw = ctypes.string_at(name, size)
+    family = struct.unpack("=H", raw[:2])[0]
+    port = struct.unpack(">H", raw[2:4])[0]
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(socket.AF_INET, raw[4:8]), port)
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]), port)
+    return None
+
+
+def _encodeAddress(address):
+    """
+    Converts a (host, port) tuple, whose host is an IP address, to a
+    C{struct sockaddr}.
+    @rtype: C{str}
+    """
+    host, port = address[:2]
+    try:
+        packed = socket.inet_pton(socket.AF_INET, host)
+    except socket.error:
+        packed = socket.inet_pton(socket.AF_INET6, host)
+        return struct.pack("=H", socket.AF_INET6) + struct.pack(">HI", port, 0) + packed + struct.pack("=I", 0)
+    return struct.pack("=H", socket.AF_INET) + struct.pack(">H", port) + packed + "\0" * 8
+
+
+def makePackets(elements, destinations):
+    """
+    Returns the packets to send each element to each destination.
+
+    @param elements: C{list} of L{txosc.osc.Message}, L{txosc.osc.Bundle}
+        or already encoded C{str}. Each element is only encoded once.
+    @param destinations: C{list} of addresses, or a single address.
+    @return: C{list} of C{(data, address)} tuples, in the order of the
+        elements, then of the destinations.
+    """
+    if isinstance(destinations, tuple) or destinations is None:
+        destinations = [destinations]
+    packets = []
+    for element in elements:
+        if not isinstance(element, str):
+            element = element.toBinary()
+        for destination in destinations:
+            packets.append((element, destination))
+    return packets
+
+
+def _address(data):
+    """
+    Returns the address of the characters of a C{str}, which is not copied.
+    """
+    return ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+
+
+class SendBatch(object):
+    """
+    Sends many datagrams from a socket at once.
+
+    With sendmmsg, the message headers and the array of C{struct iovec}
+    are allocated when the object is created. The datagrams sent by a
+    call to L{send} are joined into a single string, which the iovecs
+    point to. The message headers are only rewritten when the
+    destinations differ from the previous call.
+
+    The datagrams are sent in order, and sending stops at the first one
+    that cannot be sent. It happens when a non-blocking socket would
+    block, or when an error occurs after some datagrams were sent: the
+    error is then raised by the next call.
+
+    @ivar batchSize: The most datagrams sent per system call, up to 1024.
+    @type batchSize: C{int}
+    """
+
+    def __init__(self, batchSize=DEFAULT_BATCH_SIZE, useSendmmsg=HAVE_SENDMMSG):
+        """
+        @param useSendmmsg: Whether to use sendmmsg. It must be available.
+        @type useSendmmsg: C{bool}
+        """
+        self.batchSize = min(batchSize, _MAX_SEND_BATCH)
+        self.useSendmmsg = useSendmmsg
+        if useSendmmsg:
+            self._iovecSize = struct.calcsize(_iovecFormat)
+            self._headerSize = struct.calcsize(_mmsghdrFormat)
+            self._iovecs = ctypes.create_string_buffer(self._iovecSize * self.batchSize)
+            self._headers = ctypes.create_string_buffer(self._headerSize * self.batchSize)
+            self._destinations = None
+            self._names = {}
+
+
+    def send(self, sock, packets):
+        """
+        Sends datagrams from a socket.
+
+        @param sock: A UDP C{socket.socket}.
+        @param packets: C{list} of C{(data, address)} tuples. The address
+            is a (host, port) tuple whose host is an IP address, or
+            C{None} if the socket is connected.
+        @return: The number of datagrams sent.
+        @rtype: C{int}
+        @raise socket.error: If no datagram could be sent, for the errors
+            other than C{EAGAIN}.
+        """
+        if not self.useSendmmsg:
+            return _sendLoop(sock, packets)
+        fileno = sock.fileno()
+        sent = 0
+        total = len(packets)
+        while sent < total:
+            chunk = packets[sent:sent + self.batchSize]
+            count = self._sendChunk(fileno, chunk)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in _wouldBlock or sent:
+                    break
+                raise socket.error(err, errno.errorcode.get(err, ""))
+            sent += count
+            if count < len(chunk):
+                break
+        return sent
+
+
+    def _sendChunk(self, fileno, chunk):
+        size = len(chunk)
+        datas = [data for data, address in chunk]
+        joined = "".join(datas)
+        offset = _address(joined)
+        iovecs = []
+        for data in datas:
+            length = len(data)
+            iovecs.append(offset)
+            iovecs.append(length)
+            offset += length
+        ctypes.memmove(self._iovecs, struct.pack(_iovecFormat * size, *iovecs), self._iovecSize * size)
+        destinations = [address for data, address in chunk]
+        if destinations != self._destinations:
+            self._writeHeaders(destinations)
+        return _libc.sendmmsg(fileno, self._headers, size, 0)
+
+
+    def _writeHeaders(self, destinations):
+        names = self._names
+        if len(names) > self.batchSize:
+            names.clear()
+        iovecs = ctypes.addressof(self._iovecs)
+        headers = []
+        for i, address in enumerate(destinations):
+            if address is None:
+                headers.extend((0, 0, iovecs + i * self._iovecSize, 1, 0, 0, 0, 0))
+                continue
+            name = names.get(address)
+            if name is None:
+                name = names[address] = _encodeAddress(address)
+            headers.extend((_address(name), len(name), iovecs + i * self._iovecSize, 1, 0, 0, 0, 0))
+        ctypes.memmove(self._headers, struct.pack(_mmsghdrFormat * len(destinations), *headers), self._headerSize * len(destinations))
+        self._destinations = destinations
+
+
+def _sendLoop(sock, packets):
+    """
+    Sends the datagrams with C{sendto}.
+    """
+    sent = 0
+    for data, address in packets:
+        try:
+            if address is None:
+                sock.send(data)
+            else:
+                sock.sendto(data, address)
+        except socket.error, e:
+            if e.args[0] in _wouldBlock or sent:
+                break
+            raise
+        sent += 1
+    return sent
+
+
+
+def sendv(sock, buffers, offset=0, useWritev=HAVE_WRITEV):
+    """
+    Writes strings to a stream socket with a single gather write, without
+    joining them. Like C{socket.send}, only the beginning of the data may
+    be written.
+
+    @param sock: A connected stream C{socket.socket}.
+    @param buffers: C{list} of at most L{MAX_IOV} C{str}.
+    @param offset: The number of bytes at the beginning of the first
+        string which are skipped, because they were already written.
+    @param useWritev: Whether to use writev. It must be available.
+        Otherwise, the strings are joined.
+    @return: The number of bytes written.
+    @rtype: C{int}
+    @raise socket.error: If the data cannot be written, with
+        C{errno.EAGAIN} if the socket would block.
+    """
+    if not useWritev:
+        return sock.send(buffer("".join(buffers), offset))
+    iovecs = []
+    for data in buffers:
+        iovecs.append(_address(data) + offset)
+        iovecs.append(len(data) - offset)
+        offset = 0
+    vector = struct.pack(_iovecFormat * len(buffers), *iovecs)
+    fileno = sock.fileno()
+    while True:
+        written = _writev(fileno, vector, len(buffers))
+        if written >= 0:
+            return written
+        err = ctypes.get_errno()
+        if err != errno.EINTR:
+            raise socket.error(err, os.strerror(err))
+
+
+
+def _parseDrops(control):
+    """
+    Returns the number of dropped datagrams found in the ancillary data of
+    a message, or C{None}.
+    @param control: The ancillary data.
+    @type control: C{str}
+    """
+    offset = 0
+    while offset + _cmsghdr.size <= len(control):
+        length, level, kind = _cmsghdr.unpack_from(control, offset)
+        if length < _cmsghdr.size:
+            break
+        if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+            return struct.unpack_from("I", control, offset + _cmsghdr.size)[0]
+        offset += (length + 7) & ~7
+    return None
+
+
+class RecvBatch(object):
+    """
+    Receives many datagrams from a socket at once.
+
+    With recvmmsg, the message headers, the address structures and the
+    data buffers are all allocated when the object is created, and reused
+    for each call to L{recv}.
+
+    @ivar batchSize: The most datagrams received by a call to L{recv}.
+    @type batchSize: C{int}
+    @ivar maxPacketSize: The size of each buffer. Longer datagrams are
+        truncated.
+    @type maxPacketSize: C{int}
+    @ivar drops: The number of datagrams dropped by the kernel, as last
+        reported in the ancillary data when the C{SO_RXQ_OVFL} option of
+        the socket is set. It is C{None} until reported.
+
+    On the systems without C{MSG_DONTWAIT}, the socket must be
+    non-blocking, as the ones of Twisted are.
+    """
+    drops = None
+
+    def __init__(self, batchSize=DEFAULT_BATCH_SIZE, maxPacketSize=DEFAULT_MAX_PACKET_SIZE, useRecvmmsg=HAVE_RECVMMSG):
+        """
+        @param useRecvmmsg: Whether to use recvmmsg. It must be available.
+        @type useRecvmmsg: C{bool}
+        """
+        self.batchSize = batchSize
+        self.maxPacketSize = maxPacketSize
+        self.useRecvmmsg = useRecvmmsg
+        if useRecvmmsg:
+            self._allocate()
+
+
+    def _allocate(self):
+        size = self.batchSize
+        self._buffers = [ctypes.create_string_buffer(self.maxPacketSize) for i in range(size)]
+        self._names = [ctypes.create_string_buffer(_SOCKADDR_SIZE) for i in range(size)]
+        self._controls = [ctypes.create_string_buffer(_CONTROL_SIZE) for i in range(size)]
+        self._iovecs = (_iovec * size)()
+        self._headers = (_mmsghdr * size)()
+        for i in range(size):
+            self._iovecs[i].iov_base = ctypes.addressof(self._buffers[i])
+            self._iovecs[i].iov_len = self.maxPacketSize
+            hdr = self._headers[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self._names[i])
+            hdr.msg_namelen = _SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+            hdr.msg_iovlen = 1
+            hdr.msg_control = ctypes.addressof(self._controls[i])
+            hdr.msg_controllen = _CONTROL_SIZE
+        # The number of headers whose lengths were changed by the kernel.
+        self._used = 0
+
+
+    def recv(self, sock):
+        """
+        Receives the datagrams which are waiting on a socket, without
+        blocking.
+
+        @param sock: A UDP C{socket.socket}.
+        @return: C{list} of C{(data, (host, port))} tuples. It is empty
+            if no datagram is waiting.
+        @raise socket.error: For the errors other than C{EAGAIN}.
+        """
+        if not self.useRecvmmsg:
+            return self._recvLoop(sock)
+        headers = self._headers
+        for i in range(self._used):
+            hdr = headers[i].msg_hdr
+            hdr.msg_namelen = _SOCKADDR_SIZE
+            hdr.msg_controllen = _CONTROL_SIZE
+        self._used = 0
+        count = _libc.recvmmsg(sock.fileno(), headers, self.batchSize, _MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in _wouldBlock:
+                return []
+            raise socket.error(err, errno.errorcode.get(err, ""))
+        self._used = count
+        datagrams = []
+        for i in range(count):
+            hdr = headers[i]
+            data = ctypes.string_at(self._iovecs[i].iov_base, hdr.msg_len)
+            address = _decodeAddress(hdr.msg_hdr.msg_name, hdr.msg_hdr.msg_namelen)
+            datagrams.append((data, address))
+        for i in range(count - 1, -1, -1):
+            hdr = headers[i].msg_hdr
+            if hdr.msg_controllen:
+                drops = _parseDrops(ctypes.string_at(hdr.msg_control, hdr.msg_controllen))
+                if drops is not None:
+                    self.drops = drops
+                    break
+        return datagrams
+
+
+    def _recvLoop(self, sock):
+        """
+        Receives the datagrams with C{recvfrom}.
+        """
+        datagrams = []
+        for i in xrange(self.batchSize):
+            try:
+                data, address = sock.recvfrom(self.maxPacketSize, _MSG_DONTWAIT)
+            except socket.error, e:
+                if e.args[0] in _wouldBlock:
+                    break
+                raise
+            datagrams.append((data, address[:2]))
+        return datagrams
@@ -46,31 +46,52 @@ class Message(object):
     @type address: C{str}
     @ivar arguments: The L{Argument} instances for the message.
     @type argument: C{list}
+    @ivar _typeTags: The type tags decoded by L{fromBinary}, or C{None}
+        once the arguments may have been changed.
     """
+    _typeTags = None
 
     def __init__(self, address, *args):
         self.address = address
-        self.arguments = []
+        self._arguments = []
         for arg in args:
             self.add(arg)
 
 
+    def _getArguments(self):
+        # the arguments may be changed by the caller
+        self._typeTags = None
+        return self._arguments
+
+
+    def _setArguments(self, arguments):
+        self._typeTags = None
+        self._arguments = arguments
+
+    arguments = property(_getArguments, _setArguments)
+
+
     def toBinary(self):
         """
         Encodes the L{Message} to binary form, ready to send over the wire.
 
         @return: A string with the binary presentation of this L{Message}.
         """
-        return StringArgument(self.address).toBinary() + StringArgument("," + self.getTypeTags()).toBinary() + "".join([a.toBinary() for a in self.arguments])
+        return StringArgument(self.address).toBinary() + StringArgument("," + self.getTypeTags()).toBinary() + "".join([a.toBinary() for a in self._arguments])
 
 
     def getTypeTags(self):
         """
         Return the OSC type tags for this message.
 
+        The type tags of a message decoded by L{fromBinary} are not
+        computed again, as long as its C{arguments} are not accessed.
+
         @return: A string with this message's OSC type tag, e.g. C{"ii"} when there are 2 int arguments.
         """
-        return "".join([a.typeTag for a in self.arguments])
+        if self._typeTags is not None:
+            return self._typeTags
+        return "".join([a.typeTag for a in self._arguments])
 
 
     def add(self, value):
@@ -82,7 +103,8 @@ class Message(object):
         """
         if not isinstance(value, Argument):
             value = createArgument(value)
-        self.arguments.append(value)
+        self._typeTags = None
+        self._arguments.append(value)
 
 
     @staticmethod
@@ -109,15 +131,16 @@ class Message(object):
 
         for type_tag in type_tags[1:]:
             arg, leftover = _argumentFromBinary(type_tag, leftover)
-            message.arguments.append(arg)
+            message._arguments.append(arg)
+        message._typeTags = type_tags[1:]
 
         return message, leftover
 
 
     def __str__(self):
         s = self.address
-        if self.arguments:
-            args = " ".join([str(a) for a in self.arguments])
+        if self._arguments:
+            args = " ".join([str(a) for a in self._arguments])
             s += " ,%s %s" % (self.getTypeTags(), args)
         return s
 
@@ -126,19 +149,19 @@ class Message(object):
         Returns a list of each argument's value.
         @rtype: C{list}
         """
-        return [arg.value for arg in self.arguments]
+        return [arg.value for arg in self._arguments]
 
     def __eq__(self, other):
         if not isinstance(other, type(self)):
             return False
         if self.address != other.address:
             return False
-        if len(self.arguments) != len(other.arguments):
+        if len(self._arguments) != len(other._arguments):
             return False
         if self.getTypeTags() != other.getTypeTags():
             return False
-        for i in range(len(self.arguments)):
-            if self.arguments[i].value != other.arguments[i].value:
+        for i in range(len(self._arguments)):
+            if self._arguments[i].value != other._arguments[i].value:
                 return False
         return True
 
@@ -246,6 +269,79 @@ class Bundle(object):
         return r
 
 
+class Bundler(object):
+    """
+    Packs OSC elements into bundles whose binary size stays under an MTU.
+
+    Elements are encoded once when added. The returned packets are ready
+    to be sent, e.g. as UDP datagrams. Elements added together are atomic:
+    they are always put in the same packet. A packet holding a single
+    element is sent as that element, without a bundle around it.
+
+    @ivar mtu: The largest packet size, in bytes. A packet is only larger
+        if a single group of elements is larger than it.
+    @type mtu: C{int}
+    @ivar timeTag: The time tag of the bundles. See L{Bundle}.
+    """
+    DEFAULT_MTU = 1472 # largest UDP payload in an Ethernet frame
+
+    def __init__(self, mtu=DEFAULT_MTU, timeTag=True):
+        self.mtu = mtu
+        self.timeTag = timeTag
+        self._header = StringArgument("#bundle").toBinary() + TimeTagArgument(timeTag).toBinary()
+        self._binaries = []
+        self._size = len(self._header)
+
+
+    def add(self, *elements):
+        """
+        Adds elements, which are kept in the same packet.
+
+        @param elements: L{Message} or L{Bundle} instances.
+        @return: C{list} of the C{str} packets that are complete.
+        """
+        binaries = [element.toBinary() for element in elements]
+        size = sum([4 + len(binary) for binary in binaries])
+        packets = []
+        if self._binaries and self._size + size > self.mtu:
+            packets.extend(self.flush())
+        self._binaries.extend(binaries)
+        self._size += size
+        if self._size >= self.mtu:
+            packets.extend(self.flush())
+        return packets
+
+
+    def flush(self):
+        """
+        Packs all the pending elements.
+
+        @return: C{list} of C{str} packets. It is empty if there was no
+            pending element.
+        """
+        binaries = self._binaries
+        if not binaries:
+            return []
+        self._binaries = []
+        self._size = len(self._header)
+        if len(binaries) == 1:
+            return [binaries[0]]
+        data = [self._header]
+        for binary in binaries:
+            data.append(struct.pack(">i", len(binary)))
+            data.append(binary)
+        return ["".join(data)]
+
+
+    def getPendingCount(self):
+        """
+        Returns the number of elements waiting to be packed.
+        @rtype: C{int}
+        """
+        return len(self._binaries)
+
+
+
 class Argument(object):
     """
     Base OSC argument class.
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_rpc -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Request and reply calls over OSC
+
+An L{RpcClient} sends requests to a remote L{RpcResponder}, typically
+over a single TCP connection, and returns a L{Deferred} which fires with
+the values of the reply. Many requests can be sent before the first
+reply is received.
+
+Each reply is matched to its request with one of these conventions:
+
+ - L{CORRELATE_ID}: an int32 request id is prepended to the arguments of
+   the request. The reply is sent to C{/reply} with the same id followed
+   by the results, or to C{/error} with the id and an error message.
+
+ - L{CORRELATE_ADDRESS}: the request is sent as is, and the reply is sent
+   to the address of the request followed by C{/reply}, or C{/error}. The
+   requests sent to an address are answered in order, so this needs an
+   ordered transport such as TCP.
+"""
+import collections
+
+from twisted.internet import defer
+from twisted.python import log
+from txosc.osc import Message, OscError
+from txosc import stats
+
+CORRELATE_ID = "id"
+CORRELATE_ADDRESS = "address"
+
+REPLY_ADDRESS = "/reply"
+ERROR_ADDRESS = "/error"
+
+_MAX_REQUEST_ID = 1 << 31
+
+
+class RpcError(OscError):
+    """
+    The remote responder answered a request with an error.
+    """
+
+
+class RpcTimeoutError(OscError):
+    """
+    No reply was received for a request before its timeout.
+    """
+
+
+def _remoteName(connection):
+    """
+    Returns a name for the peer of a L{txosc.async.StreamBasedProtocol},
+    or of the connected protocol of a factory.
+    """
+    protocol = getattr(connection, "connectedProtocol", connection)
+    transport = getattr(protocol, "transport", None)
+    if transport is None:
+        return None
+    peer = transport.getPeer()
+    host = getattr(peer, "host", None)
+    if host is not None:
+        return "%s:%s" % (host, peer.port)
+    return str(getattr(peer, "name", peer))
+
+
+class _Call(object):
+    """
+    A request sent, or waiting to be sent, by an L{RpcClient}.
+    """
+    timeoutCall = None
+    sentAt = None
+    remote = None
+
+    def __init__(self, address, args, deferred):
+        self.address = address
+        self.args = args
+        self.deferred = deferred
+
+
+
+class RpcClient(object):
+    """
+    Sends requests and matches their replies.
+
+    At most C{window} requests are waiting for their reply at once. The
+    calls beyond it are queued, and sent when a reply is received.
+
+    Here is an example on how to use it::
+
+      factory = async.ClientFactory(receiver)
+      reactor.connectTCP("localhost", 17779, factory)
+      client = rpc.RpcClient(factory, receiver)
+      d = client.call("/synth/voices")
+      d.addCallback(lambda values: log.msg("%d voices" % values[0]))
+
+    The round trip times are recorded for each remote peer. See
+    L{getStats}.
+
+    Only the replies received from the connection are matched, so that
+    several clients can share a receiver. When the connection is a
+    L{txosc.async.StreamBasedProtocol}, or a factory of them, the calls
+    fail when it is lost.
+
+    @ivar connection: The L{txosc.async.StreamBasedProtocol} or factory
+        the requests are sent with.
+    @ivar receiver: The L{txosc.dispatch.Receiver} which receives the
+        replies. Callbacks are added to it.
+    @ivar correlation: L{CORRELATE_ID} or L{CORRELATE_ADDRESS}.
+    @ivar window: The most requests waiting for their reply.
+    @ivar timeout: The default timeout of the calls, in seconds, or
+        C{None} to wait forever.
+    @ivar clock: The C{IReactorTime} provider used for the timeouts and
+        round trip times. Defaults to the global reactor.
+    @ivar peer: The client the replies come from, as given to the
+        callbacks of the receiver, for example the C{(host, port)} of a
+        UDP responder. If C{None}, it must be the connection or its
+        connected protocol.
+    """
+    clock = None
+    peer = None
+    _watched = None
+
+    def __init__(self, connection, receiver, correlation=CORRELATE_ID, window=32, timeout=5.0):
+        if correlation not in (CORRELATE_ID, CORRELATE_ADDRESS):
+            raise ValueError("Invalid correlation: %s" % (correlation))
+        self.connection = connection
+        self.receiver = receiver
+        self.correlation = correlation
+        self.window = window
+        self.timeout = timeout
+        self.callCount = 0
+        self.replyCount = 0
+        self.errorCount = 0
+        self.timeoutCount = 0
+        self.lateReplyCount = 0
+        self._nextId = 0
+        self._inFlight = 0
+        # by request id, or by address with the calls in order
+        self._pending = {}
+        self._queue = collections.deque()
+        self._latencies = {}
+        if correlation == CORRELATE_ID:
+            receiver.addCallback(REPLY_ADDRESS, self._gotReply)
+            receiver.addCallback(ERROR_ADDRESS, self._gotError)
+
+
+    def call(self, address, *args, **kwargs):
+        """
+        Sends a request.
+
+        @param address: The OSC address of the request.
+        @param args: The arguments of the request.
+        @keyword timeout: The timeout of this call, in seconds, counted
+            from now. Defaults to the C{timeout} of the client.
+        @return: A L{Deferred} which fires with the C{list} of the values
+            of the reply. It fails with L{RpcError} if the responder
+            answers with an error, and with L{RpcTimeoutError} if there is
+            no reply before the timeout.
+        """
+        timeout = kwargs.pop("timeout", self.timeout)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" % (", ".join(kwargs)))
+        call = _Call(address, args, defer.Deferred())
+        call.timeout = timeout
+        self.callCount += 1
+        if timeout is not None:
+            call.timeoutCall = self.getClock().callLater(timeout, self._timedOut, call)
+        if self._inFlight < self.window:
+            self._send(call)
+        else:
+            self._queue.append(call)
+        return call.deferred
+
+
+    def getPendingCount(self):
+        """
+        Returns the number of requests sent and waiting for their reply,
+        and the number of calls queued.
+        @rtype: C{tuple}
+        """
+        return self._inFlight, len(self._queue)
+
+
+    def getStats(self):
+        """
+        Returns the statistics of the calls.
+
+        @return: C{dict} with the C{"calls"}, C{"replies"}, C{"errors"},
+            C{"timeouts"} and C{"lateReplies"} counts, and C{"latency"}, a
+            C{dict} of the round trip time snapshots of each remote peer.
+            See L{txosc.stats.Histogram.snapshot}.
+        """
+        return {
+            "calls": self.callCount,
+            "replies": self.replyCount,
+            "errors": self.errorCount,
+            "timeouts": self.timeoutCount,
+            "lateReplies": self.lateReplyCount,
+            "latency": dict([(remote, histogram.snapshot()) for remote, histogram in self._latencies.iteritems()]),
+            }
+
+
+    def failPending(self, reason):
+        """
+        Fails all the calls sent or queued, for example when the
+        connection is lost.
+
+        @param reason: L{Failure} or exception the calls fail with.
+        """
+        calls = list(self._queue)
+        self._queue.clear()
+        if self.correlation == CORRELATE_ID:
+            calls.extend(self._pending.values())
+            self._pending.clear()
+        else:
+            for address, queue in self._pending.items():
+                calls.extend([call for call in queue if call is not None])
+                self._forgetAddress(address)
+        self._inFlight = 0
+        for call in calls:
+            self._finish(call)
+            call.deferred.errback(reason)
+
+
+    def getClock(self):
+        """
+        Returns the C{IReactorTime} provider used for the timeouts.
+        """
+        if self.clock is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.clock
+
+
+    def _send(self, call):
+        self._inFlight += 1
+        if self.correlation == CORRELATE_ID:
+            requestId = self._nextId
+            self._nextId = (self._nextId + 1) % _MAX_REQUEST_ID
+            call.requestId = requestId
+            self._pending[requestId] = call
+            message = Message(call.address, requestId, *call.args)
+        else:
+            queue = self._pending.get(call.address)
+            if queue is None:
+                queue = self._pending[call.address] = collections.deque()
+                self.receiver.addCallback(call.address + REPLY_ADDRESS, self._gotReply)
+                self.receiver.addCallback(call.address + ERROR_ADDRESS, self._gotError)
+            queue.append(call)
+            message = Message(call.address, *call.args)
+        self._watchConnection()
+        call.remote = _remoteName(self.connection)
+        call.sentAt = self.getClock().seconds()
+        try:
+            self.connection.send(message)
+        except Exception:
+            self._remove(call, replied=True)
+            self._finish(call)
+            call.deferred.errback()
+
+
+    def _watchConnection(self):
+        """
+        Fails the pending calls when the current connection is lost.
+        """
+        protocol = getattr(self.connection, "connectedProtocol", self.connection)
+        if protocol is self._watched or not hasattr(protocol, "notifyConnectionLost"):
+            return
+        self._watched = protocol
+        protocol.notifyConnectionLost().addErrback(self._connectionLost, protocol)
+
+
+    def _connectionLost(self, reason, protocol):
+        if protocol is self._watched:
+            self._watched = None
+            self.failPending(reason)
+
+
+    def _isFromPeer(self, client):
+        """
+        Returns whether a reply was received from the connection.
+        """
+        if self.peer is not None:
+            return client == self.peer
+        connection = self.connection
+        return client is connection or client is getattr(connection, "connectedProtocol", None)
+
+
+    def _remove(self, call, replied):
+        """
+        Forgets a call which was sent, and sends the next queued ones.
+
+        @param replied: Whether no reply is expected anymore for the call.
+            Otherwise, with L{CORRELATE_ADDRESS}, the reply to come is
+            matched to a placeholder and discarded.
+        """
+        if self.correlation == CORRELATE_ID:
+            del self._pending[call.requestId]
+        else:
+            queue = self._pending[call.address]
+            if replied:
+                queue.remove(call)
+                if not queue:
+                    self._forgetAddress(call.address)
+            else:
+                queue[list(queue).index(call)] = None
+        self._inFlight -= 1
+        while self._queue and self._inFlight < self.window:
+            self._send(self._queue.popleft())
+
+
+    def _finish(self, call):
+        if call.timeoutCall is not None and call.timeoutCall.active():
+            call.timeoutCall.cancel()
+        call.timeoutCall = None
+
+
+    def _timedOut(self, call):
+        call.timeoutCall = None
+        self.timeoutCount += 1
+        if call.sentAt is None:
+            self._queue.remove(call)
+        else:
+            self._remove(call, replied=False)
+        call.deferred.errback(RpcTimeoutError("No reply to %s after %s seconds." % (call.address, call.timeout)))
+
+
+    def _popCall(self, message):
+        """
+        Returns the call a reply is for, and the values of the reply.
+        """
+        values = message.getValues()
+        if self.correlation == CORRELATE_ID:
+            if not values:
+                return None, values
+            return self._pending.get(values[0]), values[1:]
+        address = message.address.rsplit("/", 1)[0]
+        queue = self._pending.get(address)
+        if not queue:
+            return None, values
+        call = queue[0]
+        if call is None:
+            queue.popleft()
+            if not queue:
+                self._forgetAddress(address)
+        return call, values
+
+
+    def _forgetAddress(self, address):
+        del self._pending[address]
+        self.receiver.removeCallback(address + REPLY_ADDRESS, self._gotReply)
+        self.receiver.removeCallback(address + ERROR_ADDRESS, self._gotError)
+
+
+    def _complete(self, call):
+        self._latencies.setdefault(call.remote, stats.Histogram()).record(self.getClock().seconds() - call.sentAt)
+        self._finish(call)
+        self._remove(call, replied=True)
+
+
+    def _gotReply(self, message, client):
+        if not self._isFromPeer(client):
+            return
+        call, values = self._popCall(message)
+        if call is None:
+            self.lateReplyCount += 1
+            return
+        self.replyCount += 1
+        self._complete(call)
+        call.deferred.callback(values)
+
+
+    def _gotError(self, message, client):
+        if not self._isFromPeer(client):
+            return
+        call, values = self._popCall(message)
+        if call is None:
+            self.lateReplyCount += 1
+            return
+        self.errorCount += 1
+        self._complete(call)
+        call.deferred.errback(RpcError(*values))
+
+
+
+class RpcResponder(object):
+    """
+    Answers the requests of L{RpcClient}s.
+
+    A method is a function which is called with the arguments of a
+    request. Its result, or the result of the L{Deferred} it returns, is
+    sent back: a C{list} or C{tuple} as many values, C{None} as no value,
+    and anything else as a single value. An exception is sent back as an
+    error.
+
+    Here is an example on how to use it::
+
+      responder = rpc.RpcResponder(receiver)
+      responder.addMethod("/synth/voices", lambda: len(voices))
+      reactor.listenTCP(17779, async.ServerFactory(receiver))
+
+    The replies are sent with the C{send} method of the client given to
+    the callbacks, such as a L{txosc.async.StreamBasedProtocol}. When the
+    client is an address, for example the C{(host, port)} of a UDP client,
+    they are sent to it with the C{send(element, address)} method of the
+    C{sender}, such as a L{txosc.async.DatagramClientProtocol}.
+
+    @ivar receiver: The L{txosc.dispatch.Receiver} which receives the
+        requests.
+    @ivar correlation: L{CORRELATE_ID} or L{CORRELATE_ADDRESS}. It must be
+        the same as the one of the clients.
+    @ivar sender: The sender of the replies to the clients which are
+        addresses, or C{None}.
+    """
+
+    def __init__(self, receiver, correlation=CORRELATE_ID, sender=None):
+        if correlation not in (CORRELATE_ID, CORRELATE_ADDRESS):
+            raise ValueError("Invalid correlation: %s" % (correlation))
+        self.receiver = receiver
+        self.correlation = correlation
+        self.sender = sender
+        self._methods = {}
+        # the replies to each client and address, to send them in order
+        self._lastReplies = {}
+
+
+    def addMethod(self, address, method):
+        """
+        Adds a method.
+
+        @param address: The OSC address of the requests. It must not
+            contain wildcards.
+        @param method: A callable.
+        """
+        def gotRequest(message, client):
+            self._gotRequest(address, method, message, client)
+        self._methods[address] = gotRequest
+        self.receiver.addCallback(address, gotRequest)
+
+
+    def removeMethod(self, address):
+        """
+        Removes a method.
+        """
+        self.receiver.removeCallback(address, self._methods.pop(address))
+
+
+    def _gotRequest(self, address, method, message, client):
+        values = message.getValues()
+        if self.correlation == CORRELATE_ID:
+            if not values:
+                log.msg("RPC request without a request id: %s" % (message))
+                return
+            prefix = values[:1]
+            values = values[1:]
+            replyAddress = REPLY_ADDRESS
+            errorAddress = ERROR_ADDRESS
+        else:
+            prefix = []
+            replyAddress = address + REPLY_ADDRESS
+            errorAddress = address + ERROR_ADDRESS
+        d = defer.maybeDeferred(method, *values)
+
+        def gotResult(result):
+            if result is None:
+                result = []
+            elif not isinstance(result, (list, tuple)):
+                result = [result]
+            return Message(replyAddress, *(prefix + list(result)))
+
+        def gotFailure(reason):
+            return Message(errorAddress, *(prefix + [reason.getErrorMessage()]))
+
+        d.addCallbacks(gotResult, gotFailure)
+        if self.correlation == CORRELATE_ID:
+            d.addCallback(self._sendReply, client)
+            d.addErrback(log.err)
+            return
+        key = (client, address)
+        slot = [None]
+        self._lastReplies.setdefault(key, collections.deque()).append(slot)
+        def ready(reply):
+            slot[0] = reply
+            self._sendReady(key, client)
+        d.addCallback(ready)
+        d.addErrback(log.err)
+
+
+    def _sendReady(self, key, client):
+        """
+        Sends the replies to a client in the order of its requests.
+        """
+        replies = self._lastReplies[key]
+        while replies and replies[0][0] is not None:
+            self._sendReply(replies.popleft()[0], client)
+        if not replies:
+            del self._lastReplies[key]
+
+
+    def _sendReply(self, reply, client):
+        """
+        Sends a reply to a client, or to its address with the sender.
+        """
+        if hasattr(client, "send"):
+            client.send(reply)
+        elif self.sender is not None:
+            self.sender.send(reply, client)
+        else:
+            raise OscError("Cannot reply to %s without a sender." % (client,))
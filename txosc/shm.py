@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_shm -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Shared memory ring buffer transport for OSC between local processes
+
+A ring buffer is a file, usually in C{/dev/shm}, which is mapped in the
+memory of a single writer process and of a single reader process. Each
+OSC packet is copied into it as a record made of its size, as a
+little-endian int32, and of its data. Sending and receiving packets does
+not need any system call.
+
+The writer publishes a record by updating the write index after having
+copied the data, and the reader frees it by updating the read index after
+having copied it. Each index is only written by one side. There is no
+memory barrier between the copy and the update of an index, so this
+relies on the stores being seen in order by the other process. Only x86
+processors guarantee it: opening a ring buffer raises L{OscError} on the
+other architectures.
+
+The reader can sleep until a record is written. It then sets a flag in
+the header, and waits on a FIFO next to the ring file. The writer writes
+a byte to the FIFO when it publishes a record into an empty ring while
+the flag is set. The reader opens the FIFO for writing too, so that it
+does not see an end of file when a writer closes it. Since the flag and
+the indices are not protected by a memory barrier, a wakeup can be
+missed: the reader also wakes up after a short timeout.
+
+When the ring is full, a L{RingWriter} either drops the packet and counts
+it, or raises L{RingFullError}, depending on its C{overflow} policy.
+
+Twisted is not used in this file. See L{txosc.async.RingReceiver} to
+receive with Twisted.
+"""
+import os
+import mmap
+import errno
+import struct
+import select
+import platform
+from txosc.osc import OscError
+
+OVERFLOW_DROP = "drop"
+OVERFLOW_RAISE = "raise"
+
+DEFAULT_CAPACITY = 1 << 20 # 1 MiB
+DEFAULT_WAIT_TIMEOUT = 0.01
+
+_MAGIC = "OSCRING1"
+# The indices written by each side are on different cache lines.
+_CAPACITY_OFFSET = 8
+_WRITE_OFFSET = 64
+_DROPPED_OFFSET = 72
+_READ_OFFSET = 128
+_WAITING_OFFSET = 136
+_HEADER_SIZE = 192
+
+_index = struct.Struct("<Q")
+_flag = struct.Struct("<I")
+_recordSize = struct.Struct("<i")
+_WRAP = -1
+
+# The architectures whose stores are seen in the order of the program by
+# the other processors.
+_ORDERED_MACHINES = ["x86_64", "amd64", "i386", "i486", "i586", "i686", "x86"]
+
+
+class RingFullError(OscError):
+    """
+    Raised when a packet is sent to a full ring buffer whose overflow
+    policy is L{OVERFLOW_RAISE}.
+    """
+
+
+def createRing(path, capacity=DEFAULT_CAPACITY):
+    """
+    Creates the file of a ring buffer, or resets it.
+
+    @param path: The path of the file, for example C{/dev/shm/synth.osc}.
+    @param capacity: The size of the data part of the ring, in bytes. It
+        is rounded up to a multiple of 8.
+    """
+    capacity = (capacity + 7) & ~7
+    f = open(path, "w+b")
+    try:
+        f.truncate(_HEADER_SIZE + capacity)
+        f.seek(0)
+        f.write(_MAGIC + _index.pack(capacity))
+    finally:
+        f.close()
+
+
+def removeRing(path):
+    """
+    Removes the file of a ring buffer and its wakeup FIFO.
+    """
+    for name in [path, _fifoPath(path)]:
+        try:
+            os.unlink(name)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def _fifoPath(path):
+    return path + ".wakeup"
+
+
+class _Ring(object):
+    """
+    Maps the file of a ring buffer.
+    """
+
+    def __init__(self, path):
+        machine = platform.machine()
+        if machine.lower() not in _ORDERED_MACHINES:
+            raise OscError("Ring buffers need the stores to be ordered, which %s does not guarantee." % (machine))
+        self.path = path
+        f = open(path, "r+b")
+        try:
+            self._map = mmap.mmap(f.fileno(), 0)
+        finally:
+            f.close()
+        if self._map[:len(_MAGIC)] != _MAGIC:
+            self._map.close()
+            raise OscError("%s is not an OSC ring buffer." % (path))
+        self.capacity = _index.unpack_from(self._map, _CAPACITY_OFFSET)[0]
+
+
+    def getPendingSize(self):
+        """
+        Returns the number of bytes written but not read yet.
+        @rtype: C{int}
+        """
+        m = self._map
+        return _index.unpack_from(m, _WRITE_OFFSET)[0] - _index.unpack_from(m, _READ_OFFSET)[0]
+
+
+    def getDropped(self):
+        """
+        Returns the number of packets dropped because the ring was full.
+        @rtype: C{int}
+        """
+        return _index.unpack_from(self._map, _DROPPED_OFFSET)[0]
+
+
+    def close(self):
+        self._map.close()
+
+
+
+class RingWriter(_Ring):
+    """
+    The single writer of a ring buffer.
+
+    Here is an example on how to use it::
+
+      createRing("/dev/shm/synth.osc")
+      writer = RingWriter("/dev/shm/synth.osc")
+      writer.send(osc.Message("/synth/1/freq", 440.0))
+
+    @ivar overflow: What to do with the packets sent when the ring is
+        full: L{OVERFLOW_DROP} drops them, and L{OVERFLOW_RAISE} raises
+        L{RingFullError}.
+    """
+
+    def __init__(self, path, overflow=OVERFLOW_DROP):
+        _Ring.__init__(self, path)
+        if overflow not in (OVERFLOW_DROP, OVERFLOW_RAISE):
+            raise ValueError("Invalid overflow policy: %s" % (overflow))
+        self.overflow = overflow
+        self._write = _index.unpack_from(self._map, _WRITE_OFFSET)[0]
+        self._fifo = None
+
+
+    def send(self, element):
+        """
+        Sends an OSC element.
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        @return: Whether the element was written. See L{sendBinary}.
+        """
+        return self.sendBinary(element.toBinary())
+
+
+    def sendBinary(self, data):
+        """
+        Copies an already encoded OSC packet into the ring.
+
+        @type data: C{str}
+        @return: C{True} if the packet was written, C{False} if it was
+            dropped because the ring is full.
+        @raise RingFullError: If the ring is full and the overflow policy
+            is L{OVERFLOW_RAISE}.
+        @raise OscError: If the packet can never fit in the ring.
+        """
+        m = self._map
+        capacity = self.capacity
+        size = len(data)
+        needed = (4 + size + 7) & ~7
+        if needed > capacity:
+            raise OscError("A packet of %d bytes does not fit in a ring of %d bytes." % (size, capacity))
+        write = self._write
+        read = _index.unpack_from(m, _READ_OFFSET)[0]
+        position = write % capacity
+        skipped = 0
+        if position + needed > capacity:
+            skipped = capacity - position
+        if write + skipped + needed - read > capacity:
+            dropped = _index.unpack_from(m, _DROPPED_OFFSET)[0] + 1
+            _index.pack_into(m, _DROPPED_OFFSET, dropped)
+            if self.overflow == OVERFLOW_RAISE:
+                raise RingFullError("The ring buffer %s is full." % (self.path))
+            return False
+        if skipped:
+            _recordSize.pack_into(m, _HEADER_SIZE + position, _WRAP)
+            position = 0
+        start = _HEADER_SIZE + position
+        _recordSize.pack_into(m, start, size)
+        m[start + 4:start + 4 + size] = data
+        self._write = write + skipped + needed
+        _index.pack_into(m, _WRITE_OFFSET, self._write)
+        if read == write and _flag.unpack_from(m, _WAITING_OFFSET)[0]:
+            self._wakeUp()
+        return True
+
+
+    def _wakeUp(self):
+        """
+        Writes a byte to the wakeup FIFO of the reader, if it is open.
+        """
+        if self._fifo is None:
+            try:
+                self._fifo = os.open(_fifoPath(self.path), os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                return
+        try:
+            os.write(self._fifo, "\0")
+        except OSError, e:
+            if e.errno == errno.EPIPE:
+                os.close(self._fifo)
+                self._fifo = None
+
+
+    def close(self):
+        if self._fifo is not None:
+            os.close(self._fifo)
+            self._fifo = None
+        _Ring.close(self)
+
+
+
+class RingReader(_Ring):
+    """
+    The single reader of a ring buffer.
+
+    Here is an example on how to use it::
+
+      reader = RingReader("/dev/shm/synth.osc")
+      while True:
+          for data in reader.wait():
+              receiver.dispatch(osc._elementFromBinary(data), None)
+
+    @ivar wakeupFileno: The file descriptor of the wakeup FIFO, which is
+        readable when the writer wakes the reader up. It is open for
+        writing too, so it never reaches the end of file when the writers
+        close the FIFO.
+    """
+
+    def __init__(self, path):
+        _Ring.__init__(self, path)
+        self._read = _index.unpack_from(self._map, _READ_OFFSET)[0]
+        fifo = _fifoPath(path)
+        try:
+            os.mkfifo(fifo)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.wakeupFileno = os.open(fifo, os.O_RDWR | os.O_NONBLOCK)
+
+
+    def read(self, maxRecords=None):
+        """
+        Reads the packets written to the ring, without blocking.
+
+        @param maxRecords: The most packets to read, or C{None} for all.
+        @return: C{list} of C{str} packets. It might be empty.
+        """
+        m = self._map
+        capacity = self.capacity
+        read = self._read
+        write = _index.unpack_from(m, _WRITE_OFFSET)[0]
+        packets = []
+        while read < write:
+            if maxRecords is not None and len(packets) >= maxRecords:
+                break
+            position = read % capacity
+            if capacity - position < 4:
+                read += capacity - position
+                continue
+            size = _recordSize.unpack_from(m, _HEADER_SIZE + position)[0]
+            if size == _WRAP:
+                read += capacity - position
+                continue
+            start = _HEADER_SIZE + position + 4
+            packets.append(m[start:start + size])
+            read += (4 + size + 7) & ~7
+        if read != self._read:
+            self._read = read
+            _index.pack_into(m, _READ_OFFSET, read)
+        return packets
+
+
+    def setWaiting(self, waiting):
+        """
+        Sets whether the writer should wake the reader up with the FIFO
+        when it writes into an empty ring.
+        @type waiting: C{bool}
+        """
+        _flag.pack_into(self._map, _WAITING_OFFSET, int(waiting))
+
+
+    def clearWakeup(self):
+        """
+        Reads the bytes written to the wakeup FIFO.
+        """
+        try:
+            while os.read(self.wakeupFileno, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+    def wait(self, timeout=DEFAULT_WAIT_TIMEOUT):
+        """
+        Returns the packets written to the ring, and sleeps until some are
+        written if there is none.
+
+        @param timeout: The longest time to sleep, in seconds. A wakeup
+            might be missed, so it should stay short.
+        @return: C{list} of C{str} packets. It is empty on timeout.
+        """
+        packets = self.read()
+        if packets:
+            return packets
+        self.setWaiting(True)
+        try:
+            packets = self.read()
+            if packets:
+                return packets
+            select.select([self.wakeupFileno], [], [], timeout)
+            self.clearWakeup()
+        finally:
+            self.setWaiting(False)
+        return self.read()
+
+
+    def close(self):
+        self.setWaiting(False)
+        os.close(self.wakeupFileno)
+        _Ring.close(self)
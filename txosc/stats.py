@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_stats -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Statistics and profiling tools for the dispatching of OSC messages
+
+Twisted is only needed to periodically dump the statistics.
+"""
+import time
+import random
+
+
+class Histogram(object):
+    """
+    A histogram of durations, with logarithmic buckets.
+
+    Like an HDR histogram, each power of two is split into a fixed number
+    of sub-buckets, so that the relative error on the recorded values is
+    bounded whatever their magnitude. Values are recorded in microseconds.
+
+    @ivar precision: Number of bits of precision. Each power of two is
+        split into C{2 ** precision} buckets.
+    @type precision: C{int}
+    """
+
+    def __init__(self, precision=3):
+        self.precision = precision
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all the recorded values.
+        """
+        self._buckets = {}
+        self._count = 0
+        self._total = 0
+        self._max = 0
+
+
+    def record(self, duration):
+        """
+        Records a duration.
+
+        @param duration: Duration in seconds.
+        @type duration: C{float}
+        """
+        value = int(duration * 1e6)
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.precision - 1
+        if shift > 0:
+            value = (value >> shift) << shift
+        self._buckets[value] = self._buckets.get(value, 0) + 1
+        self._count += 1
+        self._total += duration
+        if duration > self._max:
+            self._max = duration
+
+
+    def getCount(self):
+        """
+        Returns the number of recorded values.
+        @rtype: C{int}
+        """
+        return self._count
+
+
+    def getMean(self):
+        """
+        Returns the mean of the recorded durations, in seconds.
+        @rtype: C{float}
+        """
+        if not self._count:
+            return 0.0
+        return self._total / self._count
+
+
+    def getMax(self):
+        """
+        Returns the largest recorded duration, in seconds.
+        @rtype: C{float}
+        """
+        return self._max
+
+
+    def getPercentile(self, percentile):
+        """
+        Returns the duration under which the given percentage of the
+        recorded values are.
+
+        The result is the lower bound of the bucket, so it is accurate to
+        the precision of the histogram.
+
+        @param percentile: A number in the range [0, 100].
+        @return: Duration in seconds.
+        @rtype: C{float}
+        """
+        if not self._count:
+            return 0.0
+        wanted = self._count * percentile / 100.0
+        seen = 0
+        for value in sorted(self._buckets):
+            seen += self._buckets[value]
+            if seen >= wanted:
+                return value / 1e6
+        return max(self._buckets) / 1e6
+
+
+    def snapshot(self):
+        """
+        Returns a summary of the recorded durations, in seconds.
+        @rtype: C{dict}
+        """
+        return {
+            "count": self._count,
+            "mean": self.getMean(),
+            "max": self._max,
+            "p50": self.getPercentile(50),
+            "p90": self.getPercentile(90),
+            "p99": self.getPercentile(99),
+            }
+
+
+
+class _PeriodicDumper(object):
+    """
+    Base class for the statistics which can be periodically dumped.
+
+    Child classes must implement C{snapshot} and C{logSnapshot}.
+    """
+    _dumpCall = None
+
+    def startDumping(self, interval, dump=None, reactor=None):
+        """
+        Periodically passes the snapshot of the statistics to a function.
+
+        This uses the Twisted reactor.
+
+        @param interval: Interval in seconds.
+        @param dump: Callable which receives the C{dict} returned by
+            C{snapshot}. By default, the statistics are logged.
+        @param reactor: The C{IReactorTime} provider to use. Defaults to
+            the global reactor.
+        """
+        from twisted.internet import task
+        if dump is None:
+            dump = self.logSnapshot
+        self.stopDumping()
+        self._dumpCall = task.LoopingCall(self._dump, dump)
+        if reactor is not None:
+            self._dumpCall.clock = reactor
+        self._dumpCall.start(interval, now=False)
+
+
+    def stopDumping(self):
+        """
+        Stops dumping the statistics periodically.
+        """
+        if self._dumpCall is not None:
+            if self._dumpCall.running:
+                self._dumpCall.stop()
+            self._dumpCall = None
+
+
+    def _dump(self, dump):
+        dump(self.snapshot())
+
+
+
+class Profiler(_PeriodicDumper):
+    """
+    Collects the time spent decoding, matching and dispatching OSC messages.
+
+    Set it to a L{txosc.dispatch.Receiver} with its C{setProfiler} method.
+    The protocols of L{txosc.async} then record the decoding time of the
+    packets they receive. The number of messages per address is always
+    counted, but only a sample of them is timed.
+
+    @ivar sampleRate: The fraction of the messages that are timed, in the
+        range [0, 1].
+    @type sampleRate: C{float}
+    @ivar decodeTime: L{Histogram} of the time spent decoding packets.
+    @ivar matchTime: L{Histogram} of the time spent finding the callbacks.
+    @ivar dispatchTime: L{Histogram} of the total time spent dispatching
+        a message, including the callbacks.
+    @ivar callbackTimes: C{dict} of L{Histogram}, one for each callback.
+    @ivar addressCounts: C{dict} of the number of messages for each address.
+        Like the table of a L{FallbackCounter}, it is bounded: when it is
+        full, the half of the addresses with the smallest counts is evicted.
+    @ivar maxAddresses: Maximum number of addresses counted.
+    @type maxAddresses: C{int}
+    """
+    clock = time.time
+
+    def __init__(self, sampleRate=0.01, maxAddresses=1024):
+        self.sampleRate = sampleRate
+        self.maxAddresses = maxAddresses
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all the statistics.
+        """
+        self.decodeTime = Histogram()
+        self.matchTime = Histogram()
+        self.dispatchTime = Histogram()
+        self.callbackTimes = {}
+        self.addressCounts = {}
+        self._evictedAddresses = 0
+
+
+    def shouldSample(self):
+        """
+        Returns whether the current message should be timed.
+        @rtype: C{bool}
+        """
+        if self.sampleRate >= 1.0:
+            return True
+        return random.random() < self.sampleRate
+
+
+    def countMessage(self, address):
+        """
+        Counts one message received for the given address.
+        @type address: C{str}
+        """
+        counts = self.addressCounts
+        if address in counts:
+            counts[address] += 1
+            return
+        if len(counts) >= self.maxAddresses:
+            kept = _largestCounts(counts, self.maxAddresses // 2)
+            self._evictedAddresses += len(counts) - len(kept)
+            self.addressCounts = counts = kept
+        counts[address] = 1
+
+
+    def recordCallback(self, callback, duration):
+        """
+        Records the time spent running a callback.
+        @param callback: The callable that has been called.
+        @param duration: Duration in seconds.
+        """
+        histogram = self.callbackTimes.get(callback)
+        if histogram is None:
+            histogram = self.callbackTimes[callback] = Histogram()
+        histogram.record(duration)
+
+
+    def snapshot(self):
+        """
+        Returns all the statistics.
+
+        The callbacks are named after their module or class. The callbacks
+        sharing a name, such as lambdas, are told apart with their C{repr}.
+        @rtype: C{dict}
+        """
+        names = {}
+        for callback in self.callbackTimes:
+            names.setdefault(_callbackName(callback), []).append(callback)
+        callbacks = {}
+        for name, named in names.iteritems():
+            for callback in named:
+                if len(named) > 1:
+                    key = "%s %r" % (name, callback)
+                else:
+                    key = name
+                callbacks[key] = self.callbackTimes[callback].snapshot()
+        return {
+            "decode": self.decodeTime.snapshot(),
+            "match": self.matchTime.snapshot(),
+            "dispatch": self.dispatchTime.snapshot(),
+            "callbacks": callbacks,
+            "addresses": dict(self.addressCounts),
+            "evictedAddresses": self._evictedAddresses,
+            }
+
+
+    def logSnapshot(self, snapshot):
+        """
+        Logs the statistics returned by L{snapshot} using Twisted.
+        """
+        from twisted.python import log
+        for key in ["decode", "match", "dispatch"]:
+            log.msg("%s: %s" % (key, _formatHistogram(snapshot[key])))
+        for name, histogram in sorted(snapshot["callbacks"].iteritems()):
+            log.msg("callback %s: %s" % (name, _formatHistogram(histogram)))
+        for address, count in sorted(snapshot["addresses"].iteritems()):
+            log.msg("address %s: %d messages" % (address, count))
+
+
+
+class FallbackCounter(_PeriodicDumper):
+    """
+    A fallback for L{txosc.dispatch.Receiver} which counts the unhandled
+    messages instead of logging each of them.
+
+    Messages are counted per address and source. The table of counters is
+    bounded: when it is full, the half with the smallest counts is
+    evicted, so that the most frequent senders stay in it. Summaries are
+    logged periodically, and only if new messages were counted.
+
+    Here is an example on how to use it::
+
+      counter = FallbackCounter()
+      receiver.setFallback(counter)
+      counter.startDumping(60.0)
+
+    @ivar maxEntries: Maximum number of (address, source) counters.
+    @type maxEntries: C{int}
+    @ivar topSize: Number of entries in the top list of the snapshot.
+    @type topSize: C{int}
+    """
+
+    def __init__(self, maxEntries=1024, topSize=10):
+        self.maxEntries = maxEntries
+        self.topSize = topSize
+        self.reset()
+
+
+    def reset(self):
+        """
+        Forget all the counters.
+        """
+        self._counts = {}
+        self._total = 0
+        self._evicted = 0
+        self._lastDumpedTotal = 0
+
+
+    def __call__(self, message, client):
+        """
+        Counts an unhandled message.
+        @param message: L{txosc.osc.Message} instance.
+        @param client: The client argument of L{txosc.dispatch.Receiver.dispatch}.
+        """
+        key = (message.address, _sourceName(client))
+        self._total += 1
+        if key in self._counts:
+            self._counts[key] += 1
+            return
+        if len(self._counts) >= self.maxEntries:
+            self._evict()
+        self._counts[key] = 1
+
+
+    def _evict(self):
+        """
+        Removes the half of the counters with the smallest counts.
+        """
+        kept = _largestCounts(self._counts, self.maxEntries // 2)
+        self._evicted += len(self._counts) - len(kept)
+        self._counts = kept
+
+
+    def _sortedCounts(self):
+        return sorted(self._counts.iteritems(), key=lambda item: item[1], reverse=True)
+
+
+    def getTotal(self):
+        """
+        Returns the number of unhandled messages counted.
+        @rtype: C{int}
+        """
+        return self._total
+
+
+    def getTop(self, size=None):
+        """
+        Returns the most frequent unhandled addresses and sources.
+
+        @param size: Number of entries. Defaults to C{topSize}.
+        @return: C{list} of C{((address, source), count)} tuples, the
+            largest count first.
+        """
+        if size is None:
+            size = self.topSize
+        return self._sortedCounts()[:size]
+
+
+    def snapshot(self):
+        """
+        Returns the counters.
+        @rtype: C{dict}
+        """
+        return {
+            "total": self._total,
+            "evicted": self._evicted,
+            "top": self.getTop(),
+            }
+
+
+    def logSnapshot(self, snapshot):
+        """
+        Logs the counters returned by L{snapshot} using Twisted.
+        """
+        from twisted.python import log
+        top = ", ".join(["%s from %s (%d)" % (address, source, count) for (address, source), count in snapshot["top"]])
+        log.msg("%d unhandled messages. Top: %s" % (snapshot["total"], top))
+
+
+    def _dump(self, dump):
+        if self._total == self._lastDumpedTotal:
+            return
+        self._lastDumpedTotal = self._total
+        dump(self.snapshot())
+
+
+
+def readUdpDrops(sock):
+    """
+    Returns the number of datagrams dropped by the kernel for a UDP
+    socket, as found in C{/proc/net/udp} or C{/proc/net/udp6} on Linux.
+
+    @param sock: A UDP C{socket.socket}.
+    @return: The number of drops, or C{None} if it cannot be found.
+    """
+    import os
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in ["/proc/net/udp", "/proc/net/udp6"]:
+        try:
+            f = open(path)
+        except IOError:
+            continue
+        try:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[12])
+        finally:
+            f.close()
+    return None
+
+
+
+def _largestCounts(counts, size):
+    """
+    Returns the given number of entries of a table of counters with the
+    largest counts.
+    @rtype: C{dict}
+    """
+    return dict(sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)[:size])
+
+
+def _callbackName(callback):
+    """
+    Returns a readable name for a callable.
+    @rtype: C{str}
+    """
+    name = getattr(callback, "__name__", None)
+    if name is None:
+        return repr(callback)
+    owner = getattr(callback, "im_self", None)
+    if owner is not None:
+        return "%s.%s" % (type(owner).__name__, name)
+    return "%s.%s" % (getattr(callback, "__module__", None), name)
+
+
+def _sourceName(client):
+    """
+    Returns the name of the originator of a message.
+
+    @param client: Either a (host, port) tuple, or a L{txosc.async.StreamBasedFactory}.
+    @rtype: C{str}
+    """
+    if isinstance(client, tuple):
+        return client[0]
+    return repr(client)
+
+
+def _formatHistogram(histogram):
+    return "count=%(count)d mean=%(mean).6fs p50=%(p50).6fs p99=%(p99).6fs max=%(max).6fs" % histogram
@@ -2,21 +2,67 @@
 #!/usr/bin/env python
 # Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
 # See LICENSE for details.
-# TODO: # -*- test-case-name: txosc.test.test_sync -*-
+# -*- test-case-name: txosc.test.test_sync -*-
 """
-Synchronous blocking OSC sender without Twisted.
+Synchronous blocking OSC sender and receiver without Twisted.
 
 Twisted is not used in this file. You don't even need to repy on Twisted to use 
 it and the txosc.osc module. That is enough to send OSC messages in a simple
-script. 
+script. The receivers dispatch the received messages with a
+L{txosc.dispatch.Receiver}. Since its default fallback logs the unhandled
+messages with Twisted, they are counted by a L{txosc.stats.FallbackCounter}
+instead, unless another fallback was set.
 """
+import collections
+import errno
+import Queue
+import select
 import socket
 import struct
+import threading
+import time
+import traceback
+from txosc.osc import Bundle, Bundler, OscError, _elementFromBinary
+from txosc import framing
+from txosc import mmsg
+from txosc import stats
 
-#TODO: receiver
 #TODO: bidirectional sender-receiver
-# self._socket.recv(self.buffer_size)
-# self.buffer_size = 1024
+
+def _sendAll(sock, pieces):
+    """
+    Writes strings to a stream socket completely, like C{socket.sendall},
+    but with gather writes instead of joining them. See
+    L{txosc.mmsg.sendv}.
+
+    @param pieces: C{list} of C{str}.
+    @raise socket.error: If the data cannot be written. Its C{written}
+        attribute is the number of bytes which were written before.
+    """
+    written = 0
+    index = 0
+    offset = 0
+    while index < len(pieces):
+        try:
+            count = mmsg.sendv(sock, pieces[index:index + mmsg.MAX_IOV], offset)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                # the socket has a timeout
+                if not select.select([], [sock], [], sock.gettimeout())[1]:
+                    e = socket.timeout("timed out")
+                    e.written = written
+                    raise e
+                continue
+            if e.args[0] == errno.EINTR:
+                continue
+            e.written = written
+            raise
+        written += count
+        offset += count
+        while index < len(pieces) and offset >= len(pieces[index]):
+            offset -= len(pieces[index])
+            index += 1
+
 
 class _Sender(object):
     def __init__(self):
@@ -50,8 +96,196 @@ class TcpSender(_Sender):
 
     def _actually_send(self, binary_data):
         #For TCP, we need to pack the data with its size first
-        data = struct.pack(">i", len(binary_data)) + binary_data
-        self._socket.send(data)
+        _sendAll(self._socket, [struct.pack(">i", len(binary_data)), binary_data])
+
+    def close(self):
+        self._socket.close()
+
+class BufferedTcpSender(_Sender):
+    """
+    Send OSC over TCP, with buffering and reconnection.
+
+    The packets are written with gather writes, so that the size prefixes
+    are not joined to the packets, and the writes are resumed until all
+    the data is written.
+
+    With a C{delay}, the packets sent in a burst are batched: a packet
+    sent less than C{delay} seconds after the previous one is kept until
+    C{flushSize} bytes are pending, until a packet is sent more than
+    C{delay} seconds after the first pending one, or until L{flush} or
+    L{close} is called. There is no timer, so the end of a burst is only
+    written by the next send: call L{flush} before waiting for a reply.
+    The first packet after a pause is written at once. Without a delay,
+    every packet is written when it is sent.
+
+    When the connection is lost, the packets which were not written are
+    kept, and the sender reconnects when it flushes them, at most once
+    every C{retryDelay} seconds. A packet partly written to the lost
+    connection is written again from its start. Meanwhile, the oldest
+    packets are dropped to keep at most C{maxBacklog} bytes. The packets
+    written to a connection which is then lost are not sent again, as TCP
+    does not tell whether they were received.
+
+    @ivar flushSize: The number of pending bytes written at once.
+    @ivar delay: The longest time between the packets of a burst, and
+        the longest time a packet is kept before being written as long as
+        other packets are sent, in seconds. C{0} disables the batching.
+    @ivar maxBacklog: The most bytes kept while disconnected.
+    @ivar retryDelay: The shortest time between connection attempts, in
+        seconds.
+    @ivar droppedCount: Number of packets dropped from the backlog.
+    @ivar reconnectCount: Number of successful reconnections.
+    """
+    def __init__(self, address, port, flushSize=16384, delay=0.0, maxBacklog=1 << 20, retryDelay=1.0, framer=framing.LengthPrefixedFramer):
+        """
+        @param framer: The class of the L{txosc.framing} framer.
+        @raise socket.error: If the first connection fails.
+        """
+        _Sender.__init__(self)
+        self.address = address
+        self.port = port
+        self.flushSize = flushSize
+        self.delay = delay
+        self.maxBacklog = maxBacklog
+        self.retryDelay = retryDelay
+        self.droppedCount = 0
+        self.reconnectCount = 0
+        self._framer = framer()
+        # (size, pieces) tuples of the packets to write
+        self._frames = collections.deque()
+        self._pendingSize = 0
+        self._firstPendingTime = None
+        self._lastSendTime = None
+        self._lastAttempt = None
+        self._connect()
+
+    def _connect(self):
+        self._socket = socket.create_connection((self.address, self.port))
+        # the packets are already gathered
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _actually_send(self, binary_data):
+        pieces = self._framer.frame(binary_data)
+        size = sum([len(piece) for piece in pieces])
+        self._frames.append((size, pieces))
+        self._pendingSize += size
+        while self._pendingSize > self.maxBacklog and len(self._frames) > 1:
+            self._pendingSize -= self._frames.popleft()[0]
+            self.droppedCount += 1
+        now = time.time()
+        burst = self._lastSendTime is not None and now - self._lastSendTime < self.delay
+        self._lastSendTime = now
+        if self._firstPendingTime is None:
+            self._firstPendingTime = now
+        if not burst or self._pendingSize >= self.flushSize or now - self._firstPendingTime >= self.delay:
+            self.flush()
+
+    def getPendingSize(self):
+        """
+        Returns the number of bytes waiting to be written.
+        @rtype: C{int}
+        """
+        return self._pendingSize
+
+    def flush(self):
+        """
+        Writes all the pending packets. It blocks until they are written,
+        or until the connection is lost and cannot be made again.
+
+        @return: Whether all the packets were written. Otherwise, they are
+            written once reconnected.
+        @rtype: C{bool}
+        """
+        reconnected = False
+        while self._frames:
+            if self._socket is None:
+                # reconnects once at most, if the new connection is lost
+                if reconnected or not self._reconnect():
+                    return False
+                reconnected = True
+            try:
+                self._write()
+            except socket.error:
+                self._socket.close()
+                self._socket = None
+        self._firstPendingTime = None
+        return True
+
+    def _reconnect(self):
+        now = time.time()
+        if self._lastAttempt is not None and now - self._lastAttempt < self.retryDelay:
+            return False
+        self._lastAttempt = now
+        try:
+            self._connect()
+        except socket.error:
+            return False
+        self.reconnectCount += 1
+        return True
+
+    def _write(self):
+        frames = self._frames
+        pieces = []
+        for size, framePieces in frames:
+            pieces.extend(framePieces)
+        written = 0
+        try:
+            _sendAll(self._socket, pieces)
+            written = self._pendingSize
+        except socket.error, e:
+            written = e.written
+            raise
+        finally:
+            # forgets the packets written completely
+            while frames and frames[0][0] <= written:
+                size = frames.popleft()[0]
+                written -= size
+                self._pendingSize -= size
+
+    def close(self):
+        """
+        Writes the pending packets, if possible, and closes the connection.
+        """
+        self.flush()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+class UnixStreamSender(TcpSender):
+    """
+    Send OSC over a Unix stream socket, to the same host.
+
+    The packets are framed like with TCP. See L{txosc.async.listenUNIX}.
+    """
+    def __init__(self, path):
+        """
+        @param path: The path of the socket of the server.
+        """
+        _Sender.__init__(self)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.path = path
+        self._socket.connect(self.path)
+
+
+class UnixDatagramSender(_Sender):
+    """
+    Send OSC over a Unix datagram socket, to the same host.
+
+    Unlike with UDP, no datagram is lost: sending blocks while the receive
+    buffer of the server is full. See L{txosc.async.listenUNIXDatagram}.
+    """
+    def __init__(self, path):
+        """
+        @param path: The path of the socket of the server.
+        """
+        _Sender.__init__(self)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.path = path
+        self._socket.connect(self.path)
+
+    def _actually_send(self, binary_data):
+        self._socket.send(binary_data)
 
     def close(self):
         self._socket.close()
@@ -65,13 +299,20 @@ class UdpSender(_Sender):
 
     Mode can be either UDP_MODE_BROADCAST or UDP_MODE_MULTICAST or None.
     If using UDP_MODE_MULTICAST, you must set the multicast_group.
+
+    Without mode, the socket can be connected to the destination. The
+    kernel then does not look up the route of each packet, and an ICMP
+    "port unreachable" error makes the next send raise a C{socket.error}
+    with C{errno.ECONNREFUSED}.
     
     FIXME: Right now, the data it sends is badly formatted.
     """
-    def __init__(self, address, port, mode=None, multicast_group=None):
+    def __init__(self, address, port, mode=None, multicast_group=None, connected=False):
         """
         @param multicast_group: IP of the multicast group.
         @type multicast_group: C{str}
+        @param connected: Whether to connect the socket to the destination.
+        @type connected: C{bool}
         """
         _Sender.__init__(self)
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -94,17 +335,565 @@ class UdpSender(_Sender):
         else:
             if multicast_group is not None:
                 raise RuntimeError("Not using the multicast mode.")
+        self._sendBatch = None
+        self.connected = connected
+        if self.connected:
+            if self.mode is not None:
+                raise RuntimeError("Only the sockets without mode can be connected.")
+            self._socket.connect((self.address, self.port))
 
     def _actually_send(self, binary_data):
         # For UDP, we just send the data. 
         # No need to pack it with its size. 
-        if self.mode == UDP_MODE_BROADCAST:
+        if self.connected:
+            self._socket.send(binary_data)
+        elif self.mode == UDP_MODE_BROADCAST:
             self._socket.sendto(binary_data, ('<broadcast>', self.port))
         elif self.mode == UDP_MODE_MULTICAST:
             self._socket.sendto(binary_data, (self.multicast_group, self.port))
         else:
             self._socket.sendto(binary_data, (self.address, self.port))
 
+    def sendMany(self, elements, destinations=None):
+        """
+        Sends each element to each destination, with as few system calls
+        as possible. On Linux, the datagrams are sent with sendmmsg.
+
+        @param elements: C{list} of L{txosc.osc.Message},
+            L{txosc.osc.Bundle} or already encoded C{str}.
+        @param destinations: C{list} of (host, port) tuples, or a single
+            one. Defaults to the destination of the sender. It must be
+            the default one if the socket is connected.
+        @return: The number of datagrams sent. It is lower than the
+            number of packets if an error occurred after some of them
+            were sent. The next call then raises the error.
+        @rtype: C{int}
+        @raise socket.error: If no datagram could be sent.
+        """
+        if destinations is None:
+            if self.connected:
+                destinations = None
+            elif self.mode == UDP_MODE_BROADCAST:
+                destinations = ('255.255.255.255', self.port)
+            elif self.mode == UDP_MODE_MULTICAST:
+                destinations = (self.multicast_group, self.port)
+            else:
+                destinations = (self.address, self.port)
+        else:
+            if self.connected:
+                raise RuntimeError("A connected sender only sends to its destination.")
+            if isinstance(destinations, tuple):
+                destinations = [destinations]
+            destinations = [(socket.gethostbyname(host), port) for host, port in destinations]
+        if self._sendBatch is None:
+            self._sendBatch = mmsg.SendBatch()
+        return self._sendBatch.send(self._socket, mmsg.makePackets(elements, destinations))
+
     def close(self):
         self._socket.close()
 
+
+class BundlingSender(object):
+    """
+    Packs the elements sent with a sender into bundles.
+
+    The elements are packed into L{txosc.osc.Bundle}s no larger than an
+    MTU, so that fewer datagrams are sent. As there is no event loop, the
+    pending elements are sent when the MTU is reached, when an element is
+    sent more than C{delay} seconds after the first pending one, or when
+    L{flush} or L{close} is called.
+
+    @ivar sender: The L{UdpSender} which sends the datagrams.
+    @ivar delay: The longest time an element is kept before being sent,
+        in seconds, as long as other elements are sent.
+    @ivar mtu: The largest datagram size, in bytes.
+    """
+    def __init__(self, sender, mtu=Bundler.DEFAULT_MTU, delay=0.001):
+        self.sender = sender
+        self.delay = delay
+        self._bundler = Bundler(mtu)
+        self._firstPendingTime = None
+
+    def send(self, element):
+        """
+        Queues an element to send.
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        """
+        self.sendAtomic([element])
+
+    def sendAtomic(self, elements):
+        """
+        Queues elements to send in the same datagram.
+        @param elements: C{list} of L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        """
+        now = time.time()
+        if self._firstPendingTime is not None and now - self._firstPendingTime >= self.delay:
+            self.flush()
+        for packet in self._bundler.add(*elements):
+            self.sender._actually_send(packet)
+        if not self._bundler.getPendingCount():
+            self._firstPendingTime = None
+        elif self._firstPendingTime is None:
+            self._firstPendingTime = now
+
+    def flush(self):
+        """
+        Sends all the pending elements right away.
+        """
+        for packet in self._bundler.flush():
+            self.sender._actually_send(packet)
+        self._firstPendingTime = None
+
+    def close(self):
+        """
+        Sends the pending elements and closes the sender.
+        """
+        self.flush()
+        self.sender.close()
+
+
+def _countUnhandled(receiver, threadSafe=False):
+    """
+    Makes a L{txosc.dispatch.Receiver} count its unhandled messages with a
+    L{txosc.stats.FallbackCounter}, if its fallback is the default one,
+    which imports Twisted.
+
+    @param threadSafe: Whether the counter is called from many threads.
+    @return: The L{txosc.stats.FallbackCounter}, or C{None} if the
+        fallback was not replaced.
+    """
+    if not hasattr(receiver, "setFallback") or "fallback" in vars(receiver):
+        return None
+    counter = stats.FallbackCounter()
+    if not threadSafe:
+        receiver.setFallback(counter)
+        return counter
+    lock = threading.Lock()
+    def fallback(message, client):
+        lock.acquire()
+        try:
+            counter(message, client)
+        finally:
+            lock.release()
+    receiver.setFallback(fallback)
+    return counter
+
+
+class _Receiver(object):
+    """
+    Base class of the blocking receivers.
+
+    @ivar receiver: The L{txosc.dispatch.Receiver} the received elements
+        are dispatched to.
+    @ivar packetCount: Number of packets received.
+    @ivar errorCount: Number of packets which could not be decoded. They
+        are skipped.
+    @ivar callbackErrorCount: Number of packets whose callbacks raised an
+        exception. It is printed, and the next packets are still
+        dispatched.
+    @ivar unhandled: The L{txosc.stats.FallbackCounter} of the unhandled
+        messages, or C{None} if the receiver has its own fallback.
+    """
+    def __init__(self, receiver):
+        self.receiver = receiver
+        self.unhandled = _countUnhandled(receiver)
+        self.packetCount = 0
+        self.errorCount = 0
+        self.callbackErrorCount = 0
+        self._serving = False
+
+    def poll(self, timeout=None):
+        """
+        Waits for packets and dispatches them.
+
+        @param timeout: The longest time to wait, in seconds. With C{0},
+            only the packets already received are dispatched. With
+            C{None}, it waits until something is received.
+        @return: The number of packets dispatched. It is C{0} on timeout.
+        @rtype: C{int}
+        """
+        raise NotImplementedError("This method must be overriden in child classes.")
+
+    def serve_forever(self, pollInterval=0.5):
+        """
+        Dispatches the received packets until L{shutdown} is called.
+
+        @param pollInterval: The longest time before a call to L{shutdown}
+            from another thread is noticed, in seconds.
+        """
+        self._serving = True
+        while self._serving:
+            self.poll(pollInterval)
+
+    def shutdown(self):
+        """
+        Makes L{serve_forever} return. It can be called from a callback,
+        or from another thread.
+        """
+        self._serving = False
+
+    def _dispatch(self, data, client):
+        self.packetCount += 1
+        try:
+            element = _elementFromBinary(data)
+        except (OscError, IndexError, struct.error):
+            self.errorCount += 1
+            return
+        try:
+            self.receiver.dispatch(element, client)
+        except Exception:
+            self.callbackErrorCount += 1
+            traceback.print_exc()
+
+    def close(self):
+        raise NotImplementedError("This method must be overriden in child classes.")
+
+
+class UdpReceiver(_Receiver):
+    """
+    Receives OSC over UDP.
+
+    The datagrams are read into a single preallocated buffer. The client
+    given to the callbacks is the C{(host, port)} tuple of the sender.
+
+    Here is an example on how to use it::
+
+      receiver = dispatch.Receiver()
+      receiver.addCallback("/ping", ping)
+      UdpReceiver(17779, receiver).serve_forever()
+
+    @ivar port: The UDP port number.
+    @ivar maxPacketSize: The size of the buffer. Larger datagrams are
+        truncated, and therefore cannot be decoded.
+    @ivar batchSize: The most datagrams dispatched by a single L{poll}.
+    """
+    def __init__(self, port, receiver, interface='', maxPacketSize=8192, receiveBufferSize=None, batchSize=64):
+        """
+        @param port: The UDP port number, or C{0} for any free one.
+        @param receiver: L{txosc.dispatch.Receiver} instance.
+        @param interface: The interface to listen on.
+        @param receiveBufferSize: The C{SO_RCVBUF} size, in bytes.
+        """
+        _Receiver.__init__(self, receiver)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if receiveBufferSize is not None:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+        self._socket.bind((interface, port))
+        self._socket.setblocking(False)
+        self.port = self._socket.getsockname()[1]
+        self.maxPacketSize = maxPacketSize
+        self.batchSize = batchSize
+        self._buffer = bytearray(maxPacketSize)
+        self._view = memoryview(self._buffer)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def poll(self, timeout=None):
+        if timeout != 0 and not select.select([self._socket], [], [], timeout)[0]:
+            return 0
+        sock = self._socket
+        buf = self._buffer
+        view = self._view
+        count = 0
+        while count < self.batchSize:
+            try:
+                size, address = sock.recvfrom_into(buf)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            count += 1
+            self._dispatch(view[:size].tobytes(), address)
+        return count
+
+    def close(self):
+        self._socket.close()
+
+
+class _TcpConnection(object):
+    """
+    A connection accepted by a L{TcpReceiver}. It is the client given to
+    the callbacks, so that they can reply with L{send}.
+
+    @ivar address: The address of the peer.
+    """
+    def __init__(self, sock, address, framer):
+        self._socket = sock
+        self.address = address
+        self._framer = framer
+        self._sendLock = threading.Lock()
+
+    def send(self, element):
+        """
+        Sends an element to the peer. It blocks until it is sent.
+
+        It can be called from the workers of a L{ThreadPoolDispatcher}: the
+        frames sent by different threads are not interleaved.
+        @param element: L{txosc.osc.Message} or L{txosc.osc.Bundle}
+        """
+        data = "".join(self._framer.frame(element.toBinary()))
+        self._sendLock.acquire()
+        try:
+            self._socket.setblocking(True)
+            try:
+                self._socket.sendall(data)
+            finally:
+                self._socket.setblocking(False)
+        finally:
+            self._sendLock.release()
+
+    def __str__(self):
+        return "%s:%s" % self.address
+
+
+class TcpReceiver(_Receiver):
+    """
+    Receives OSC over TCP, from many connections at once.
+
+    The data is read into a single preallocated buffer, and split into
+    packets by a framer for each connection. The client given to the
+    callbacks has a C{send} method to reply to the peer.
+
+    @ivar port: The TCP port number.
+    @ivar framer: The class of the L{txosc.framing} framer.
+    @ivar maxFrameSize: The largest packet size accepted, in bytes. A
+        connection sending a larger one is closed.
+    @ivar connections: C{dict} of the connections, by socket.
+    """
+    def __init__(self, port, receiver, interface='', framer=framing.LengthPrefixedFramer, maxFrameSize=framing.DEFAULT_MAX_FRAME_SIZE, chunkSize=65536):
+        """
+        @param port: The TCP port number, or C{0} for any free one.
+        @param receiver: L{txosc.dispatch.Receiver} instance.
+        @param interface: The interface to listen on.
+        @param chunkSize: The size of the buffer data is read into.
+        """
+        _Receiver.__init__(self, receiver)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((interface, port))
+        self._socket.listen(socket.SOMAXCONN)
+        self._socket.setblocking(False)
+        self.port = self._socket.getsockname()[1]
+        self.framer = framer
+        self.maxFrameSize = maxFrameSize
+        self.connections = {}
+        self._buffer = bytearray(chunkSize)
+        self._view = memoryview(self._buffer)
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def poll(self, timeout=None):
+        sockets = [self._socket] + self.connections.keys()
+        readable = select.select(sockets, [], [], timeout)[0]
+        count = 0
+        for sock in readable:
+            if sock is self._socket:
+                self._accept()
+            else:
+                count += self._read(sock)
+        return count
+
+    def _accept(self):
+        try:
+            sock, address = self._socket.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        sock.setblocking(False)
+        self.connections[sock] = _TcpConnection(sock, address, self.framer(self.maxFrameSize))
+
+    def _read(self, sock):
+        connection = self.connections[sock]
+        try:
+            size = sock.recv_into(self._buffer)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            size = 0
+        if not size:
+            self._disconnect(sock)
+            return 0
+        try:
+            packets = connection._framer.feed(self._view[:size])
+        except OscError:
+            self._disconnect(sock)
+            return 0
+        for packet in packets:
+            if packet:
+                self._dispatch(packet, connection)
+        return len(packets)
+
+    def _disconnect(self, sock):
+        del self.connections[sock]
+        sock.close()
+
+    def close(self):
+        for sock in self.connections.keys():
+            self._disconnect(sock)
+        self._socket.close()
+
+
+_STOP = object()
+
+def _orderedMessages(bundle):
+    """
+    Returns the messages of a bundle, recursively, in the order of its
+    elements. Unlike L{Bundle.getMessages}, it keeps the equal messages.
+    """
+    messages = []
+    for element in bundle.elements:
+        if isinstance(element, Bundle):
+            messages.extend(_orderedMessages(element))
+        else:
+            messages.append(element)
+    return messages
+
+
+class ThreadPoolDispatcher(object):
+    """
+    Dispatches the received elements from a pool of worker threads.
+
+    It is given to a blocking receiver in place of the
+    L{txosc.dispatch.Receiver}. The thread calling L{UdpReceiver.poll} or
+    L{TcpReceiver.poll} then only reads and decodes the packets, and puts
+    them in a bounded queue. The workers call the callbacks.
+
+    Here is an example on how to use it::
+
+      receiver = dispatch.Receiver()
+      receiver.addCallback("/ping", ping)
+      pool = ThreadPoolDispatcher(receiver, workers=4)
+      UdpReceiver(17779, pool).serve_forever()
+      pool.close()
+
+    Without ordering, the callbacks of consecutive elements may be called
+    at the same time, or in any order. With ordering, the messages are
+    queued for a worker chosen by their address, so that the messages of
+    an address are dispatched one after the other, in the order they were
+    received. The bundles are then split into their messages, in the
+    order of their elements.
+
+    The address tree of the receiver is made thread-safe, so that
+    callbacks can be added and removed while the workers dispatch. See
+    L{txosc.dispatch.AddressNode.setThreadSafe}. Make it copy-on-write
+    with L{txosc.dispatch.AddressNode.setCopyOnWrite} so that the workers
+    do not wait for each other to look up the callbacks.
+
+    @ivar receiver: The L{txosc.dispatch.Receiver}.
+    @ivar ordered: Whether the messages of an address are dispatched in
+        order.
+    @ivar overflowCount: Number of elements dropped because the queue was
+        full.
+    @ivar unhandled: The L{txosc.stats.FallbackCounter} of the unhandled
+        messages, or C{None} if the receiver has its own fallback.
+    """
+    def __init__(self, receiver, workers=4, maxQueueSize=1024, ordered=False):
+        """
+        @param receiver: L{txosc.dispatch.Receiver} instance.
+        @param workers: The number of worker threads.
+        @param maxQueueSize: The most elements waiting to be dispatched.
+            With ordering, it is the size of the queue of each worker.
+        @param ordered: Whether the messages of an address are
+            dispatched in order.
+        """
+        self.receiver = receiver
+        self.ordered = ordered
+        self.overflowCount = 0
+        receiver.setThreadSafe()
+        self.unhandled = _countUnhandled(receiver, threadSafe=True)
+        if ordered:
+            self._queues = [Queue.Queue(maxQueueSize) for i in range(workers)]
+        else:
+            self._queues = [Queue.Queue(maxQueueSize)]
+        # counted by each worker, so that no lock is needed
+        self._dispatched = [0] * workers
+        self._errors = [0] * workers
+        self._closed = False
+        self._threads = []
+        for index in range(workers):
+            queue = self._queues[index % len(self._queues)]
+            thread = threading.Thread(target=self._work, args=(index, queue), name="txosc worker %d" % (index,))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def dispatch(self, element, client):
+        """
+        Queues an element to be dispatched by a worker. It does not block:
+        the element is dropped if the queue is full.
+
+        @param element: A L{txosc.osc.Message} or L{txosc.osc.Bundle}.
+        @param client: The client given to the callbacks.
+        @return: Whether the element was queued. With ordering, whether
+            all its messages were queued.
+        @rtype: C{bool}
+        @raise RuntimeError: If the dispatcher is closed.
+        """
+        if self._closed:
+            raise RuntimeError("The dispatcher is closed.")
+        if not self.ordered:
+            return self._put(self._queues[0], element, client)
+        if isinstance(element, Bundle):
+            messages = _orderedMessages(element)
+        else:
+            messages = [element]
+        queued = True
+        queues = self._queues
+        for message in messages:
+            queue = queues[hash(message.address) % len(queues)]
+            queued = self._put(queue, message, client) and queued
+        return queued
+
+    def _put(self, queue, element, client):
+        try:
+            queue.put_nowait((element, client))
+        except Queue.Full:
+            self.overflowCount += 1
+            return False
+        return True
+
+    def _work(self, index, queue):
+        receiver = self.receiver
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            try:
+                receiver.dispatch(*item)
+            except Exception:
+                self._errors[index] += 1
+                traceback.print_exc()
+            self._dispatched[index] += 1
+
+    def getStats(self):
+        """
+        Returns the statistics of the dispatcher.
+
+        @return: C{dict} with the number of elements C{"queued"}, the
+            number C{"dispatched"} so far, the number of C{"overflows"},
+            and the number of C{"errors"} raised by callbacks. With
+            ordering, the messages of the bundles are counted instead.
+        @rtype: C{dict}
+        """
+        return {
+            "queued": sum([queue.qsize() for queue in self._queues]),
+            "dispatched": sum(self._dispatched),
+            "overflows": self.overflowCount,
+            "errors": sum(self._errors),
+            }
+
+    def close(self):
+        """
+        Dispatches the elements already queued, and stops the workers.
+        Call it once the receiver is not polled anymore.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for index in range(len(self._threads)):
+            self._queues[index % len(self._queues)].put(_STOP)
+        for thread in self._threads:
+            thread.join()
@@ -7,11 +7,17 @@ Tests for txosc/async.py
 Maintainer: Arjan Scherpenisse
 """
 
+import sys
+import socket
 from twisted.trial import unittest
-from twisted.internet import reactor, defer, task
+from twisted.internet import reactor, defer, task, error
+from twisted.python import failure, log
+from twisted.test import proto_helpers
 from txosc import osc
 from txosc import async
 from txosc import dispatch
+from txosc import framing
+from txosc import shm
 
 
 class ClientServerTests(object):
@@ -78,6 +84,233 @@ class TestUDPClientServer(unittest.TestCase, ClientServerTests):
     def _send(self, element):
         self.client.send(element, ("127.0.0.1", 17778))
 
+class TestBatchedUDPClientServer(TestUDPClientServer):
+    """
+    Test the L{async.listenUDPBatched} and L{dispatch.Receiver} over UDP via localhost.
+    """
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.serverPort = async.listenUDPBatched(17778, async.DatagramServerProtocol(self.receiver))
+        self.client = async.DatagramClientProtocol()
+        self.clientPort = reactor.listenUDP(0, self.client)
+
+
+    def testBatch(self):
+        if not isinstance(self.serverPort, async.BatchDatagramPort):
+            raise unittest.SkipTest("recvmmsg is not available")
+        d = defer.Deferred()
+        received = []
+        batches = []
+        protocol = self.serverPort.protocol
+        original = protocol.datagramsReceived
+        def datagramsReceived(datagrams):
+            batches.append(len(datagrams))
+            original(datagrams)
+        protocol.datagramsReceived = datagramsReceived
+        def ping(message, address):
+            received.append(message.getValues()[0])
+            if len(received) == 20:
+                d.callback(None)
+        self.receiver.addCallback("/ping", ping)
+        for i in range(20):
+            self._send(osc.Message("/ping", i))
+        def check(result):
+            self.assertEquals(received, range(20))
+            self.assertTrue(len(batches) < 20)
+        return d.addCallback(check)
+
+
+    def testCallbackError(self):
+        received = []
+        def ping(message, address):
+            received.append(message.getValues()[0])
+            if received[-1] == 1:
+                raise ValueError("bad ping")
+        self.receiver.addCallback("/ping", ping)
+        protocol = async.DatagramServerProtocol(self.receiver)
+        protocol.datagramsReceived([(osc.Message("/ping", i).toBinary(), ("127.0.0.1", 17779)) for i in range(5)])
+        self.assertEquals(received, range(5))
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+
+class TestReceiveStats(unittest.TestCase):
+    """
+    Test the receive buffer size and the statistics of the
+    L{async.DatagramServerProtocol}.
+    """
+    timeout = 2
+
+    if not sys.platform.startswith("linux"):
+        skip = "The kernel drops are only known on Linux"
+
+    def tearDown(self):
+        return self.serverPort.stopListening()
+
+
+    def _flood(self, listen):
+        self.receiver = dispatch.Receiver()
+        self.receiver.addCallback("/ping", lambda m, a: None)
+        protocol = async.DatagramServerProtocol(self.receiver, receiveBufferSize=4096)
+        self.serverPort = listen(0, protocol)
+        # the size is doubled by Linux
+        self.assertEquals(protocol.getReceiveBufferSize(), 8192)
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sender.close)
+        data = osc.Message("/ping").toBinary()
+        for i in range(200):
+            sender.sendto(data, ("127.0.0.1", self.serverPort.getHost().port))
+        def check(result):
+            stats = protocol.getStats()
+            self.assertTrue(stats["drops"] > 0)
+            self.assertEquals(stats["datagrams"] + stats["drops"], 200)
+            self.assertEquals(stats["bytes"], stats["datagrams"] * len(data))
+            self.assertTrue(stats["datagramsPerSecond"] > 0)
+            self.assertTrue(stats["dropsPerSecond"] > 0)
+            stats = protocol.getStats()
+            self.assertEquals(stats["dropsPerSecond"], 0.0)
+        return task.deferLater(reactor, 0.1, lambda: None).addCallback(check)
+
+
+    def testListenUDP(self):
+        return self._flood(lambda port, protocol: reactor.listenUDP(port, protocol, "127.0.0.1"))
+
+
+    def testBatched(self):
+        return self._flood(lambda port, protocol: async.listenUDPBatched(port, protocol, "127.0.0.1"))
+
+
+
+
+class TestReceiveBufferLimit(unittest.TestCase):
+    """
+    Test the warning of the L{async.DatagramServerProtocol} when the
+    receive buffer is smaller than requested.
+    """
+
+    if not sys.platform.startswith("linux"):
+        skip = "The doubling of the buffer size is specific to Linux"
+
+    def _checkLimit(self, reportedSize):
+        messages = []
+        observer = lambda event: messages.append(log.textFromEventDict(event))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        transport = proto_helpers.FakeDatagramTransport()
+        transport.socket = sock
+        protocol = async.DatagramServerProtocol(dispatch.Receiver(), receiveBufferSize=4096)
+        protocol.getReceiveBufferSize = lambda: reportedSize
+        protocol.makeConnection(transport)
+        return [m for m in messages if "receive buffer is limited" in m]
+
+
+    def testBufferLimit(self):
+        # the size is doubled by Linux: 8192 means that 4096 bytes were set
+        self.assertEquals(self._checkLimit(8192), [])
+        # capped by rmem_max, between the requested size and its double
+        self.assertEquals(len(self._checkLimit(6144)), 1)
+
+
+
+class TestUDPSendMany(unittest.TestCase):
+    """
+    Test the C{sendMany} method of the L{async.DatagramClientProtocol}
+    and the L{async.ConnectedDatagramClientProtocol}.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.serverPort = reactor.listenUDP(17778, async.DatagramServerProtocol(self.receiver))
+        self.clientPort = None
+
+
+    def tearDown(self):
+        return defer.DeferredList([self.serverPort.stopListening(), self.clientPort.stopListening()])
+
+
+    def _receive(self, count):
+        d = defer.Deferred()
+        received = []
+        def ping(message, address):
+            received.append(message.getValues()[0])
+            if len(received) == count:
+                d.callback(received)
+        self.receiver.addCallback("/ping", ping)
+        return d
+
+
+    def testSendMany(self):
+        client = async.DatagramClientProtocol()
+        self.clientPort = reactor.listenUDP(0, client)
+        d = self._receive(4)
+        elements = [osc.Message("/ping", 1), osc.Message("/ping", 2).toBinary()]
+        self.assertEquals(client.sendMany(elements, [("127.0.0.1", 17778)]), 2)
+        # localhost is not resolved yet
+        self.assertEquals(client.sendMany(elements, ("localhost", 17778)), 2)
+        d.addCallback(self.assertEquals, [1, 2, 1, 2])
+        return d
+
+
+    def testConnectedSendMany(self):
+        client = async.ConnectedDatagramClientProtocol(("127.0.0.1", 17778))
+        self.clientPort = reactor.listenUDP(0, client)
+        d = self._receive(4)
+        self.assertEquals(client.sendMany([osc.Message("/ping", 1), osc.Message("/ping", 2)]), 2)
+        self.assertRaises(osc.OscError, client.sendMany, [osc.Message("/ping", 3)], ("127.0.0.2", 17778))
+        def connected(result):
+            self.assertEquals(client.sendMany([osc.Message("/ping", 3), osc.Message("/ping", 4)], ("127.0.0.1", 17778)), 2)
+        client.deferred.addCallback(connected)
+        d.addCallback(self.assertEquals, [1, 2, 3, 4])
+        return d
+
+
+
+class TestConnectedUDPClientServer(unittest.TestCase, ClientServerTests):
+    """
+    Test the L{async.ConnectedDatagramClientProtocol} and L{dispatch.Receiver} over UDP via localhost.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.serverPort = reactor.listenUDP(17778, async.DatagramServerProtocol(self.receiver))
+        self.client = async.ConnectedDatagramClientProtocol(("localhost", 17778))
+        self.clientPort = reactor.listenUDP(0, self.client)
+        return self.client.deferred
+
+
+    def tearDown(self):
+        ports = [port for port in [self.serverPort, self.clientPort] if port is not None]
+        return defer.DeferredList([port.stopListening() for port in ports])
+
+
+    def _send(self, element):
+        self.client.send(element)
+
+
+    def testWrongAddress(self):
+        self.assertRaises(osc.OscError, self.client.send, osc.Message("/ping"), ("localhost", 17779))
+
+
+    def testConnectionRefused(self):
+        d = defer.Deferred()
+        self.client.setRefusedHandler(lambda: d.callback(self.client.refusedCount))
+        stopped = self.serverPort.stopListening()
+        self.serverPort = None
+        def send(ignored):
+            self._send(osc.Message("/ping"))
+            self._send(osc.Message("/ping"))
+            return d
+        stopped.addCallback(send)
+        stopped.addCallback(self.assertEquals, 1)
+        return stopped
+
+
+
 class TestMulticastClientServer(unittest.TestCase):
     """
     Test the L{osc.Sender} and two L{dispatch.Receiver} over Multicast UDP via 224.0.0.1.
@@ -142,6 +375,813 @@ class TestTCPClientServer(unittest.TestCase, ClientServerTests):
 
 
 
+class TestUNIXClientServer(unittest.TestCase, ClientServerTests):
+    """
+    Test the L{async.connectUNIX} and L{async.listenUNIX} functions.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        path = self.mktemp()
+        self.serverPort = async.listenUNIX(path, self.receiver)
+        self.client = async.connectUNIX(path)
+        return self.client.deferred
+
+
+    def tearDown(self):
+        self.client.connectedProtocol.transport.loseConnection()
+        return self.serverPort.stopListening()
+
+
+    def _send(self, element):
+        self.client.send(element)
+
+
+
+class TestUNIXDatagramClientServer(unittest.TestCase, ClientServerTests):
+    """
+    Test the L{async.connectUNIXDatagram} and L{async.listenUNIXDatagram} functions.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        path = self.mktemp()
+        self.serverPort = async.listenUNIXDatagram(path, self.receiver)
+        self.clientPath = self.mktemp()
+        self.client = async.connectUNIXDatagram(path, self.clientPath)
+
+
+    def tearDown(self):
+        return defer.DeferredList([self.serverPort.stopListening(), self.client.transport.stopListening()])
+
+
+    def _send(self, element):
+        self.client.send(element)
+
+
+    def testReply(self):
+        d = defer.Deferred()
+        def ping(message, address):
+            self.assertEquals(address, self.clientPath)
+            self.serverPort.write(osc.Message("/pong").toBinary(), address)
+        self.receiver.addCallback("/ping", ping)
+        self.client.datagramReceived = lambda data: d.callback(data)
+        self.client.send(osc.Message("/ping"))
+        return d.addCallback(self.assertEquals, osc.Message("/pong").toBinary())
+
+
+
+class TestRingClientServer(unittest.TestCase, ClientServerTests):
+    """
+    Test the L{async.RingReceiver} with a L{shm.RingWriter}.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.path = self.mktemp()
+        shm.createRing(self.path, 4096)
+        self.ring = async.RingReceiver(self.path, self.receiver)
+        self.ring.startReading()
+        self.writer = shm.RingWriter(self.path)
+
+
+    def tearDown(self):
+        self.ring.close()
+        self.writer.close()
+        shm.removeRing(self.path)
+
+
+    def _send(self, element):
+        self.writer.send(element)
+
+
+    def testPolling(self):
+        self.ring.stopReading()
+        self.ring.wakeup = False
+        self.ring.pollInterval = 0.001
+        self.ring.startReading()
+        d = defer.Deferred()
+        self.receiver.addCallback("/ping", lambda message, address: d.callback(message.getValues()))
+        self._send(osc.Message("/ping", 1))
+        self.assertEquals(self.ring.reactor.getReaders().count(self.ring), 0)
+        return d.addCallback(self.assertEquals, [1])
+
+
+    @defer.inlineCallbacks
+    def testWritersInARow(self):
+        # the ring is only read on wakeups
+        self.ring.stopReading()
+        self.ring.pollInterval = 10
+        self.ring.startReading()
+        received = defer.DeferredQueue()
+        self.receiver.addCallback("/ping", lambda message, address: received.put(message.getValues()))
+        for i in range(2):
+            self._send(osc.Message("/ping", i))
+            self.assertEquals((yield received.get()), [i])
+            self.writer.close()
+            self.writer = shm.RingWriter(self.path)
+            yield task.deferLater(reactor, 0.01, lambda: None)
+            self.assertEquals(self.ring.reactor.getReaders().count(self.ring), 1)
+
+
+    def testCallbackError(self):
+        received = []
+        def ping(message, address):
+            received.append(message.getValues()[0])
+            if received[-1] == 1:
+                raise ValueError("bad ping")
+        self.receiver.addCallback("/ping", ping)
+        for i in range(4):
+            self._send(osc.Message("/ping", i))
+        self.ring.readRing()
+        self.assertEquals(received, range(4))
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertTrue(self.ring._poll.running)
+        self._send(osc.Message("/ping", 4))
+        self.ring.readRing()
+        self.assertEquals(received, range(5))
+
+
+    def testUnorderedMachine(self):
+        self.patch(shm.platform, "machine", lambda: "armv7l")
+        self.assertRaises(osc.OscError, shm.RingWriter, self.path)
+
+
+    def testOverflow(self):
+        big = osc.Message("/big", "x" * 990).toBinary()
+        sent = 0
+        while self.writer.sendBinary(big):
+            sent += 1
+        self.assertFalse(self.writer.sendBinary(big))
+        d = defer.Deferred()
+        received = []
+        def gotBig(message, address):
+            received.append(message)
+            if len(received) == sent:
+                d.callback(None)
+        self.receiver.addCallback("/big", gotBig)
+        def check(result):
+            self.assertEquals(self.ring.getStats(), {"packets": sent, "bytes": sent * len(big), "drops": 2, "pending": 0})
+        return d.addCallback(check)
+
+
+class TestConnectionPool(unittest.TestCase):
+    """
+    Test the L{async.ConnectionPool} with local TCP servers.
+    """
+    timeout = 2
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.received = defer.DeferredQueue()
+        self.receiver.addCallback("/ping", lambda message, client: self.received.put(message.getValues()))
+        self.serverFactory = async.ServerFactory(self.receiver)
+        self.serverPort = reactor.listenTCP(0, self.serverFactory, interface="127.0.0.1")
+        self.destination = ("127.0.0.1", self.serverPort.getHost().port)
+        self.pool = async.ConnectionPool()
+        self.pool.initialDelay = 0.01
+
+
+    def tearDown(self):
+        d = self.pool.closeAll()
+        d.addCallback(lambda result: self.serverPort.stopListening())
+        return d
+
+
+    @defer.inlineCallbacks
+    def testQueueWhileConnecting(self):
+        self.pool.maxQueueSize = 2
+        sent = [self.pool.send(osc.Message("/ping", i), self.destination) for i in range(3)]
+        self.assertEquals(self.pool.getStats()["queued"], 2)
+        self.assertEquals(self.pool.getStats()["connecting"], 1)
+        results = yield defer.gatherResults(sent)
+        self.assertEquals(results, [True, True, False])
+        self.assertEquals((yield self.received.get()), [0])
+        self.assertEquals((yield self.received.get()), [1])
+        protocol = yield self.pool.getProtocol(self.destination)
+        self.assertIdentical(protocol, self.pool._factories[self.destination].connectedProtocol)
+        yield self.pool.send(osc.Message("/ping", 3), self.destination)
+        self.assertEquals((yield self.received.get()), [3])
+        stats = self.pool.getStats()
+        self.assertEquals((stats["connections"], stats["connects"], stats["dropped"]), (1, 1, 1))
+        self.assertEquals(stats["destinations"][self.destination]["sent"], 3)
+
+
+    @defer.inlineCallbacks
+    def testReconnect(self):
+        protocol = yield self.pool.getProtocol(self.destination)
+        for server in list(self.serverFactory.connectedProtocols):
+            server.transport.loseConnection()
+        d = defer.Deferred()
+        protocol.connectionLost = lambda reason, lost=protocol.connectionLost: (lost(reason), d.callback(None))
+        yield d
+        sent = self.pool.send(osc.Message("/ping", 1), self.destination)
+        self.assertEquals(self.pool.getStats()["queued"], 1)
+        self.assertEquals((yield sent), True)
+        self.assertEquals((yield self.received.get()), [1])
+        self.assertEquals(self.pool.getStats()["connects"], 2)
+
+
+    @defer.inlineCallbacks
+    def testGiveUp(self):
+        self.pool.maxRetries = 1
+        port = self.destination[1]
+        yield self.serverPort.stopListening()
+        self.serverPort = reactor.listenTCP(0, self.serverFactory, interface="127.0.0.1")
+        destination = ("127.0.0.1", port)
+        sent = self.pool.send(osc.Message("/ping"), destination)
+        connected = self.pool.getProtocol(destination)
+        self.assertEquals((yield sent), False)
+        yield self.assertFailure(connected, error.ConnectionRefusedError)
+        stats = self.pool.getStats()
+        self.assertEquals((stats["failures"], stats["dropped"], stats["destinations"]), (2, 1, {}))
+
+
+    @defer.inlineCallbacks
+    def testIdleReaping(self):
+        self.pool.idleTimeout = 0.05
+        yield self.pool.getProtocol(self.destination)
+        d = defer.Deferred()
+        reactor.callLater(0.2, d.callback, None)
+        yield d
+        stats = self.pool.getStats()
+        self.assertEquals((stats["reaped"], stats["connections"], stats["connecting"]), (1, 0, 0))
+        self.assertEquals(len(self.serverFactory.connectedProtocols), 0)
+
+
+    @defer.inlineCallbacks
+    def testProtocolTrafficIsNotIdle(self):
+        self.pool.idleTimeout = 0.1
+        self.pool.receiver = dispatch.Receiver()
+        self.pool.receiver.addCallback("/pong", lambda message, client: None)
+        protocol = yield self.pool.getProtocol(self.destination)
+        # used directly, then only receiving
+        for i in range(4):
+            yield task.deferLater(reactor, 0.05, protocol.send, osc.Message("/ping", i))
+            self.assertEquals((yield self.received.get()), [i])
+        server = list(self.serverFactory.connectedProtocols)[0]
+        for i in range(4):
+            yield task.deferLater(reactor, 0.05, server.send, osc.Message("/pong", i))
+        self.assertEquals(self.pool.getStats()["reaped"], 0)
+        self.assertIdentical((yield self.pool.getProtocol(self.destination)), protocol)
+        yield task.deferLater(reactor, 0.3, lambda: None)
+        self.assertEquals(self.pool.getStats()["reaped"], 1)
+
+
+    @defer.inlineCallbacks
+    def testCloseWhileConnecting(self):
+        sent = self.pool.send(osc.Message("/ping"), self.destination)
+        connected = self.pool.getProtocol(self.destination)
+        yield self.pool.close(self.destination)
+        self.assertEquals((yield sent), False)
+        yield self.assertFailure(connected, osc.OscError)
+        d = defer.Deferred()
+        reactor.callLater(0.05, d.callback, None)
+        yield d
+        stats = self.pool.getStats()
+        self.assertEquals((stats["connects"], stats["failures"], stats["destinations"]), (0, 0, {}))
+        self.assertEquals(len(self.serverFactory.connectedProtocols), 0)
+
+
+class TestStreamBasedProtocol(unittest.TestCase):
+    """
+    Test the L{async.StreamBasedProtocol} with a fake transport.
+    """
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.factory = async.ServerFactory(self.receiver)
+        self.protocol = self.factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+
+    def testManyElementsInOneChunk(self):
+        received = []
+        self.receiver.addCallback("/ping", lambda m, a: received.append(m))
+        framer = self.protocol._framer
+        data = "".join(["".join(framer.frame(osc.Message("/ping", i).toBinary())) for i in range(5000)])
+        self.protocol.dataReceived(data)
+        self.assertEquals(len(received), 5000)
+        self.assertEquals(received[-1], osc.Message("/ping", 4999))
+
+
+    def testCoalescing(self):
+        clock = task.Clock()
+        self.factory.clock = clock
+        self.factory.setCoalescing(maxBytes=100)
+        self.protocol.send(osc.Message("/ping"))
+        self.protocol.send(osc.Message("/ping"))
+        self.assertEquals(self.transport.value(), "")
+        clock.advance(0)
+        self.assertEquals(len(self.transport.value()), 2 * 16)
+        self.assertEquals(self.factory.getWriteStats(), {"messages": 2, "dropped": 0, "writes": 1, "bytes": 32})
+
+        self.transport.clear()
+        for i in range(7):
+            self.protocol.send(osc.Message("/ping"))
+        self.assertEquals(len(self.transport.value()), 7 * 16)
+        self.assertEquals(self.factory.writesFlushed, 2)
+        clock.advance(0)
+        self.assertEquals(self.factory.writesFlushed, 2)
+
+
+    def testCoalescingDelay(self):
+        clock = task.Clock()
+        self.factory.clock = clock
+        self.factory.setCoalescing(delay=0.01)
+        self.protocol.send(osc.Message("/ping"))
+        clock.advance(0.005)
+        self.protocol.send(osc.Message("/ping"))
+        self.assertEquals(self.transport.value(), "")
+        clock.advance(0.005)
+        self.assertEquals(len(self.transport.value()), 2 * 16)
+        self.protocol.send(osc.Message("/ping"))
+        self.factory.flush()
+        self.assertEquals(len(self.transport.value()), 3 * 16)
+        self.assertEquals(clock.getDelayedCalls(), [])
+
+
+    def testNoDelay(self):
+        calls = []
+        self.transport.setTcpNoDelay = calls.append
+        self.factory.setNoDelay(True)
+        self.assertEquals(calls, [True])
+
+
+    def testFrameTooLarge(self):
+        self.factory.maxFrameSize = 16
+        protocol = self.factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived("\0\0\0\x20")
+        self.assertTrue(transport.disconnecting)
+
+
+    def testOutboundBufferLimit(self):
+        self.factory.maxOutboundBuffer = 40
+        self.protocol.pauseProducing()
+        for i in range(3):
+            self.protocol.send(osc.Message("/ping"))
+        self.assertEquals(self.transport.value(), "")
+        self.assertEquals(self.protocol.getPendingSize(), 32)
+        self.assertEquals(self.factory.messagesDropped, 1)
+        self.protocol.resumeProducing()
+        self.assertEquals(len(self.transport.value()), 32)
+        self.assertEquals(self.protocol.getPendingSize(), 0)
+
+
+    def testSendDeferred(self):
+        results = []
+        self.protocol.send(osc.Message("/ping")).addCallback(results.append)
+        self.assertEquals(results, [True])
+        self.factory.maxOutboundBuffer = 16
+        self.protocol.pauseProducing()
+        self.protocol.send(osc.Message("/ping")).addCallback(results.append)
+        self.protocol.send(osc.Message("/ping")).addCallback(results.append)
+        self.assertEquals(results, [True, False])
+        self.protocol.resumeProducing()
+        self.assertEquals(results, [True, False, True])
+
+
+    def testWatermarks(self):
+        self.factory.highWatermark = 48
+        self.factory.lowWatermark = 16
+        calls = []
+        class Producer(object):
+            def pauseProducing(self):
+                calls.append("pause")
+            def resumeProducing(self):
+                calls.append("resume")
+        self.protocol.registerProducer(Producer(), True)
+        self.protocol.pauseProducing()
+        self.assertEquals(calls, ["pause"])
+        self.assertFalse(self.protocol.isWritable())
+        writable = []
+        self.protocol.whenWritable().addCallback(writable.append)
+        for i in range(3):
+            self.protocol.write(osc.Message("/ping").toBinary())
+        self.assertEquals(calls, ["pause"])
+        self.protocol.resumeProducing()
+        self.assertEquals(len(self.transport.value()), 3 * 16)
+        self.assertEquals(calls, ["pause", "resume"])
+        self.assertEquals(writable, [None])
+        self.assertTrue(self.protocol.isWritable())
+
+        # pending data above the high watermark pauses the producer too
+        self.factory.setCoalescing(maxBytes=1000)
+        self.factory.clock = task.Clock()
+        for i in range(3):
+            self.protocol.send(osc.Message("/ping"))
+        self.assertEquals(calls, ["pause", "resume", "pause"])
+        self.factory.flush()
+        self.assertEquals(calls, ["pause", "resume", "pause", "resume"])
+        self.protocol.unregisterProducer()
+
+
+    def testWhenWritableConnectionLost(self):
+        self.protocol.pauseProducing()
+        d = self.protocol.whenWritable()
+        results = []
+        self.protocol.send(osc.Message("/ping")).addCallback(results.append)
+        self.protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEquals(results, [False])
+        return self.assertFailure(d, error.ConnectionDone)
+
+
+    def testBroadcast(self):
+        received = []
+        self.receiver.addCallback("/ping", lambda m, client: client.send(osc.Message("/pong")))
+        transports = [self.transport]
+        for i in range(2):
+            protocol = self.factory.buildProtocol(None)
+            transport = proto_helpers.StringTransport()
+            protocol.makeConnection(transport)
+            transports.append(transport)
+        self.assertEquals(len(self.factory.connectedProtocols), 3)
+        self.assertEquals(self.factory.broadcast(osc.Message("/all")), 3)
+        frame = "".join(self.protocol._framer.frame(osc.Message("/all").toBinary()))
+        self.assertEquals([t.value() for t in transports], [frame] * 3)
+
+        # replies go to the client which sent the message
+        for t in transports:
+            t.clear()
+        self.protocol.dataReceived("".join(self.protocol._framer.frame(osc.Message("/ping").toBinary())))
+        self.assertEquals(transports[0].value(), "".join(self.protocol._framer.frame(osc.Message("/pong").toBinary())))
+        self.assertEquals(transports[1].value(), "")
+
+        self.protocol.connectionLost(None)
+        self.assertEquals(len(self.factory.connectedProtocols), 2)
+        self.assertTrue(self.factory.connectedProtocol in self.factory.connectedProtocols)
+
+
+
+class TestServerLimits(unittest.TestCase):
+    """
+    Test the limits of the L{async.ServerFactory} with fake transports.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = async.ServerFactory(dispatch.Receiver())
+        self.factory.clock = self.clock
+
+
+    def _connect(self):
+        protocol = self.factory.buildProtocol(None)
+        if protocol is None:
+            return None
+        protocol.makeConnection(proto_helpers.StringTransport())
+        return protocol
+
+
+    def _disconnect(self, protocol):
+        protocol.connectionLost(failure.Failure(error.ConnectionDone()))
+
+
+    def testMaxConnections(self):
+        self.factory.setLimits(maxConnections=2)
+        first = self._connect()
+        self._connect()
+        self.assertIdentical(self._connect(), None)
+        self._disconnect(first)
+        self.assertNotIdentical(self._connect(), None)
+        self.assertEquals(self.factory.getConnectionStats(), {"connections": 2, "accepted": 3, "rejected": 1, "reaped": 0, "overflowed": 0})
+
+
+    def testIdleTimeout(self):
+        self.factory.setLimits(idleTimeout=10)
+        active = self._connect()
+        idle = self._connect()
+        self.clock.advance(6)
+        active.dataReceived("\0\0")
+        self.clock.advance(4)
+        self.assertTrue(idle.transport.disconnecting)
+        self.assertFalse(active.transport.disconnecting)
+        self._disconnect(idle)
+        self.clock.advance(6)
+        self.assertTrue(active.transport.disconnecting)
+        self._disconnect(active)
+        self.assertEquals(self.factory.getConnectionStats()["reaped"], 2)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+
+
+    def testKeepalive(self):
+        self.factory.setLimits(idleTimeout=10, keepaliveInterval=4)
+        protocol = self._connect()
+        ping = "".join(protocol._framer.frame(osc.Message("/ping").toBinary()))
+        self.clock.advance(3)
+        self.assertEquals(protocol.transport.value(), "")
+        self.clock.advance(1)
+        self.assertEquals(protocol.transport.value(), ping)
+        self.clock.advance(4)
+        self.assertEquals(protocol.transport.value(), ping * 2)
+        protocol.dataReceived("".join(protocol._framer.frame(osc.Message("/pong").toBinary())))
+        self.clock.advance(3)
+        self.assertEquals(protocol.transport.value(), ping * 2)
+        self.clock.advance(1)
+        self.assertEquals(protocol.transport.value(), ping * 3)
+        self.clock.advance(6)
+        self.assertTrue(protocol.transport.disconnecting)
+
+
+    def testPendingOverflow(self):
+        self.factory.setLimits(maxPendingSize=100)
+        protocol = self._connect()
+        protocol.pauseProducing()
+        # each frame is 16 bytes
+        for i in range(6):
+            protocol.send(osc.Message("/ping"))
+        self.assertFalse(protocol.transport.disconnecting)
+        d = protocol.send(osc.Message("/ping"))
+        self.assertTrue(protocol.transport.disconnecting)
+        self._disconnect(protocol)
+        self.assertEquals(self.successResultOf(d), False)
+
+        protocol = self._connect()
+        protocol.dataReceived("\0\0\0\xff" + "x" * 96)
+        self.assertFalse(protocol.transport.disconnecting)
+        protocol.dataReceived("x")
+        self.assertTrue(protocol.transport.disconnecting)
+        self._disconnect(protocol)
+
+        # the complete packets received with the overflow are dispatched
+        received = []
+        self.factory.receiver.addCallback("/ping", lambda message, client: received.append(message))
+        protocol = self._connect()
+        ping = "".join(protocol._framer.frame(osc.Message("/ping").toBinary()))
+        protocol.dataReceived(ping * 2 + "\0\0\0\xff" + "x" * 97)
+        self.assertTrue(protocol.transport.disconnecting)
+        self.assertEquals(received, [osc.Message("/ping")] * 2)
+        self.assertEquals(self.factory.getConnectionStats()["overflowed"], 3)
+
+
+class TestSLIPClientServer(unittest.TestCase, ClientServerTests):
+    """
+    Test the L{async.ClientFactory} and L{async.ServerFactory} with the
+    SLIP framing, over TCP via localhost.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.serverPort = reactor.listenTCP(17778, async.ServerFactory(self.receiver, framer=framing.SLIPFramer))
+        self.client = async.ClientFactory(framer=framing.SLIPFramer)
+        self.clientPort = reactor.connectTCP("localhost", 17778, self.client)
+        return self.client.deferred
+
+
+    def tearDown(self):
+        self.clientPort.transport.loseConnection()
+        return defer.DeferredList([self.serverPort.stopListening()])
+
+
+    def _send(self, element):
+        self.client.send(element)
+
+
+
+class FakeResolvingReactor(task.Clock):
+    """
+    A fake reactor which resolves host names when told to.
+    """
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.lookups = []
+
+    def resolve(self, name):
+        d = defer.Deferred()
+        self.lookups.append((name, d))
+        return d
+
+
+
+class TestHostResolver(unittest.TestCase):
+    """
+    Test the L{async.HostResolver} and its use by L{async.DatagramClientProtocol}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeResolvingReactor()
+        self.resolver = async.HostResolver(ttl=10.0)
+        self.resolver.reactor = self.reactor
+        self.client = async.DatagramClientProtocol()
+        self.client.resolver = self.resolver
+        self.transport = proto_helpers.FakeDatagramTransport()
+        self.client.makeConnection(self.transport)
+
+
+    def testLiteralAddress(self):
+        self.assertEquals(self.resolver.getCachedAddress("10.0.0.1"), "10.0.0.1")
+        self.assertEquals(self.resolver.getCachedAddress("::1"), "::1")
+        self.client.send(osc.Message("/foo"), ("10.0.0.1", 17778))
+        self.assertEquals(self.reactor.lookups, [])
+        self.assertEquals(self.transport.written, [(osc.Message("/foo").toBinary(), ("10.0.0.1", 17778))])
+
+
+    def testQueueDuringResolution(self):
+        self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        self.client.send(osc.Message("/bar"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 1)
+        self.assertEquals(self.transport.written, [])
+        self.reactor.lookups[0][1].callback("10.0.0.2")
+        self.assertEquals(self.transport.written, [
+            (osc.Message("/foo").toBinary(), ("10.0.0.2", 17778)),
+            (osc.Message("/bar").toBinary(), ("10.0.0.2", 17778))])
+        self.client.send(osc.Message("/baz"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 1)
+        self.assertEquals(len(self.transport.written), 3)
+
+
+    def testExpiry(self):
+        self.resolver.resolve("example.com")
+        self.reactor.lookups[0][1].callback("10.0.0.2")
+        self.reactor.advance(10.0)
+        self.assertEquals(self.resolver.getCachedAddress("example.com"), "10.0.0.2")
+        self.assertEquals(len(self.reactor.lookups), 2)
+        self.reactor.lookups[1][1].callback("10.0.0.3")
+        self.assertEquals(self.resolver.getCachedAddress("example.com"), "10.0.0.3")
+
+
+    def testRefreshFailure(self):
+        self.resolver.resolve("example.com")
+        self.reactor.lookups[0][1].callback("10.0.0.2")
+        self.reactor.advance(10.0)
+        for i in range(3):
+            self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        # a single refresh, and no waiting deferred per packet
+        self.assertEquals(len(self.reactor.lookups), 2)
+        self.assertEquals(len(self.resolver._waiting["example.com"]), 1)
+        self.reactor.lookups[1][1].errback(ValueError("no such host"))
+        # the stale address is still used, and resolved again later
+        self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 2)
+        self.assertEquals(self.transport.written[-1][1], ("10.0.0.2", 17778))
+        self.reactor.advance(1.0)
+        self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 3)
+        self.reactor.lookups[2][1].errback(ValueError("no such host"))
+        self.reactor.advance(1.0)
+        self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 3)
+        self.reactor.advance(1.0)
+        self.client.send(osc.Message("/foo"), ("example.com", 17778))
+        self.assertEquals(len(self.reactor.lookups), 4)
+        self.reactor.lookups[3][1].callback("10.0.0.3")
+        self.assertEquals(self.resolver.getCachedAddress("example.com"), "10.0.0.3")
+        self.assertEquals(self.resolver._failures, {})
+
+
+    def testFailure(self):
+        self.client.send(osc.Message("/foo"), ("nowhere.invalid", 17778))
+        self.reactor.lookups[0][1].errback(ValueError("no such host"))
+        self.assertEquals(self.transport.written, [])
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+
+
+
+class TestConnectedDatagramResolution(unittest.TestCase):
+    """
+    Test the resolution of the destination of the
+    L{async.ConnectedDatagramClientProtocol}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeResolvingReactor()
+        self.client = async.ConnectedDatagramClientProtocol(("example.com", 17778), maxQueueSize=2)
+        self.client.reactor = self.reactor
+        self.client.makeConnection(proto_helpers.FakeDatagramTransport())
+        self.reactor.advance(0)
+
+
+    def testQueueLimit(self):
+        self.client.send(osc.Message("/foo"))
+        self.assertEquals(self.client.sendMany([osc.Message("/bar"), osc.Message("/baz")]), 1)
+        self.client.send(osc.Message("/egg"))
+        self.assertEquals(len(self.client._queue), 2)
+        self.assertEquals(self.client.droppedCount, 2)
+        self.assertEquals(self.client.resolver.reactor, self.reactor)
+
+
+    def testResolutionFailure(self):
+        self.client.send(osc.Message("/foo"))
+        self.reactor.lookups[0][1].errback(ValueError("no such host"))
+        self.assertEquals(self.client._queue, [])
+        self.assertRaises(osc.OscError, self.client.send, osc.Message("/bar"))
+        self.assertRaises(osc.OscError, self.client.sendMany, [osc.Message("/bar")])
+        self.assertEquals(self.client._queue, [])
+        return self.assertFailure(self.client.deferred, ValueError)
+
+
+
+class TestDatagramBundler(unittest.TestCase):
+    """
+    Test the L{async.DatagramBundler} with a fake client.
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.client = async.DatagramClientProtocol()
+        self.client.sendBinary = lambda data, address: self.sent.append((data, address))
+        self.clock = task.Clock()
+        self.bundler = async.DatagramBundler(self.client, mtu=200, delay=0.01)
+        self.bundler.clock = self.clock
+
+
+    def testDelay(self):
+        self.bundler.send(osc.Message("/foo"), ("127.0.0.1", 17778))
+        self.bundler.send(osc.Message("/bar"), ("127.0.0.1", 17778))
+        self.bundler.send(osc.Message("/baz"), ("127.0.0.1", 17779))
+        self.assertEquals(self.sent, [])
+        self.clock.advance(0.01)
+        self.assertEquals(len(self.sent), 2)
+        sent = dict([(address, data) for data, address in self.sent])
+        self.assertEquals(osc.Bundle.fromBinary(sent[("127.0.0.1", 17778)])[0].elements, [osc.Message("/foo"), osc.Message("/bar")])
+        self.assertEquals(sent[("127.0.0.1", 17779)], osc.Message("/baz").toBinary())
+
+
+    def testMtuAndFlush(self):
+        for i in range(10):
+            self.bundler.send(osc.Message("/foo", i), ("127.0.0.1", 17778))
+        self.assertEquals(len(self.sent), 1)
+        self.bundler.flush()
+        self.assertEquals(len(self.sent), 2)
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        received = []
+        for data, address in self.sent:
+            self.assertTrue(len(data) <= 200)
+            received.extend(osc.Bundle.fromBinary(data)[0].elements)
+        self.assertEquals(received, [osc.Message("/foo", i) for i in range(10)])
+
+
+
+class TestFanoutSender(unittest.TestCase):
+    """
+    Test the L{async.FanoutSender} with fake transports.
+    """
+
+    def setUp(self):
+        self.sent = []
+        self.client = async.DatagramClientProtocol()
+        self.client.sendBinary = lambda data, address: self.sent.append((data, address))
+        self.fanout = async.FanoutSender(self.client)
+
+
+    def _connectedFactory(self):
+        factory = async.ClientFactory()
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        return factory, transport
+
+
+    def testEncodeOnce(self):
+        encoded = []
+        message = osc.Message("/foo", 1)
+        toBinary = message.toBinary
+        def countingToBinary():
+            encoded.append(True)
+            return toBinary()
+        message.toBinary = countingToBinary
+        factory, transport = self._connectedFactory()
+        self.fanout.addDestination(("10.0.0.1", 17778))
+        self.fanout.addDestination(("10.0.0.2", 17778))
+        self.fanout.addDestination(factory)
+
+        self.assertEquals(self.fanout.send(message), 3)
+        self.assertEquals(len(encoded), 1)
+        self.assertEquals(sorted(self.sent), [(toBinary(), ("10.0.0.1", 17778)), (toBinary(), ("10.0.0.2", 17778))])
+        self.assertEquals(transport.value(), "\0\0\0\x10" + toBinary())
+
+
+    def testAddRemove(self):
+        self.fanout.addDestination(("10.0.0.1", 17778))
+        self.fanout.addDestination(["10.0.0.1", 17778])
+        self.assertEquals(self.fanout.getDestinations(), [("10.0.0.1", 17778)])
+        self.fanout.removeDestination(("10.0.0.1", 17778))
+        self.assertEquals(self.fanout.send(osc.Message("/foo")), 0)
+        self.assertRaises(KeyError, self.fanout.removeDestination, ("10.0.0.1", 17778))
+        self.assertRaises(osc.OscError, async.FanoutSender().addDestination, ("10.0.0.1", 17778))
+
+
+    def testErrorsAndDrops(self):
+        def failingSend(data, address):
+            raise ValueError("boom")
+        self.client.sendBinary = failingSend
+        self.fanout.addDestination(("10.0.0.1", 17778))
+        disconnected = async.ClientFactory()
+        self.fanout.addDestination(disconnected)
+        self.assertEquals(self.fanout.send(osc.Message("/foo")), 0)
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEquals(self.fanout.getStats(), {
+            ("10.0.0.1", 17778): {"sent": 0, "errors": 1, "drops": 0},
+            disconnected: {"sent": 0, "errors": 0, "drops": 1}})
+
+
+
 class TestReceiverWithExternalClient(unittest.TestCase):
     """
     This test needs python-liblo.
@@ -7,6 +7,8 @@ Tests for txosc/dispatch.py
 Maintainer: Arjan Scherpenisse
 """
 
+import threading
+import sys
 from twisted.trial import unittest
 from twisted.internet import reactor, defer, task
 from txosc import osc
@@ -300,6 +302,139 @@ class TestAddressNode(unittest.TestCase):
         self.assertEquals(parent.getCallbacks("/foo/bar"), set([]))
         self.assertEquals(parent.getCallbacks("/baz/foo/bar"), set([cb]))
 
+    def testTypeTagsSignature(self):
+
+        def untyped(m):
+            pass
+        def floats(m):
+            pass
+        def ints(m):
+            pass
+        n = dispatch.AddressNode()
+        n.addCallback("/foo", untyped)
+        n.addCallback("/foo", floats, "ff")
+        n.addCallback("/foo", ints, "i")
+
+        self.assertEquals(n.matchCallbacks(osc.Message("/foo", 1.0, 2.0)), set([untyped, floats]))
+        self.assertEquals(n.matchCallbacks(osc.Message("/foo", 1)), set([untyped, ints]))
+        self.assertEquals(n.matchCallbacks(osc.Message("/foo")), set([untyped]))
+        self.assertEquals(n.getCallbacks("/foo"), set([untyped, floats, ints]))
+
+        n.removeCallback("/foo", floats, "ff")
+        self.assertEquals(n.matchCallbacks(osc.Message("/foo", 1.0, 2.0)), set([untyped]))
+        self.assertRaises(KeyError, n.removeCallback, "/foo", ints, "ff")
+        n.removeCallback("/foo", untyped)
+        n.removeCallback("/foo", ints, "i")
+        self.assertEquals(n.getCallbacks("/*"), set())
+
+    def testThreadSafe(self):
+        """
+        The callbacks can be added and removed from a thread while another
+        one looks them up.
+        """
+        def cb(m):
+            pass
+        parent = dispatch.AddressNode()
+        parent.setThreadSafe()
+        child = dispatch.AddressNode()
+        parent.addNode("child", child)
+        self.assertIdentical(child._getLock(), parent._lock)
+        errors = []
+        def change():
+            try:
+                for i in range(1000):
+                    child.addCallback("/foo/%d" % (i,), cb)
+                    parent.addCallback("/bar/%d" % (i,), cb)
+                    child.removeCallback("/foo/%d" % (i,), cb)
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target=change)
+        thread.start()
+        try:
+            while thread.isAlive():
+                parent.getCallbacks("/child/foo/*")
+                parent.getCallbacks("/bar/*")
+        finally:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(parent.getCallbacks("/bar/*")), 1)
+        self.assertEquals(len(parent.match("/bar/*")), 1000)
+        self.assertEquals(parent.getCallbacks("/child/foo/*"), set())
+
+    def testCopyOnWrite(self):
+        def cb(m):
+            pass
+        def floats(m):
+            pass
+        parent = dispatch.AddressNode()
+        parent.addCallback("/foo/bar", cb)
+        parent.setCopyOnWrite()
+        parent.addCallback("/foo/*", floats, "ff")
+        parent.addCallback("/egg/spam", cb)
+        child = dispatch.AddressNode()
+        child.addCallback("/ham", cb)
+        parent.addNode("child", child)
+        self.assertEquals(parent.getCallbacks("/foo/bar"), set([cb, floats]))
+        self.assertEquals(parent.getCallbacks("/foo/bar", "i"), set([cb]))
+        self.assertEquals(parent.getCallbacks("/*/*"), set([cb, floats]))
+        self.assertEquals(parent.getCallbacks("/child/ham"), set([cb]))
+        self.assertEquals(child.getCallbacks("/ham"), set([cb]))
+        self.assertEquals(parent.match("/child"), set([child]))
+
+        # only the nodes on the changed path are copied
+        before = parent._snapshot
+        child.addCallback("/ham", floats, "ff")
+        after = parent._snapshot
+        self.assertNotIdentical(before, after)
+        self.assertIdentical(before.children["foo"], after.children["foo"])
+        self.assertNotIdentical(before.children["child"], after.children["child"])
+        self.assertEquals(parent.getCallbacks("/child/ham", "ff"), set([cb, floats]))
+        # the previous snapshot is unchanged
+        self.assertEquals(before.getCallbacks(["child", "ham"], "ff"), set([cb]))
+
+        parent.removeCallback("/foo/*", floats, "ff")
+        parent.removeCallback("/foo/bar", cb)
+        self.assertEquals(parent.getCallbacks("/foo/*"), set())
+        self.assertEquals(parent._snapshot.children.keys(), parent._childNodes.keys())
+        child.removeAllCallbacks()
+        self.assertEquals(parent.getCallbacks("/child/ham"), set())
+        self.assertEquals(sorted(parent._snapshot.children.keys()), ["egg"])
+
+        parent.setCopyOnWrite(False)
+        self.assertIdentical(parent._snapshot, None)
+        self.assertEquals(parent.getCallbacks("/egg/spam"), set([cb]))
+
+
+    def testCopyOnWriteThreads(self):
+        """
+        The callbacks can be added and removed from a thread while another
+        one looks them up without locking.
+        """
+        def cb(m):
+            pass
+        parent = dispatch.AddressNode()
+        parent.setCopyOnWrite()
+        errors = []
+        def change():
+            try:
+                for i in range(1000):
+                    parent.addCallback("/foo/%d" % (i,), cb)
+                    parent.addCallback("/bar/%d" % (i,), cb)
+                    parent.removeCallback("/foo/%d" % (i,), cb)
+            except Exception, e:
+                errors.append(e)
+        thread = threading.Thread(target=change)
+        thread.start()
+        try:
+            while thread.isAlive():
+                parent.getCallbacks("/foo/*")
+                parent.getCallbacks("/bar/*")
+        finally:
+            thread.join()
+        self.assertEquals(errors, [])
+        self.assertEquals(len(parent.match("/bar/*")), 1000)
+        self.assertEquals(parent.getCallbacks("/foo/*"), set())
+
     testRemoveCallbacksByPattern.skip = "This feature is not implemented."
 
 
@@ -336,6 +471,62 @@ class TestReceiver(unittest.TestCase):
         self.assertEquals(state, {'cb': True, 'cb2': True})
 
 
+    def testDispatchingTypeTags(self):
+        addr = ("0.0.0.0", 17778)
+        called = []
+
+        def floats(message, a):
+            called.append("floats")
+        def fallback(message, a):
+            called.append("fallback")
+
+        recv = dispatch.Receiver()
+        recv.addCallback("/pos", floats, "fff")
+        recv.setFallback(fallback)
+
+        recv.dispatch(osc.Message("/pos", 1.0, 2.0, 3.0), addr)
+        self.assertEquals(called, ["floats"])
+        called = []
+        recv.dispatch(osc.Message("/pos", 1.0, 2.0), addr)
+        self.assertEquals(called, ["fallback"])
+        called = []
+        message, leftover = osc.Message.fromBinary(osc.Message("/pos", 1.0, 2.0, 3.0).toBinary())
+        recv.dispatch(message, addr)
+        self.assertEquals(called, ["floats"])
+
+
+    def testDispatchMany(self):
+        called = []
+        recv = dispatch.Receiver()
+        recv.addCallback("/pos", lambda m, a: called.append((m.arguments[0].value, a)))
+        recv.setFallback(lambda m, a: called.append(("fallback", a)))
+        recv.dispatchMany([
+            (osc.Message("/pos", 1), "a"),
+            (osc.Bundle([osc.Message("/pos", 2)]), "b"),
+            (osc.Message("/other"), "b"),
+            (osc.Message("/pos", 3), "c"),
+            ])
+        self.assertEquals(called, [(1, "a"), (2, "b"), ("fallback", "b"), (3, "c")])
+
+
+    def testDispatchManyError(self):
+        called = []
+        errors = []
+        def pos(m, a):
+            called.append(m.getValues()[0])
+            if m.getValues()[0] == 1:
+                raise ValueError("bad position")
+        recv = dispatch.Receiver()
+        recv.addCallback("/pos", pos)
+        elements = [(osc.Message("/pos", i), None) for i in range(5)]
+        self.assertRaises(ValueError, recv.dispatchMany, elements)
+        self.assertEquals(called, [0, 1])
+        called = []
+        recv.dispatchMany(elements, lambda: errors.append(sys.exc_info()[0]))
+        self.assertEquals(called, range(5))
+        self.assertEquals(errors, [ValueError])
+
+
     def testFunctionFallback(self):
         hello = osc.Message("/hello")
         addr = ("0.0.0.0", 17778)
@@ -0,0 +1,102 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/framing.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+from twisted.trial import unittest
+from txosc import osc
+from txosc import framing
+
+
+class TestLengthPrefixedFramer(unittest.TestCase):
+    """
+    Test the L{framing.LengthPrefixedFramer} class.
+    """
+
+    def _encode(self, framer, packets):
+        return "".join(["".join(framer.frame(p)) for p in packets])
+
+
+    def testFrame(self):
+        framer = framing.LengthPrefixedFramer()
+        self.assertEquals(framer.frame("abcd"), ["\0\0\0\4", "abcd"])
+
+
+    def testSingleChunk(self):
+        framer = framing.LengthPrefixedFramer()
+        packets = ["abcd", "", "efghijkl"]
+        self.assertEquals(framer.feed(self._encode(framer, packets)), packets)
+        self.assertEquals(framer.getPendingSize(), 0)
+
+
+    def testByteByByte(self):
+        framer = framing.LengthPrefixedFramer()
+        packets = ["abcd", "efghijkl"]
+        received = []
+        for c in self._encode(framer, packets):
+            received.extend(framer.feed(c))
+        self.assertEquals(received, packets)
+
+
+    def testManyFramesInOneChunk(self):
+        framer = framing.LengthPrefixedFramer()
+        framer.compactThreshold = 16
+        packets = [osc.Message("/foo", i).toBinary() for i in range(10000)]
+        data = self._encode(framer, packets)
+        received = framer.feed(data[:-3])
+        self.assertEquals(len(received), 9999)
+        self.assertEquals(framer.getPendingSize(), 4 + len(packets[-1]) - 3)
+        received.extend(framer.feed(data[-3:]))
+        self.assertEquals(received, packets)
+
+
+    def testMaxFrameSize(self):
+        framer = framing.LengthPrefixedFramer(maxFrameSize=8)
+        self.assertEquals(framer.feed("".join(framer.frame("12345678"))), ["12345678"])
+        self.assertRaises(osc.OscError, framer.feed, "".join(framer.frame("123456789")))
+        framer = framing.LengthPrefixedFramer()
+        self.assertRaises(osc.OscError, framer.feed, "\xff\xff\xff\xff")
+
+
+
+class TestSLIPFramer(unittest.TestCase):
+    """
+    Test the L{framing.SLIPFramer} class.
+    """
+
+    def testFrame(self):
+        framer = framing.SLIPFramer()
+        self.assertEquals("".join(framer.frame("ab")), "\xc0ab\xc0")
+        self.assertEquals("".join(framer.frame("a\xc0b\xdb")), "\xc0a\xdb\xdcb\xdb\xdd\xc0")
+
+
+    def testRoundTrip(self):
+        framer = framing.SLIPFramer()
+        packets = ["abcd", "\xc0", "\xdb", "\xdb\xdc", "\xdb\xdd\xc0\xc0", osc.Message("/foo", 1, "\xc0").toBinary()]
+        data = "".join(["".join(framer.frame(p)) for p in packets])
+        self.assertEquals(framer.feed(data), packets)
+        self.assertEquals(framer.getPendingSize(), 0)
+
+        received = []
+        for c in data:
+            received.extend(framer.feed(c))
+        self.assertEquals(received, packets)
+
+
+    def testSingleEnded(self):
+        framer = framing.SLIPFramer()
+        self.assertEquals(framer.feed("abc\xc0def\xc0\xc0gh"), ["abc", "def"])
+        self.assertEquals(framer.getPendingSize(), 2)
+        self.assertEquals(framer.feed("i\xc0"), ["ghi"])
+
+
+    def testMaxFrameSize(self):
+        framer = framing.SLIPFramer(maxFrameSize=4)
+        self.assertEquals(framer.feed("\xc0\xdb\xdc\xdb\xdc\xdb\xdc\xdb\xdc\xc0"), ["\xc0\xc0\xc0\xc0"])
+        self.assertRaises(osc.OscError, framer.feed, "\xc012345\xc0")
+        framer = framing.SLIPFramer(maxFrameSize=4)
+        self.assertRaises(osc.OscError, framer.feed, "\xc0123456789")
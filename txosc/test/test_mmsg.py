@@ -0,0 +1,215 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/mmsg.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+import ctypes
+import errno
+import socket
+import struct
+from twisted.trial import unittest
+from txosc import osc
+from txosc import mmsg
+from txosc import stats
+
+
+class TestRecvBatch(unittest.TestCase):
+    """
+    Test the L{mmsg.RecvBatch} class with local sockets.
+    """
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.bind(("127.0.0.1", 0))
+
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+
+    def _check(self, batch):
+        self.assertEquals(batch.recv(self.server), [])
+        for i in range(5):
+            self.client.sendto("packet %d" % i, self.server.getsockname())
+        source = self.client.getsockname()
+        self.assertEquals(batch.recv(self.server), [("packet 0", source), ("packet 1", source), ("packet 2", source)])
+        self.assertEquals(batch.recv(self.server), [("packet 3", source), ("packet 4", source)])
+        self.assertEquals(batch.recv(self.server), [])
+
+
+    def testRecvmmsg(self):
+        if not mmsg.HAVE_RECVMMSG:
+            raise unittest.SkipTest("recvmmsg is not available")
+        self._check(mmsg.RecvBatch(batchSize=3))
+
+
+    def testFallback(self):
+        self._check(mmsg.RecvBatch(batchSize=3, useRecvmmsg=False))
+
+
+    def testFallbackWithoutDontwait(self):
+        self.patch(mmsg, "_MSG_DONTWAIT", 0)
+        self.server.setblocking(False)
+        self._check(mmsg.RecvBatch(batchSize=3, useRecvmmsg=False))
+
+
+    def testKernelDrops(self):
+        if not mmsg.HAVE_RECVMMSG:
+            raise unittest.SkipTest("recvmmsg is not available")
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.server.setsockopt(socket.SOL_SOCKET, mmsg.SO_RXQ_OVFL, 1)
+        batch = mmsg.RecvBatch()
+        for i in range(200):
+            self.client.sendto("flood", self.server.getsockname())
+        received = 0
+        while True:
+            datagrams = batch.recv(self.server)
+            if not datagrams:
+                break
+            received += len(datagrams)
+        # the counter is reported with the datagrams queued after the drops
+        self.client.sendto("last", self.server.getsockname())
+        self.assertEquals(len(batch.recv(self.server)), 1)
+        self.assertTrue(batch.drops > 0)
+        self.assertEquals(received + batch.drops, 200)
+        self.assertEquals(stats.readUdpDrops(self.server), batch.drops)
+
+
+    def testTruncation(self):
+        batch = mmsg.RecvBatch(maxPacketSize=4)
+        self.client.sendto("123456", self.server.getsockname())
+        self.assertEquals(batch.recv(self.server), [("1234", self.client.getsockname())])
+
+
+
+class TestSendBatch(unittest.TestCase):
+    """
+    Test the L{mmsg.SendBatch} class with local sockets.
+    """
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.setblocking(False)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+    def tearDown(self):
+        self.server.close()
+        self.client.close()
+
+
+    def testHeaderFormats(self):
+        if mmsg._mmsghdrFormat is None:
+            raise unittest.SkipTest("The message headers cannot be packed here")
+        self.assertEquals(struct.calcsize(mmsg._iovecFormat), ctypes.sizeof(mmsg._iovec))
+        self.assertEquals(struct.calcsize(mmsg._mmsghdrFormat), ctypes.sizeof(mmsg._mmsghdr))
+        header = mmsg._mmsghdr.from_buffer_copy(struct.pack(mmsg._mmsghdrFormat, 1, 2, 3, 4, 5, 6, 7, 8))
+        self.assertEquals(header.msg_hdr.msg_iovlen, 4)
+        self.assertEquals(header.msg_hdr.msg_flags, 7)
+        self.assertEquals(header.msg_len, 8)
+        # a format whose sizes do not match is refused
+        self.assertIdentical(mmsg._structFormat(mmsg._iovec, ["P", "B"]), None)
+
+
+    def testMakePackets(self):
+        a = ("127.0.0.1", 1)
+        b = ("127.0.0.1", 2)
+        ping = osc.Message("/ping").toBinary()
+        self.assertEquals(mmsg.makePackets([osc.Message("/ping"), "raw"], [a, b]), [(ping, a), (ping, b), ("raw", a), ("raw", b)])
+        self.assertEquals(mmsg.makePackets(["raw"], a), [("raw", a)])
+        self.assertEquals(mmsg.makePackets(["raw"], None), [("raw", None)])
+
+
+    def _check(self, useSendmmsg):
+        packets = [("packet %d" % i, self.server.getsockname()) for i in range(5)]
+        self.assertEquals(mmsg.SendBatch(useSendmmsg=useSendmmsg).send(self.client, packets), 5)
+        received = [self.server.recv(1024) for i in range(5)]
+        self.assertEquals(received, [data for data, address in packets])
+        self.assertRaises(socket.error, self.server.recv, 1024)
+
+        self.client.connect(self.server.getsockname())
+        self.assertEquals(mmsg.SendBatch(useSendmmsg=useSendmmsg).send(self.client, [("connected", None)]), 1)
+        self.assertEquals(self.server.recv(1024), "connected")
+
+
+    def testSendmmsg(self):
+        if not mmsg.HAVE_SENDMMSG:
+            raise unittest.SkipTest("sendmmsg is not available")
+        self._check(True)
+
+
+    def testFallback(self):
+        self._check(False)
+
+
+    def testBatches(self):
+        if not mmsg.HAVE_SENDMMSG:
+            raise unittest.SkipTest("sendmmsg is not available")
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other.bind(("127.0.0.1", 0))
+        other.setblocking(False)
+        self.addCleanup(other.close)
+        batch = mmsg.SendBatch(batchSize=2)
+        packets = [("a", self.server.getsockname()), ("bc", other.getsockname()), ("def", self.server.getsockname())]
+        self.assertEquals(batch.send(self.client, packets), 3)
+        self.assertEquals(batch.send(self.client, [("g", other.getsockname())]), 1)
+        self.assertEquals([self.server.recv(1024) for i in range(2)], ["a", "def"])
+        self.assertEquals([other.recv(1024) for i in range(2)], ["bc", "g"])
+
+
+    def testError(self):
+        packets = [("x" * 70000, self.server.getsockname())]
+        self.assertRaises(socket.error, mmsg.SendBatch().send, self.client, packets)
+        self.assertRaises(socket.error, mmsg.SendBatch(useSendmmsg=False).send, self.client, packets)
+        packets.insert(0, ("ok", self.server.getsockname()))
+        self.assertEquals(mmsg.SendBatch().send(self.client, packets), 1)
+
+
+
+class TestSendv(unittest.TestCase):
+    """
+    Test the L{mmsg.sendv} function with a pair of local sockets.
+    """
+
+    def setUp(self):
+        self.client, self.server = socket.socketpair()
+
+
+    def tearDown(self):
+        self.client.close()
+        self.server.close()
+
+
+    def _check(self, useWritev):
+        self.assertEquals(mmsg.sendv(self.client, ["abc", "", "de"], 0, useWritev), 5)
+        self.assertEquals(mmsg.sendv(self.client, ["abc", "de"], 2, useWritev), 3)
+        self.assertEquals(self.server.recv(1024), "abcdecde")
+
+
+    def testWritev(self):
+        if not mmsg.HAVE_WRITEV:
+            raise unittest.SkipTest("writev is not available")
+        self._check(True)
+
+
+    def testFallback(self):
+        self._check(False)
+
+
+    def testWouldBlock(self):
+        self.client.setblocking(False)
+        written = 0
+        try:
+            while True:
+                written += mmsg.sendv(self.client, ["x" * 65536, "y"])
+        except socket.error, e:
+            self.assertIn(e.args[0], (errno.EAGAIN, errno.EWOULDBLOCK))
+        self.assertTrue(written > 0)
@@ -266,6 +266,18 @@ class TestMessage(unittest.TestCase):
         self.assertEquals(m.getTypeTags(), "ss")
 
 
+    def testReplaceArgument(self):
+        m = osc.Message("/a", 1)
+        m.getTypeTags()
+        m.arguments[0] = osc.FloatArgument(1.0)
+        self.assertEquals(m.toBinary(), osc.Message("/a", 1.0).toBinary())
+        decoded = osc.Message.fromBinary(osc.Message("/a", 1, True).toBinary())[0]
+        self.assertEquals(decoded.getTypeTags(), "iT")
+        decoded.arguments[1] = osc.BooleanArgument(False)
+        self.assertEquals(decoded.getTypeTags(), "iF")
+        self.assertEquals(decoded.toBinary(), osc.Message("/a", 1, False).toBinary())
+
+
     def testToAndFromBinary(self):
 
         self.assertRaises(osc.OscError, osc.Message.fromBinary, "invalidbinarydata..")
@@ -352,3 +364,53 @@ class TestBundle(unittest.TestCase):
         b.add(osc.Bundle([m3]))
         self.assertEquals(b.getMessages(), set([m1, m2, m3]))
 
+
+
+
+class TestBundler(unittest.TestCase):
+    """
+    Test the L{osc.Bundler} class.
+    """
+
+    def testSingleElement(self):
+        bundler = osc.Bundler()
+        message = osc.Message("/foo", 1)
+        self.assertEquals(bundler.add(message), [])
+        self.assertEquals(bundler.getPendingCount(), 1)
+        self.assertEquals(bundler.flush(), [message.toBinary()])
+        self.assertEquals(bundler.flush(), [])
+
+
+    def testMtu(self):
+        bundler = osc.Bundler(mtu=100)
+        messages = [osc.Message("/foo", i) for i in range(20)]
+        packets = []
+        for m in messages:
+            packets.extend(bundler.add(m))
+        packets.extend(bundler.flush())
+        received = []
+        for packet in packets:
+            self.assertTrue(len(packet) <= 100)
+            bundle, leftover = osc.Bundle.fromBinary(packet)
+            received.extend(bundle.elements)
+        self.assertEquals(received, messages)
+
+
+    def testAtomicGroup(self):
+        bundler = osc.Bundler(mtu=100)
+        first = [osc.Message("/foo", i) for i in range(3)]
+        group = [osc.Message("/bar", i) for i in range(3)]
+        bundler.add(*first)
+        packets = bundler.add(*group)
+        self.assertEquals(len(packets), 1)
+        self.assertEquals(osc.Bundle.fromBinary(packets[0])[0].elements, first)
+        self.assertEquals(osc.Bundle.fromBinary(bundler.flush()[0])[0].elements, group)
+
+
+    def testGroupLargerThanMtu(self):
+        bundler = osc.Bundler(mtu=50)
+        group = [osc.Message("/bar", i) for i in range(5)]
+        packets = bundler.add(*group)
+        self.assertEquals(len(packets), 1)
+        self.assertEquals(osc.Bundle.fromBinary(packets[0])[0].elements, group)
+        self.assertEquals(bundler.getPendingCount(), 0)
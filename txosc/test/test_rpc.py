@@ -0,0 +1,283 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/rpc.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task, error
+from txosc import osc
+from txosc import async
+from txosc import dispatch
+from txosc import rpc
+
+
+class FakeConnection(object):
+    """
+    Keeps the elements sent, and dispatches them to a receiver when
+    L{deliver} is called.
+    """
+
+    def __init__(self, receiver, peer):
+        self.receiver = receiver
+        self.peer = peer
+        self.sent = []
+
+    def send(self, element):
+        self.sent.append(element)
+
+    def deliver(self):
+        sent = self.sent
+        self.sent = []
+        for element in sent:
+            self.receiver.dispatch(element, self.peer)
+
+
+
+class TestRpc(unittest.TestCase):
+    """
+    Test the L{rpc.RpcClient} and L{rpc.RpcResponder} classes with a fake
+    connection.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serverReceiver = dispatch.Receiver()
+        self.clientReceiver = dispatch.Receiver()
+        self.toServer = FakeConnection(self.serverReceiver, None)
+        self.toClient = FakeConnection(self.clientReceiver, self.toServer)
+        self.toServer.peer = self.toClient
+
+
+    def _makePair(self, correlation, window=32):
+        client = rpc.RpcClient(self.toServer, self.clientReceiver, correlation, window, timeout=1.0)
+        client.clock = self.clock
+        responder = rpc.RpcResponder(self.serverReceiver, correlation)
+        responder.addMethod("/add", lambda a, b: a + b)
+        responder.addMethod("/nothing", lambda: None)
+        responder.addMethod("/fail", lambda: 1 / 0)
+        return client, responder
+
+
+    def _roundTrip(self):
+        self.toServer.deliver()
+        self.toClient.deliver()
+
+
+    def _check(self, correlation):
+        client, responder = self._makePair(correlation)
+        results = []
+        client.call("/add", 1, 2).addCallback(results.append)
+        client.call("/nothing").addCallback(results.append)
+        client.call("/add", 3, 4).addCallback(results.append)
+        failures = []
+        client.call("/fail").addErrback(failures.append)
+        self.assertEquals(client.getPendingCount(), (4, 0))
+        self.clock.advance(0.25)
+        self._roundTrip()
+        self.assertEquals(results, [[3], [], [7]])
+        self.assertEquals(len(failures), 1)
+        failures[0].trap(rpc.RpcError)
+        self.assertEquals(client.getPendingCount(), (0, 0))
+        stats = client.getStats()
+        self.assertEquals(stats["replies"], 3)
+        self.assertEquals(stats["errors"], 1)
+        self.assertEquals(stats["latency"][None]["count"], 4)
+        self.assertEquals(stats["latency"][None]["max"], 0.25)
+        return client
+
+
+    def testCorrelateId(self):
+        self._check(rpc.CORRELATE_ID)
+        self.assertEquals(self.toServer.sent, [])
+
+
+    def testCorrelateAddress(self):
+        client = self._check(rpc.CORRELATE_ADDRESS)
+        # the reply callbacks are removed once no reply is expected
+        self.assertEquals(self.clientReceiver.getCallbacks("/add/reply"), set())
+
+
+    def testRequestMessages(self):
+        client, responder = self._makePair(rpc.CORRELATE_ID)
+        client.call("/add", 1, 2)
+        client.call("/add", 3, 4)
+        self.assertEquals(self.toServer.sent, [osc.Message("/add", 0, 1, 2), osc.Message("/add", 1, 3, 4)])
+        self.toServer.deliver()
+        self.assertEquals(self.toClient.sent, [osc.Message("/reply", 0, 3), osc.Message("/reply", 1, 7)])
+
+
+    def testWindow(self):
+        client, responder = self._makePair(rpc.CORRELATE_ID, window=2)
+        results = []
+        for i in range(5):
+            client.call("/add", i, 0).addCallback(results.append)
+        self.assertEquals(client.getPendingCount(), (2, 3))
+        self.assertEquals(len(self.toServer.sent), 2)
+        self._roundTrip()
+        self.assertEquals(client.getPendingCount(), (2, 1))
+        self._roundTrip()
+        self._roundTrip()
+        self.assertEquals(results, [[0], [1], [2], [3], [4]])
+        self.assertEquals(client.getPendingCount(), (0, 0))
+
+
+    def _checkTimeout(self, correlation):
+        client, responder = self._makePair(correlation, window=1)
+        first = client.call("/add", 1, 2)
+        second = client.call("/add", 3, 4, timeout=2.0)
+        self.clock.advance(1.0)
+        self.assertFailure(first, rpc.RpcTimeoutError)
+        # the queued call is sent once the first one has timed out
+        self.assertEquals(client.getPendingCount(), (1, 0))
+        results = []
+        second.addCallback(results.append)
+        self._roundTrip()
+        self.assertEquals(results, [[7]])
+        self.assertEquals(client.getStats()["timeouts"], 1)
+        self.assertEquals(client.getStats()["lateReplies"], 1)
+        return first
+
+
+    def testTimeoutId(self):
+        return self._checkTimeout(rpc.CORRELATE_ID)
+
+
+    def testTimeoutAddress(self):
+        return self._checkTimeout(rpc.CORRELATE_ADDRESS)
+
+
+    def testQueuedTimeout(self):
+        client, responder = self._makePair(rpc.CORRELATE_ID, window=1)
+        client.call("/add", 1, 2, timeout=None)
+        d = client.call("/add", 3, 4)
+        self.clock.advance(1.0)
+        self.assertEquals(client.getPendingCount(), (1, 0))
+        self.assertEquals(len(self.toServer.sent), 1)
+        return self.assertFailure(d, rpc.RpcTimeoutError)
+
+
+    def testFailPending(self):
+        client, responder = self._makePair(rpc.CORRELATE_ADDRESS, window=1)
+        first = client.call("/add", 1, 2)
+        second = client.call("/add", 3, 4)
+        client.failPending(osc.OscError("Connection lost"))
+        self.assertEquals(client.getPendingCount(), (0, 0))
+        self.assertEquals(self.clientReceiver.getCallbacks("/add/reply"), set())
+        self.assertEquals(self.clock.getDelayedCalls(), [])
+        return defer.DeferredList([self.assertFailure(first, osc.OscError), self.assertFailure(second, osc.OscError)])
+
+
+    def testOrderedReplies(self):
+        client, responder = self._makePair(rpc.CORRELATE_ADDRESS)
+        waiting = [defer.Deferred(), defer.Deferred()]
+        responder.addMethod("/slow", lambda i: waiting[i])
+        results = []
+        client.call("/slow", 0).addCallback(results.append)
+        client.call("/slow", 1).addCallback(results.append)
+        self.toServer.deliver()
+        waiting[1].callback("second")
+        self.assertEquals(self.toClient.sent, [])
+        waiting[0].callback("first")
+        self.toClient.deliver()
+        self.assertEquals(results, [["first"], ["second"]])
+
+
+    def testSharedReceiver(self):
+        for correlation in (rpc.CORRELATE_ID, rpc.CORRELATE_ADDRESS):
+            client, responder = self._makePair(correlation)
+            otherToServer = FakeConnection(self.serverReceiver, None)
+            otherToClient = FakeConnection(self.clientReceiver, otherToServer)
+            otherToServer.peer = otherToClient
+            other = rpc.RpcClient(otherToServer, self.clientReceiver, correlation)
+            results = []
+            client.call("/add", 1, 2).addCallback(results.append)
+            other.call("/add", 3, 4).addCallback(results.append)
+            otherToServer.deliver()
+            otherToClient.deliver()
+            self.assertEquals(results, [[7]])
+            self._roundTrip()
+            self.assertEquals(results, [[7], [3]])
+            self.assertEquals(client.getStats()["lateReplies"], 0)
+            self.assertEquals(other.getStats()["lateReplies"], 0)
+
+
+    def testPeer(self):
+        client, responder = self._makePair(rpc.CORRELATE_ID)
+        client.peer = ("127.0.0.1", 17779)
+        results = []
+        client.call("/add", 1, 2).addCallback(results.append)
+        self._roundTrip()
+        self.assertEquals(results, [])
+        self.clientReceiver.dispatch(osc.Message("/reply", 0, 3), ("127.0.0.1", 17779))
+        self.assertEquals(results, [[3]])
+
+
+    def testReplyToAddress(self):
+        replies = []
+        address = ("127.0.0.1", 17779)
+        requests = {rpc.CORRELATE_ID: osc.Message("/add", 0, 1, 2), rpc.CORRELATE_ADDRESS: osc.Message("/add", 1, 2)}
+        for correlation in (rpc.CORRELATE_ID, rpc.CORRELATE_ADDRESS):
+            serverReceiver = dispatch.Receiver()
+            responder = rpc.RpcResponder(serverReceiver, correlation)
+            responder.addMethod("/add", lambda a, b: a + b)
+            serverReceiver.dispatch(requests[correlation], address)
+            self.assertEquals(len(self.flushLoggedErrors(osc.OscError)), 1)
+            responder.sender = FakeConnection(None, None)
+            responder.sender.send = lambda element, destination: replies.append((element, destination))
+            serverReceiver.dispatch(requests[correlation], address)
+        self.assertEquals(replies, [(osc.Message("/reply", 0, 3), address), (osc.Message("/add/reply", 3), address)])
+
+
+    def testInvalidCorrelation(self):
+        self.assertRaises(ValueError, rpc.RpcClient, self.toServer, self.clientReceiver, "order")
+        self.assertRaises(ValueError, rpc.RpcResponder, self.serverReceiver, "order")
+
+
+
+class TestRpcOverTCP(unittest.TestCase):
+    """
+    Test the L{rpc.RpcClient} over a TCP connection.
+    """
+    timeout = 1
+
+    def setUp(self):
+        self.serverReceiver = dispatch.Receiver()
+        responder = rpc.RpcResponder(self.serverReceiver)
+        responder.addMethod("/echo", lambda *args: args)
+        self.serverPort = reactor.listenTCP(0, async.ServerFactory(self.serverReceiver), interface="127.0.0.1")
+        self.clientReceiver = dispatch.Receiver()
+        self.factory = async.ClientFactory(self.clientReceiver)
+        self.clientConnection = reactor.connectTCP("127.0.0.1", self.serverPort.getHost().port, self.factory)
+        return self.factory.deferred
+
+
+    def tearDown(self):
+        self.clientConnection.disconnect()
+        return self.serverPort.stopListening()
+
+
+    def testConnectionLost(self):
+        self.serverReceiver.addCallback("/never", lambda message, client: None)
+        client = rpc.RpcClient(self.factory, self.clientReceiver, window=1)
+        first = client.call("/never")
+        second = client.call("/never")
+        self.clientConnection.disconnect()
+        def check(result):
+            self.assertEquals(client.getPendingCount(), (0, 0))
+        d = defer.DeferredList([self.assertFailure(first, error.ConnectionDone), self.assertFailure(second, error.ConnectionDone)])
+        return d.addCallback(check)
+
+
+    def testPipelining(self):
+        client = rpc.RpcClient(self.factory, self.clientReceiver, window=8)
+        d = defer.gatherResults([client.call("/echo", i, "x") for i in range(100)])
+        def check(results):
+            self.assertEquals(results, [[i, "x"] for i in range(100)])
+            latency = client.getStats()["latency"]
+            self.assertEquals(latency.keys(), ["127.0.0.1:%d" % self.serverPort.getHost().port])
+            self.assertEquals(latency.values()[0]["count"], 100)
+        return d.addCallback(check)
@@ -0,0 +1,101 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/shm.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+import os
+import select
+from twisted.trial import unittest
+from txosc import osc
+from txosc import shm
+
+
+class TestRing(unittest.TestCase):
+    """
+    Test the L{shm.RingWriter} and L{shm.RingReader} classes.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        shm.createRing(self.path, 256)
+        self.writer = shm.RingWriter(self.path)
+        self.reader = shm.RingReader(self.path)
+
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        shm.removeRing(self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+
+    def testReadWrite(self):
+        self.assertEquals(self.reader.read(), [])
+        message = osc.Message("/foo", 1, "bar")
+        self.assertTrue(self.writer.send(message))
+        self.assertTrue(self.writer.sendBinary(""))
+        self.assertTrue(self.writer.sendBinary("abcde"))
+        self.assertEquals(self.reader.getPendingSize(), 24 + 8 + 16)
+        self.assertEquals(self.reader.read(maxRecords=1), [message.toBinary()])
+        self.assertEquals(self.reader.read(), ["", "abcde"])
+        self.assertEquals(self.reader.getPendingSize(), 0)
+
+
+    def testWrapAround(self):
+        received = []
+        for i in range(100):
+            data = "%d" % i * (i % 20)
+            self.assertTrue(self.writer.sendBinary(data))
+            received.extend(self.reader.read())
+            self.assertEquals(received[-1], data)
+        self.assertEquals(len(received), 100)
+
+
+    def testOverflowDrop(self):
+        data = "x" * 60
+        for i in range(4):
+            self.assertTrue(self.writer.sendBinary(data))
+        self.assertFalse(self.writer.sendBinary(data))
+        self.assertEquals(self.writer.getDropped(), 1)
+        self.assertEquals(self.reader.read(maxRecords=1), [data])
+        # the free space is at the start of the ring, and a record does not
+        # wrap, so it is written after a wrap marker
+        self.assertTrue(self.writer.sendBinary(data))
+        self.assertEquals(self.reader.read(), [data] * 4)
+        self.assertEquals(self.reader.getDropped(), 1)
+
+
+    def testOverflowRaise(self):
+        writer = shm.RingWriter(self.path, overflow=shm.OVERFLOW_RAISE)
+        self.addCleanup(writer.close)
+        writer.sendBinary("x" * 200)
+        self.assertRaises(shm.RingFullError, writer.sendBinary, "x" * 60)
+        self.assertEquals(writer.getDropped(), 1)
+        self.assertRaises(osc.OscError, writer.sendBinary, "x" * 256)
+        self.assertRaises(ValueError, shm.RingWriter, self.path, overflow="block")
+
+
+    def testNotARing(self):
+        path = self.mktemp()
+        open(path, "wb").write("\0" * 256)
+        self.assertRaises(osc.OscError, shm.RingWriter, path)
+
+
+    def testWakeup(self):
+        self.writer.sendBinary("a")
+        self.reader.read()
+        self.writer.sendBinary("b")
+        self.assertEquals(select.select([self.reader.wakeupFileno], [], [], 0)[0], [])
+        self.assertEquals(self.reader.wait(0), ["b"])
+
+        self.reader.setWaiting(True)
+        self.writer.sendBinary("c")
+        self.writer.sendBinary("d")
+        self.assertEquals(select.select([self.reader.wakeupFileno], [], [], 0)[0], [self.reader.wakeupFileno])
+        self.assertEquals(os.read(self.reader.wakeupFileno, 16), "\0")
+        self.assertEquals(self.reader.wait(), ["c", "d"])
+        self.assertEquals(self.reader.wait(0.001), [])
@@ -0,0 +1,167 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/stats.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+from twisted.trial import unittest
+from twisted.internet import task
+from txosc import osc
+from txosc import dispatch
+from txosc import stats
+
+
+class TestHistogram(unittest.TestCase):
+    """
+    Test the L{stats.Histogram} class.
+    """
+
+    def testEmpty(self):
+        h = stats.Histogram()
+        self.assertEquals(h.getCount(), 0)
+        self.assertEquals(h.getMean(), 0.0)
+        self.assertEquals(h.getPercentile(99), 0.0)
+
+
+    def testPercentiles(self):
+        h = stats.Histogram()
+        for i in range(1, 101):
+            h.record(i / 1e6)
+        self.assertEquals(h.getCount(), 100)
+        self.assertAlmostEquals(h.getMax(), 100 / 1e6)
+        # 3 bits of precision: at most 1/8 relative error
+        self.assertTrue(abs(h.getPercentile(50) - 50 / 1e6) <= 50 / 8e6)
+        self.assertTrue(abs(h.getPercentile(99) - 99 / 1e6) <= 99 / 8e6)
+        self.assertEquals(h.getPercentile(1), 1 / 1e6)
+
+
+    def testLargeValues(self):
+        h = stats.Histogram()
+        h.record(10.0)
+        h.record(0.001)
+        self.assertTrue(abs(h.getPercentile(100) - 10.0) <= 10.0 / 8)
+        self.assertEquals(len(h._buckets), 2)
+
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    Test the L{stats.Profiler} with a L{dispatch.Receiver}.
+    """
+
+    def setUp(self):
+        self.profiler = stats.Profiler(sampleRate=1.0)
+        self.receiver = dispatch.Receiver()
+        self.receiver.setProfiler(self.profiler)
+
+
+    def testDispatchStatistics(self):
+        def ping(message, address):
+            pass
+        self.receiver.addCallback("/ping", ping)
+        self.receiver.setFallback(lambda m, a: None)
+        self.receiver.dispatch(osc.Message("/ping"), None)
+        self.receiver.dispatch(osc.Bundle([osc.Message("/ping"), osc.Message("/pong")]), None)
+
+        snapshot = self.profiler.snapshot()
+        self.assertEquals(snapshot["addresses"], {"/ping": 2, "/pong": 1})
+        self.assertEquals(snapshot["match"]["count"], 3)
+        self.assertEquals(snapshot["dispatch"]["count"], 3)
+        self.assertEquals(snapshot["callbacks"].keys(), ["txosc.test.test_stats.ping"])
+        self.assertEquals(snapshot["callbacks"]["txosc.test.test_stats.ping"]["count"], 2)
+
+
+    def testSameNamedCallbacks(self):
+        first = lambda m, a: None
+        second = lambda m, a: None
+        self.receiver.addCallback("/first", first)
+        self.receiver.addCallback("/second", second)
+        self.receiver.dispatch(osc.Message("/first"), None)
+        self.receiver.dispatch(osc.Message("/second"), None)
+        self.receiver.dispatch(osc.Message("/second"), None)
+        self.assertEquals(self.profiler.callbackTimes[first].getCount(), 1)
+        self.assertEquals(self.profiler.callbackTimes[second].getCount(), 2)
+        callbacks = self.profiler.snapshot()["callbacks"]
+        self.assertEquals(sorted([h["count"] for h in callbacks.values()]), [1, 2])
+        self.assertIn("txosc.test.test_stats.<lambda> %r" % (second,), callbacks)
+
+
+    def testAddressesBounded(self):
+        self.profiler.maxAddresses = 4
+        for i in range(3):
+            self.profiler.countMessage("/frequent")
+        for i in range(10):
+            self.profiler.countMessage("/random/%d" % (i,))
+        self.assertTrue(len(self.profiler.addressCounts) <= 4)
+        self.assertEquals(self.profiler.addressCounts["/frequent"], 3)
+        self.assertEquals(self.profiler.snapshot()["evictedAddresses"], 8)
+
+
+    def testNoSampling(self):
+        called = []
+        self.profiler.sampleRate = 0.0
+        self.receiver.addCallback("/ping", lambda m, a: called.append(m))
+        self.receiver.dispatch(osc.Message("/ping"), None)
+        self.assertEquals(len(called), 1)
+        self.assertEquals(self.profiler.addressCounts, {"/ping": 1})
+        self.assertEquals(self.profiler.matchTime.getCount(), 0)
+
+
+    def testPeriodicDump(self):
+        clock = task.Clock()
+        dumps = []
+        self.profiler.startDumping(5.0, dumps.append, clock)
+        clock.advance(5.0)
+        clock.advance(5.0)
+        self.profiler.stopDumping()
+        clock.advance(5.0)
+        self.assertEquals(len(dumps), 2)
+        self.assertEquals(dumps[0]["addresses"], {})
+
+
+
+class TestFallbackCounter(unittest.TestCase):
+    """
+    Test the L{stats.FallbackCounter} class.
+    """
+
+    def testCounting(self):
+        counter = stats.FallbackCounter()
+        receiver = dispatch.Receiver()
+        receiver.setFallback(counter)
+        for i in range(3):
+            receiver.dispatch(osc.Message("/foo"), ("10.0.0.1", 1234))
+        receiver.dispatch(osc.Message("/bar"), ("10.0.0.2", 1234))
+        self.assertEquals(counter.getTotal(), 4)
+        self.assertEquals(counter.getTop(), [(("/foo", "10.0.0.1"), 3), (("/bar", "10.0.0.2"), 1)])
+        self.assertEquals(counter.getTop(1), [(("/foo", "10.0.0.1"), 3)])
+
+
+    def testBoundedTable(self):
+        counter = stats.FallbackCounter(maxEntries=4)
+        addr = ("10.0.0.1", 1234)
+        for i in range(10):
+            counter(osc.Message("/flood"), addr)
+        for i in range(100):
+            counter(osc.Message("/random/%d" % i), addr)
+        self.assertTrue(len(counter._counts) <= 4)
+        self.assertEquals(counter.getTop(1), [(("/flood", "10.0.0.1"), 10)])
+        self.assertEquals(counter.getTotal(), 110)
+        self.assertTrue(counter.snapshot()["evicted"] > 0)
+
+
+    def testPeriodicSummary(self):
+        clock = task.Clock()
+        dumps = []
+        counter = stats.FallbackCounter()
+        counter.startDumping(1.0, dumps.append, clock)
+        counter(osc.Message("/foo"), ("10.0.0.1", 1234))
+        clock.advance(1.0)
+        clock.advance(1.0)
+        counter(osc.Message("/foo"), ("10.0.0.1", 1234))
+        clock.advance(1.0)
+        counter.stopDumping()
+        self.assertEquals([d["total"] for d in dumps], [1, 2])
@@ -0,0 +1,534 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/sync.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+import os
+import sys
+import socket
+import subprocess
+import threading
+import time
+from twisted.trial import unittest
+from txosc import osc
+from txosc import sync
+from txosc import framing
+from txosc import dispatch
+
+# made absolute before trial changes the working directory
+_pythonPath = os.pathsep.join([os.path.abspath(path) for path in sys.path])
+
+
+class FakeSender(object):
+    """
+    Stores the data sent, instead of sending it.
+    """
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def _actually_send(self, binary_data):
+        self.sent.append(binary_data)
+
+    def close(self):
+        self.closed = True
+
+
+
+class TestBundlingSender(unittest.TestCase):
+    """
+    Test the L{sync.BundlingSender} class.
+    """
+
+    def testFlush(self):
+        sender = FakeSender()
+        bundling = sync.BundlingSender(sender, mtu=200, delay=10.0)
+        for i in range(10):
+            bundling.send(osc.Message("/foo", i))
+        self.assertEquals(len(sender.sent), 1)
+        bundling.close()
+        self.assertEquals(len(sender.sent), 2)
+        self.assertTrue(sender.closed)
+        received = []
+        for data in sender.sent:
+            received.extend(osc.Bundle.fromBinary(data)[0].elements)
+        self.assertEquals(received, [osc.Message("/foo", i) for i in range(10)])
+
+
+    def testDelay(self):
+        sender = FakeSender()
+        bundling = sync.BundlingSender(sender, delay=0.0)
+        bundling.send(osc.Message("/foo"))
+        self.assertEquals(sender.sent, [])
+        bundling.sendAtomic([osc.Message("/bar"), osc.Message("/baz")])
+        self.assertEquals(sender.sent, [osc.Message("/foo").toBinary()])
+
+
+
+class TestUdpSender(unittest.TestCase):
+    """
+    Test the L{sync.UdpSender} class via localhost.
+    """
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(1.0)
+        self.port = self.server.getsockname()[1]
+
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def testSend(self):
+        sender = sync.UdpSender("localhost", self.port)
+        sender.send(osc.Message("/ping", 1))
+        sender.close()
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 1).toBinary())
+
+
+    def testConnected(self):
+        sender = sync.UdpSender("localhost", self.port, connected=True)
+        sender.send(osc.Message("/ping", 1))
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 1).toBinary())
+        sender.close()
+        self.assertRaises(RuntimeError, sync.UdpSender, "localhost", self.port, sync.UDP_MODE_BROADCAST, None, True)
+
+
+    def testSendMany(self):
+        other = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other.bind(("127.0.0.1", 0))
+        other.settimeout(1.0)
+        self.addCleanup(other.close)
+        sender = sync.UdpSender("localhost", self.port)
+        elements = [osc.Message("/ping", 1), osc.Message("/ping", 2).toBinary()]
+        self.assertEquals(sender.sendMany(elements, [("localhost", self.port), other.getsockname()]), 4)
+        self.assertEquals(sender.sendMany([osc.Message("/ping", 3)]), 1)
+        sender.close()
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 1).toBinary())
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 2).toBinary())
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 3).toBinary())
+        self.assertEquals(other.recv(1024), osc.Message("/ping", 1).toBinary())
+        self.assertEquals(other.recv(1024), osc.Message("/ping", 2).toBinary())
+
+
+    def testConnectedSendMany(self):
+        sender = sync.UdpSender("localhost", self.port, connected=True)
+        self.assertEquals(sender.sendMany([osc.Message("/ping", 1), osc.Message("/ping", 2)]), 2)
+        self.assertRaises(RuntimeError, sender.sendMany, [osc.Message("/ping")], ("localhost", self.port))
+        sender.close()
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 1).toBinary())
+        self.assertEquals(self.server.recv(1024), osc.Message("/ping", 2).toBinary())
+
+
+
+class TestUnixSenders(unittest.TestCase):
+    """
+    Test the L{sync.UnixStreamSender} and L{sync.UnixDatagramSender} classes.
+    """
+
+    def testDatagram(self):
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        server.bind(path)
+        self.addCleanup(server.close)
+        sender = sync.UnixDatagramSender(path)
+        sender.send(osc.Message("/ping", 1))
+        sender.close()
+        self.assertEquals(server.recv(1024), osc.Message("/ping", 1).toBinary())
+
+
+    def testStream(self):
+        path = self.mktemp()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        self.addCleanup(server.close)
+        sender = sync.UnixStreamSender(path)
+        connection, address = server.accept()
+        self.addCleanup(connection.close)
+        sender.send(osc.Message("/ping", 1))
+        sender.close()
+        framer = framing.LengthPrefixedFramer()
+        self.assertEquals(framer.feed(connection.recv(1024)), [osc.Message("/ping", 1).toBinary()])
+
+
+
+class FakeTraceback(object):
+    """
+    Counts the tracebacks printed, instead of printing them.
+    """
+    printed = 0
+
+    def print_exc(self):
+        self.printed += 1
+
+
+
+class TestUdpReceiver(unittest.TestCase):
+    """
+    Test the L{sync.UdpReceiver} class via localhost.
+    """
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.received = []
+        self.receiver.addCallback("/ping", lambda message, client: self.received.append((message.getValues(), client)))
+        self.server = sync.UdpReceiver(0, self.receiver, "127.0.0.1", batchSize=3)
+        self.sender = sync.UdpSender("127.0.0.1", self.server.port)
+
+
+    def tearDown(self):
+        self.server.close()
+        self.sender.close()
+
+
+    def testPoll(self):
+        self.assertEquals(self.server.poll(0), 0)
+        self.assertEquals(self.server.poll(0.01), 0)
+        for i in range(4):
+            self.sender.send(osc.Message("/ping", i))
+        self.sender._actually_send("garbage")
+        self.assertEquals(self.server.poll(1), 3)
+        self.assertEquals(self.server.poll(1), 2)
+        client = self.sender._socket.getsockname()
+        self.assertEquals(self.received, [([i], ("127.0.0.1", client[1])) for i in range(4)])
+        self.assertEquals((self.server.packetCount, self.server.errorCount), (5, 1))
+
+
+    def testCallbackError(self):
+        printer = FakeTraceback()
+        self.patch(sync, "traceback", printer)
+        self.receiver.addCallback("/fail", lambda message, client: 1 / 0)
+        self.receiver.addCallback("/stop", lambda message, client: self.server.shutdown())
+        for address in ["/ping", "/fail", "/ping", "/stop"]:
+            self.sender.send(osc.Message(address, 1))
+        self.server.serve_forever(0.01)
+        self.assertEquals(len(self.received), 2)
+        self.assertEquals((self.server.callbackErrorCount, printer.printed), (1, 1))
+
+
+    def testServeForever(self):
+        self.receiver.addCallback("/stop", lambda message, client: self.server.shutdown())
+        self.sender.send(osc.Message("/ping", 1))
+        self.sender.send(osc.Message("/stop"))
+        self.server.serve_forever(0.01)
+        self.assertEquals(len(self.received), 1)
+
+
+    def testTwistedFree(self):
+        code = "import sys; from txosc import sync, dispatch; print [m for m in sys.modules if m.startswith('twisted')]"
+        process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=_pythonPath))
+        self.assertEquals(process.communicate()[0].strip(), "[]")
+        # the unhandled messages are counted instead of being logged with Twisted
+        code = "; ".join([
+            "import sys",
+            "from txosc import sync, dispatch, osc",
+            "server = sync.UdpReceiver(0, dispatch.Receiver(), '127.0.0.1')",
+            "sync.UdpSender('127.0.0.1', server.port).send(osc.Message('/unhandled'))",
+            "server.poll(1)",
+            "print server.unhandled.getTotal(), [m for m in sys.modules if m.startswith('twisted')]",
+            ])
+        process = subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.PIPE, env=dict(os.environ, PYTHONPATH=_pythonPath))
+        self.assertEquals(process.communicate()[0].strip(), "1 []")
+
+
+    def testOwnFallback(self):
+        self.assertEquals(self.server.unhandled.getTotal(), 0)
+        receiver = dispatch.Receiver()
+        fallback = lambda message, client: None
+        receiver.setFallback(fallback)
+        server = sync.UdpReceiver(0, receiver, "127.0.0.1")
+        server.close()
+        self.assertIdentical(server.unhandled, None)
+        self.assertIdentical(receiver.fallback, fallback)
+
+
+
+class TestTcpReceiver(unittest.TestCase):
+    """
+    Test the L{sync.TcpReceiver} class via localhost.
+    """
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.server = sync.TcpReceiver(0, self.receiver, "127.0.0.1", maxFrameSize=64)
+
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def testReceiveAndReply(self):
+        self.receiver.addCallback("/ping", lambda message, client: client.send(osc.Message("/pong", *message.getValues())))
+        sender = sync.TcpSender("127.0.0.1", self.server.port)
+        self.addCleanup(sender.close)
+        self.assertEquals(self.server.poll(1), 0)
+        self.assertEquals(len(self.server.connections), 1)
+        for i in range(3):
+            sender.send(osc.Message("/ping", i))
+        received = 0
+        while received < 3:
+            received += self.server.poll(1)
+        sender._socket.settimeout(1)
+        framer = framing.LengthPrefixedFramer()
+        replies = []
+        while len(replies) < 3:
+            replies.extend(framer.feed(sender._socket.recv(1024)))
+        self.assertEquals(replies, [osc.Message("/pong", i).toBinary() for i in range(3)])
+
+        sender.close()
+        self.server.poll(1)
+        self.assertEquals(self.server.connections, {})
+
+
+    def testCallbackError(self):
+        printer = FakeTraceback()
+        self.patch(sync, "traceback", printer)
+        received = []
+        def ping(message, client):
+            received.append(message.getValues()[0])
+            if received[-1] == 1:
+                raise ValueError("bad ping")
+        self.receiver.addCallback("/ping", ping)
+        sender = sync.TcpSender("127.0.0.1", self.server.port)
+        self.addCleanup(sender.close)
+        self.server.poll(1)
+        # all the frames are sent at once, so that they are read together
+        sender._socket.sendall("".join(["".join(framing.LengthPrefixedFramer().frame(osc.Message("/ping", i).toBinary())) for i in range(4)]))
+        for attempt in range(10):
+            if len(received) == 4:
+                break
+            self.server.poll(0.1)
+        self.assertEquals(received, range(4))
+        self.assertEquals((self.server.callbackErrorCount, printer.printed), (1, 1))
+
+
+    def testFrameTooLarge(self):
+        sender = sync.TcpSender("127.0.0.1", self.server.port)
+        self.addCleanup(sender.close)
+        self.server.poll(1)
+        sender.send(osc.Message("/ping", "x" * 100))
+        self.server.poll(1)
+        self.assertEquals(self.server.connections, {})
+
+
+
+class TestBufferedTcpSender(unittest.TestCase):
+    """
+    Test the L{sync.BufferedTcpSender} class via localhost.
+    """
+    timeout = 5
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.received = []
+        self.receiver.addCallback("/*", lambda message, client: self.received.append((message.address, message.getValues()[0])))
+        self.server = sync.TcpReceiver(0, self.receiver, "127.0.0.1", maxFrameSize=1 << 23)
+
+
+    def tearDown(self):
+        self.server.close()
+
+
+    def _receive(self, count):
+        deadline = time.time() + self.timeout
+        while len(self.received) < count and time.time() < deadline:
+            self.server.poll(0.1)
+
+
+    def testBatching(self):
+        sender = sync.BufferedTcpSender("127.0.0.1", self.server.port, flushSize=50, delay=10)
+        self.addCleanup(sender.close)
+        # a /ping message with an int is 20 bytes long once framed. The
+        # first one starts a burst, and is written at once.
+        sender.send(osc.Message("/ping", 0))
+        self.assertEquals(sender.getPendingSize(), 0)
+        self._receive(1)
+        sender.send(osc.Message("/ping", 1))
+        sender.send(osc.Message("/ping", 2))
+        self.assertEquals(sender.getPendingSize(), 40)
+        self.server.poll(0.01)
+        self.assertEquals(self.server.poll(0.01), 0)
+        sender.send(osc.Message("/ping", 3))
+        self.assertEquals(sender.getPendingSize(), 0)
+        sender.send(osc.Message("/ping", 4))
+        self.assertTrue(sender.flush())
+        self._receive(5)
+        self.assertEquals(self.received, [("/ping", i) for i in range(5)])
+
+
+    def testLoneSend(self):
+        for delay in (0.0, 0.001):
+            self.received = []
+            sender = sync.BufferedTcpSender("127.0.0.1", self.server.port, delay=delay)
+            self.addCleanup(sender.close)
+            sender.send(osc.Message("/ping", 0))
+            self.assertEquals(sender.getPendingSize(), 0)
+            self._receive(1)
+            self.assertEquals(self.received, [("/ping", 0)])
+            # a request and its reply, after the previous send
+            time.sleep(0.01)
+            sender.send(osc.Message("/ping", 1))
+            self.assertEquals(sender.getPendingSize(), 0)
+            self._receive(2)
+            self.assertEquals(self.received, [("/ping", 0), ("/ping", 1)])
+
+
+    def testLargePacket(self):
+        # larger than the socket buffers, so that the writes are partial
+        data = "x" * (1 << 22)
+        thread = threading.Thread(target=self._receive, args=(1,))
+        thread.start()
+        sender = sync.BufferedTcpSender("127.0.0.1", self.server.port, flushSize=0)
+        sender.send(osc.Message("/blob", data))
+        thread.join()
+        sender.close()
+        self.assertEquals(self.received, [("/blob", data)])
+
+
+    def testReconnect(self):
+        port = self.server.port
+        sender = sync.BufferedTcpSender("127.0.0.1", port, flushSize=0, maxBacklog=60, retryDelay=0)
+        self.addCleanup(sender.close)
+        sender.send(osc.Message("/ping", 0))
+        self._receive(1)
+        self.server.close()
+        # the first writes may succeed before the connection is reset
+        for i in range(100):
+            sender.send(osc.Message("/lost", i))
+            if sender.getPendingSize():
+                break
+        self.assertEquals(sender.getPendingSize(), 20)
+        for i in range(5):
+            sender.send(osc.Message("/after", i))
+        self.assertEquals(sender.getPendingSize(), 60)
+        self.assertEquals(sender.droppedCount, 3)
+        self.assertEquals(sender.reconnectCount, 0)
+
+        self.received = []
+        self.server = sync.TcpReceiver(port, self.receiver, "127.0.0.1")
+        self.assertTrue(sender.flush())
+        self.assertEquals(sender.getPendingSize(), 0)
+        self.assertEquals(sender.reconnectCount, 1)
+        self._receive(3)
+        self.assertEquals(self.received, [("/after", i) for i in range(2, 5)])
+
+
+    def testTcpSenderSendsAll(self):
+        data = "x" * (1 << 22)
+        thread = threading.Thread(target=self._receive, args=(1,))
+        thread.start()
+        sender = sync.TcpSender("127.0.0.1", self.server.port)
+        sender.send(osc.Message("/blob", data))
+        thread.join()
+        sender.close()
+        self.assertEquals(self.received, [("/blob", data)])
+
+
+
+class TestThreadPoolDispatcher(unittest.TestCase):
+    """
+    Test the L{sync.ThreadPoolDispatcher} class.
+    """
+    timeout = 5
+
+    def setUp(self):
+        self.receiver = dispatch.Receiver()
+        self.received = []
+        self.receivedLock = threading.Lock()
+        self.receiver.addCallback("/*", self._received)
+
+
+    def _received(self, message, client):
+        self.receivedLock.acquire()
+        self.received.append((message.address, message.getValues()[0]))
+        self.receivedLock.release()
+
+
+    def testUdp(self):
+        pool = sync.ThreadPoolDispatcher(self.receiver, workers=3)
+        self.addCleanup(pool.close)
+        server = sync.UdpReceiver(0, pool, "127.0.0.1")
+        self.addCleanup(server.close)
+        sender = sync.UdpSender("127.0.0.1", server.port)
+        self.addCleanup(sender.close)
+        for i in range(20):
+            sender.send(osc.Message("/ping", i))
+        while server.packetCount < 20:
+            server.poll(1)
+        pool.close()
+        self.assertEquals(sorted(self.received), [("/ping", i) for i in range(20)])
+        self.assertEquals(pool.getStats(), {"queued": 0, "dispatched": 20, "overflows": 0, "errors": 0})
+
+
+    def testOrdered(self):
+        pool = sync.ThreadPoolDispatcher(self.receiver, workers=4, ordered=True)
+        for i in range(100):
+            # several messages to the same address, some of them in a
+            # nested bundle
+            inner = osc.Bundle([osc.Message("/b", 4 * i + 1), osc.Message("/b", 4 * i + 2)])
+            bundle = osc.Bundle([osc.Message("/a", i), osc.Message("/b", 4 * i), inner, osc.Message("/b", 4 * i + 3)])
+            self.assertTrue(pool.dispatch(bundle, None))
+            pool.dispatch(osc.Message("/c", i), None)
+        pool.close()
+        for address, count in [("/a", 100), ("/b", 400), ("/c", 100)]:
+            values = [value for a, value in self.received if a == address]
+            self.assertEquals(values, range(count))
+        self.assertEquals(pool.getStats()["dispatched"], 600)
+
+
+    def testOverflow(self):
+        started = threading.Event()
+        release = threading.Event()
+        def wait(message, client):
+            started.set()
+            release.wait()
+        self.receiver.addCallback("/wait", wait)
+        pool = sync.ThreadPoolDispatcher(self.receiver, workers=1, maxQueueSize=2)
+        self.assertTrue(pool.dispatch(osc.Message("/wait", 0), None))
+        started.wait()
+        self.assertTrue(pool.dispatch(osc.Message("/ping", 1), None))
+        self.assertTrue(pool.dispatch(osc.Message("/ping", 2), None))
+        self.assertFalse(pool.dispatch(osc.Message("/ping", 3), None))
+        self.assertEquals(pool.getStats()["queued"], 2)
+        release.set()
+        pool.close()
+        self.assertEquals(self.received, [("/wait", 0), ("/ping", 1), ("/ping", 2)])
+        self.assertEquals(pool.getStats()["overflows"], 1)
+        self.assertEquals(pool.overflowCount, 1)
+
+
+    def testUnhandled(self):
+        pool = sync.ThreadPoolDispatcher(dispatch.Receiver(), workers=4)
+        for i in range(100):
+            pool.dispatch(osc.Message("/unhandled/%d" % (i % 8)), None)
+        pool.close()
+        self.assertEquals(pool.unhandled.getTotal(), 100)
+
+
+    def testErrors(self):
+        printer = FakeTraceback()
+        self.patch(sync, "traceback", printer)
+        self.receiver.addCallback("/fail", lambda message, client: 1 / 0)
+        pool = sync.ThreadPoolDispatcher(self.receiver, workers=2)
+        pool.dispatch(osc.Message("/fail", 0), None)
+        pool.dispatch(osc.Message("/ping", 1), None)
+        pool.close()
+        self.assertEquals(pool.getStats()["errors"], 1)
+        self.assertEquals(pool.getStats()["dispatched"], 2)
+        self.assertEquals(printer.printed, 1)
+        self.assertIn(("/ping", 1), self.received)
+
+
+    def testClose(self):
+        pool = sync.ThreadPoolDispatcher(self.receiver, workers=2)
+        pool.close()
+        pool.close()
+        self.assertRaises(RuntimeError, pool.dispatch, osc.Message("/ping", 1), None)
+        self.assertEquals([thread.isAlive() for thread in pool._threads], [False, False])
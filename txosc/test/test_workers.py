@@ -0,0 +1,107 @@
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Tests for txosc/workers.py
+
+Maintainer: Arjan Scherpenisse
+"""
+
+import os
+import sys
+import signal
+import socket
+from twisted.trial import unittest
+from twisted.internet import reactor, defer, task
+from txosc import osc
+from txosc import dispatch
+from txosc import workers
+
+
+def makeReceiver():
+    """
+    The receiver factory of the workers of the tests.
+    """
+    receiver = dispatch.Receiver()
+    receiver.addCallback("/ping", lambda message, address: None)
+    return receiver
+
+
+
+def makeBrokenReceiver():
+    """
+    A receiver factory which makes the workers exit at startup.
+    """
+    raise RuntimeError("broken receiver")
+
+
+
+class TestWorkerGroup(unittest.TestCase):
+    """
+    Test the L{workers.WorkerGroup} with worker processes.
+    """
+    timeout = 20
+
+    if not sys.platform.startswith("linux"):
+        skip = "SO_REUSEPORT load balancing is only tested on Linux"
+
+    def setUp(self):
+        self.group = workers.WorkerGroup("txosc.test.test_workers.makeReceiver", 17790, count=2, interface="127.0.0.1")
+        self.group.statsInterval = 0.1
+        self.group.restartDelay = 0.1
+
+
+    def tearDown(self):
+        return self.group.stop()
+
+
+    @defer.inlineCallbacks
+    def _waitFor(self, condition):
+        while not condition():
+            yield task.deferLater(reactor, 0.05, lambda: None)
+
+
+    def testInvalidFactory(self):
+        self.assertRaises(AttributeError, workers.WorkerGroup, "txosc.test.test_workers.missing", 17790)
+
+
+    @defer.inlineCallbacks
+    def testStats(self):
+        yield self.group.start()
+        data = osc.Message("/ping").toBinary()
+        senders = []
+        for i in range(10):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.addCleanup(sender.close)
+            for j in range(3):
+                sender.sendto(data, ("127.0.0.1", 17790))
+        yield self._waitFor(lambda: self.group.getStats()["total"].get("datagrams") == 30)
+        stats = self.group.getStats()
+        self.assertEquals(sorted(stats["workers"].keys()), [0, 1])
+        self.assertEquals(stats["total"]["bytes"], 30 * len(data))
+        self.assertEquals(stats["restarts"], 0)
+
+
+    @defer.inlineCallbacks
+    def testRestart(self):
+        yield self.group.start()
+        pid = self.group.getStats()["workers"][0]["pid"]
+        os.kill(pid, signal.SIGKILL)
+        yield self._waitFor(lambda: self.group.restarts == 1 and len(self.group._workers) == 2 and self.group._workers[0].stats)
+        self.assertNotEquals(self.group.getStats()["workers"][0]["pid"], pid)
+
+
+    @defer.inlineCallbacks
+    def testStartFailure(self):
+        group = workers.WorkerGroup("txosc.test.test_workers.makeBrokenReceiver", 17791, count=1, interface="127.0.0.1")
+        group.restartDelay = 0.05
+        group.maxRestarts = 2
+        self.addCleanup(group.stop)
+        yield self.assertFailure(group.start(), osc.OscError)
+        # the delays double: 0.05 then 0.1 seconds
+        yield self._waitFor(lambda: group.restarts == 2 and group._workers)
+        yield self._waitFor(lambda: not group._workers)
+        self.assertEquals(group._failures, {0: 2})
+        yield task.deferLater(reactor, 0.5, lambda: None)
+        self.assertEquals(group.restarts, 2)
+        self.assertEquals(group._workers, {})
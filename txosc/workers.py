@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- test-case-name: txosc.test.test_workers -*-
+# Copyright (c) 2009 Alexandre Quessy, Arjan Scherpenisse
+# See LICENSE for details.
+
+"""
+Multi-process OSC over UDP server
+
+A single Twisted process decodes and dispatches the received messages
+with one core. A L{WorkerGroup} starts many worker processes, which all
+bind the same UDP port with the C{SO_REUSEPORT} option. The kernel spreads
+the datagrams between them by hashing their source and destination
+addresses, so that the datagrams of a sender always go to the same
+worker, in order.
+
+Each worker builds its own L{txosc.dispatch.Receiver} by calling a
+function given by its fully qualified name, since Python objects cannot
+be shared between the processes. The workers report their statistics to
+the parent process as JSON lines on their standard output.
+"""
+import os
+import sys
+import json
+
+from twisted.internet import defer, error, protocol, task
+from twisted.python import log, reflect
+from txosc import async
+from txosc.osc import OscError
+
+# The path of the modules is made absolute at import time, so that the
+# workers find them even if the working directory changes afterwards.
+_pythonPath = os.pathsep.join([os.path.abspath(path) for path in sys.path])
+
+
+class WorkerGroup(object):
+    """
+    Starts and supervises UDP server worker processes.
+
+    A worker which exits while the group is running is started again
+    after C{restartDelay} seconds. The delay doubles each time the worker
+    exits again before it reports its statistics, up to
+    C{maxRestartDelay}, and the worker is given up after C{maxRestarts}
+    such consecutive restarts.
+
+    Here is an example on how to use it::
+
+      # in mypackage/receivers.py
+      def makeReceiver():
+          receiver = dispatch.Receiver()
+          receiver.addCallback("/ping", ping)
+          return receiver
+
+      group = WorkerGroup("mypackage.receivers.makeReceiver", 17779, count=4)
+      group.start()
+
+    @ivar receiverFactory: Fully qualified name of a function with no
+        argument which returns a L{txosc.dispatch.Receiver}. It must be
+        importable by the workers.
+    @type receiverFactory: C{str}
+    @ivar port: The UDP port number.
+    @ivar count: The number of workers.
+    @ivar interface: The interface to listen on.
+    @ivar receiveBufferSize: The C{SO_RCVBUF} size of the sockets, or C{None}.
+    @ivar restartDelay: Delay before a worker is started again, in seconds.
+    @ivar maxRestartDelay: The longest delay before a worker is started
+        again, in seconds.
+    @ivar maxRestarts: The most consecutive restarts of a worker which
+        exits before it reports.
+    @ivar statsInterval: Interval between the reports of the statistics
+        of each worker, in seconds.
+    @ivar restarts: Number of times a worker was started again.
+    """
+    reactor = None
+    restartDelay = 1.0
+    maxRestartDelay = 60.0
+    maxRestarts = 10
+    statsInterval = 1.0
+
+    def __init__(self, receiverFactory, port, count=None, interface='', receiveBufferSize=None):
+        """
+        @param count: The number of workers. Defaults to the number of CPUs.
+        @param receiveBufferSize: The C{SO_RCVBUF} size of the socket of
+            each worker, in bytes.
+        @raise AttributeError: If C{receiverFactory} cannot be found.
+        """
+        reflect.namedAny(receiverFactory)
+        if count is None:
+            import multiprocessing
+            count = multiprocessing.cpu_count()
+        self.receiverFactory = receiverFactory
+        self.port = port
+        self.count = count
+        self.interface = interface
+        self.receiveBufferSize = receiveBufferSize
+        self.restarts = 0
+        self._running = False
+        self._workers = {}
+        self._retired = {}
+        self._started = {}
+        self._failures = {}
+        self._stopped = []
+
+
+    def start(self):
+        """
+        Starts the workers.
+
+        @return: A L{Deferred} which fires once every worker listens. It
+            fails with an L{OscError} if a worker exits before, for
+            instance because it cannot bind the port.
+        """
+        self._running = True
+        waiting = []
+        for index in range(self.count):
+            self._started[index] = defer.Deferred()
+            waiting.append(self._started[index])
+            self._startWorker(index)
+        d = defer.gatherResults(waiting, consumeErrors=True)
+        d.addErrback(lambda failure: failure.value.subFailure)
+        return d
+
+
+    def stop(self):
+        """
+        Stops the workers with the TERM signal.
+
+        @return: A L{Deferred} which fires once every worker has exited.
+        """
+        self._running = False
+        waiting = []
+        for worker in self._workers.values():
+            d = defer.Deferred()
+            self._stopped.append(d)
+            waiting.append(d)
+            try:
+                worker.transport.signalProcess("TERM")
+            except error.ProcessExitedAlready:
+                pass
+        return defer.gatherResults(waiting)
+
+
+    def getStats(self):
+        """
+        Returns the statistics of the workers.
+
+        Each worker reports the statistics returned by
+        L{txosc.async.DatagramServerProtocol.getStats}. The totals of the
+        counters include the workers which have exited, and the totals of
+        the rates are those of the running workers.
+
+        @return: C{dict} with a C{"workers"} C{dict} of the last report of
+            each worker, by index, a C{"total"} C{dict} of the sum of the
+            counters and rates, and the number of C{"restarts"}.
+        """
+        workers = {}
+        total = dict(self._retired)
+        for index, worker in self._workers.iteritems():
+            workers[index] = dict(worker.stats, pid=worker.transport.pid)
+            for key, value in worker.stats.iteritems():
+                if value is not None and key != "receiveBufferSize":
+                    total[key] = total.get(key, 0) + value
+        return {"workers": workers, "total": total, "restarts": self.restarts}
+
+
+    def _startWorker(self, index):
+        worker = _WorkerProcessProtocol(self, index)
+        args = [sys.executable, "-m", "txosc.workers", self.receiverFactory, str(self.port), self.interface, str(self.statsInterval), str(self.receiveBufferSize or "")]
+        env = dict(os.environ)
+        env["PYTHONPATH"] = _pythonPath
+        self._getReactor().spawnProcess(worker, sys.executable, args, env)
+        self._workers[index] = worker
+
+
+    def _workerReported(self, worker):
+        worker.reported = True
+        self._failures.pop(worker.index, None)
+        d = self._started.pop(worker.index, None)
+        if d is not None:
+            d.callback(None)
+
+
+    def _workerEnded(self, worker, reason):
+        if self._workers.get(worker.index) is worker:
+            del self._workers[worker.index]
+        for key in ["datagrams", "bytes", "drops"]:
+            value = worker.stats.get(key)
+            if value is not None:
+                self._retired[key] = self._retired.get(key, 0) + value
+        d = self._started.pop(worker.index, None)
+        if d is not None:
+            d.errback(OscError("OSC worker %d exited before listening: %s" % (worker.index, reason.getErrorMessage())))
+        if self._running:
+            log.msg("OSC worker %d exited: %s" % (worker.index, reason.getErrorMessage()))
+            delay = self.restartDelay
+            if not worker.reported:
+                failures = self._failures.get(worker.index, 0)
+                if failures >= self.maxRestarts:
+                    log.msg("OSC worker %d is not started again after %d attempts." % (worker.index, failures))
+                    return
+                self._failures[worker.index] = failures + 1
+                delay = min(self.restartDelay * 2 ** failures, self.maxRestartDelay)
+            self.restarts += 1
+            self._getReactor().callLater(delay, self._restartWorker, worker.index)
+            return
+        if not self._workers:
+            stopped = self._stopped
+            self._stopped = []
+            for d in stopped:
+                d.callback(None)
+
+
+    def _restartWorker(self, index):
+        if self._running and index not in self._workers:
+            self._startWorker(index)
+
+
+    def _getReactor(self):
+        if self.reactor is None:
+            from twisted.internet import reactor
+            return reactor
+        return self.reactor
+
+
+
+class _WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    Reads the statistics reported by a worker.
+
+    @ivar stats: The last statistics reported.
+    @ivar reported: Whether the worker has reported its statistics.
+    """
+
+    def __init__(self, group, index):
+        self.group = group
+        self.index = index
+        self.stats = {}
+        self.reported = False
+        self._buffer = ""
+
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split("\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            try:
+                self.stats = json.loads(line)
+            except ValueError:
+                log.msg("OSC worker %d: %s" % (self.index, line))
+                continue
+            self.group._workerReported(self)
+
+
+    def errReceived(self, data):
+        log.msg("OSC worker %d: %s" % (self.index, data.rstrip()))
+
+
+    def processEnded(self, reason):
+        self.group._workerEnded(self, reason)
+
+
+
+def main(args):
+    """
+    Runs a worker.
+
+    @param args: The receiver factory name, the port, the interface, the
+        interval between the statistics reports, and the size of the
+        receive buffer, or an empty string for the default one.
+    """
+    from twisted.internet import reactor
+    log.startLogging(sys.stderr, setStdout=False)
+    receiverFactory, port, interface, statsInterval, receiveBufferSize = args
+    if receiveBufferSize:
+        receiveBufferSize = int(receiveBufferSize)
+    else:
+        receiveBufferSize = None
+    proto = async.DatagramServerProtocol(reflect.namedAny(receiverFactory)(), receiveBufferSize)
+    async.listenUDPBatched(int(port), proto, interface, reusePort=True)
+    def report():
+        sys.stdout.write(json.dumps(proto.getStats()) + "\n")
+        sys.stdout.flush()
+    task.LoopingCall(report).start(float(statsInterval))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])